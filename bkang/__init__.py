@@ -1 +1,13 @@
-from .archive import AstractArchive, Datename, single_instance_aborting
\ No newline at end of file
+# the command line entry points import only what they use, the package exports load on first access
+_EXPORTS = {
+    "AstractArchive": ".archive",
+    "Datename": ".datename",
+    "single_instance_aborting": ".util",
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        import importlib
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -6,7 +6,10 @@ from datetime import datetime
 import shutil
 
 from .util import single_instance_aborting, get_cmd_output
-from .datename import Datename
+from .catalog import SnapshotCatalog
+from .datename import Datename, get_prune_plan
+from .metrics import RunMetrics
+from .tracing import span
 
 
 
@@ -50,7 +53,7 @@ class AstractArchive(ABC):
         except Exception as e:
             raise Exception(f"Error creating directories: {e}")
 
-    def __init__(self, archive_root: Union[str, Path], current_name: str = "current", snapshots_name: str = "snapshots", yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24) -> None:
+    def __init__(self, archive_root: Union[str, Path], current_name: str = "current", snapshots_name: str = "snapshots", yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0, metrics: Optional[RunMetrics] = None) -> None:
         if isinstance(archive_root, str):
             archive_root = Path(archive_root)
         self.archive_root: Path = archive_root
@@ -61,6 +64,10 @@ class AstractArchive(ABC):
         self.weekly_count: int = weekly_count
         self.daily_count: int  = daily_count
         self.hourly_count: int = hourly_count
+        self.minute_count: int = minute_count
+        self._catalog: Optional[SnapshotCatalog] = None
+        # phases and counts of the archive operations are recorded here when given
+        self.metrics: Optional[RunMetrics] = metrics
         self.init_dirs()
         assert self.requirements_installed(), "Requirements not installed"
     
@@ -78,43 +85,40 @@ class AstractArchive(ABC):
         """
         return self.archive_root / self.snapshots_name
 
+    @property
+    def catalog(self) -> SnapshotCatalog:
+        """
+        The up to date snapshot catalog of the archive.
+        """
+        if self._catalog is None:
+            self._catalog = SnapshotCatalog(self.snapshots_path)
+        else:
+            self._catalog.refresh()
+        return self._catalog
+
+    def _phase(self, name: str):
+        return self.metrics.phase(name) if self.metrics is not None else span(name)
+
     def list_snapshots(self) -> List[Path]:
         """
-        List all snapshots in the archive.
+        List all snapshots in the archive, oldest first.
         """
-        return sorted(self.archive_root.glob("**/*"))
+        with self._phase("enumerate"):
+            return self.catalog.paths()
 
     def get_prune_snapshots(self) -> Tuple[List[Path], List[Path]]:
         """
         Get snapshots to prune.
         """
-        old_to_new_snapshots = self.list_snapshots()
-        keep = [old_to_new_snapshots[0]]
-        keep_years = [old_to_new_snapshots[0]]
-        keep_months = [Datename(keep[0])]
-        keep_weeks = [Datename(keep[0])]
-        keep_days = [Datename(keep[0])]
-        keep_hours = [Datename(keep[0])]
-        keep_minutes = [Datename(keep[0])]
-
-        for snapshot in old_to_new_snapshots[1:]:
-            snapshot_date = Datename(snapshot)
-            if (self.yearly_count < 0 or len(keep_years) < self.yearly_count) and Datename(keep_years[-1]) - snapshot_date > Datename.one_year():
-                keep_years.append(snapshot_date)
-            if (self.montly_count < 0 or len(keep_months) < self.montly_count) and Datename(keep_months[-1]) - snapshot_date > Datename.one_month():
-                keep_months.append(snapshot_date)
-            if (self.weekly_count < 0 or len(keep_weeks) < self.weekly_count) and Datename(keep_weeks[-1]) - snapshot_date > Datename.one_week():
-                keep_weeks.append(snapshot_date)
-            if (self.daily_count < 0 or len(keep_days) < self.daily_count) and Datename(keep_days[-1]) - snapshot_date > Datename.one_day():
-                keep_days.append(snapshot_date)
-            if (self.hourly_count < 0 or len(keep_hours) < self.hourly_count) and Datename(keep_hours[-1]) - snapshot_date > Datename.one_hour():
-                keep_hours.append(snapshot_date)
-            if (self.minute_count < 0 or len(keep_minutes) < self.minute_count) and Datename(keep_minutes[-1]) - snapshot_date > Datename.one_minute():
-                keep_minutes.append(snapshot_date)
-        keep = keep_years + keep_months + keep_weeks + keep_days + keep_hours + keep_minutes
-        keep = set(keep)
-        prune = set(old_to_new_snapshots) - keep
-        return list(prune), list(keep)
+        snapshots = self.list_snapshots()
+        with self._phase("plan"):
+            old_to_new_snapshots, plan = get_prune_plan(snapshots, self.yearly_count, self.montly_count, self.weekly_count, self.daily_count, self.hourly_count, self.minute_count)
+        prune = [old_to_new_snapshots[idx] for idx in plan.prune]
+        keep = [old_to_new_snapshots[idx] for idx in plan.keep]
+        if self.metrics is not None:
+            self.metrics.count("snapshots_pruned", len(prune))
+            self.metrics.count("snapshots_kept", len(keep))
+        return prune, keep
 
     def get_update_current_cmdstr(self, src: str) -> None:
         """
@@ -142,4 +146,7 @@ class AstractArchive(ABC):
         Create a snapshot of the archive.
         """
         cmd = self.get_create_snapshot_cmd()
-        os.system(cmd)
\ No newline at end of file
+        with self._phase("link"), span("create_snapshot", "subprocess", cmd=cmd):
+            status = os.system(cmd)
+        if self.metrics is not None:
+            self.metrics.exit_code = os.waitstatus_to_exitcode(status)
\ No newline at end of file
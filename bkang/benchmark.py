@@ -0,0 +1,242 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from .datename import Datename, get_prune_list
+from .retention import plan_retention
+
+
+TIMELINES = ("hourly", "bursts", "gaps")
+# the cron run entry points (as in setup.py), the modules they must not load and
+# their startup budget in ms over a bare interpreter: they measured about 150, 170
+# and 260ms (the retention engine of prune needs numpy), the budgets allow twice that
+CLI_ENTRY_POINTS = {
+    "bkang-sync": ("bkang.datename:sync_current_main", ("crontab", "PySide6", "numpy"), 300.0),
+    "bkang-snapshot": ("bkang.datename:take_snapshot_main", ("crontab", "PySide6", "numpy"), 350.0),
+    "bkang-prune": ("bkang.datename:list_prune_main", ("crontab", "PySide6"), 500.0),
+}
+_TIMELINE_END = "2025-01-01-00-00-00"
+
+
+def synthetic_timeline(kind: str, size: int, seed: int = 0, end: Optional[int] = None) -> np.ndarray:
+    """
+    Generate size strictly increasing snapshot epochs ending at end.
+
+    hourly: a snapshot every hour with a few seconds of cron jitter.
+    bursts: hourly stretches alternating with bursts of snapshots seconds apart.
+    gaps: hourly with occasional outages of one to thirty days.
+    """
+    rng = np.random.default_rng(seed)
+    if end is None:
+        end = Datename(_TIMELINE_END).epoch
+    gaps = 3600 + rng.integers(-30, 31, size=size)
+    if kind == "bursts":
+        in_burst = (np.cumsum(rng.random(size) < 0.01) % 2).astype(bool)
+        gaps[in_burst] = rng.integers(5, 120, size=int(in_burst.sum()))
+    elif kind == "gaps":
+        outage = rng.random(size) < 0.002
+        gaps[outage] += rng.integers(1, 31, size=int(outage.sum())) * 86400
+    elif kind != "hourly":
+        raise ValueError(f"Invalid timeline: {kind}")
+    return end - np.cumsum(gaps[::-1])[::-1] + gaps[-1]
+
+
+def _measure(fn: Callable[[], object], repeat: int) -> Dict[str, float]:
+    """
+    Best wall time over repeat runs and the peak of traced allocations of one more run.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+def _archive_prune_snapshots(names: List[str]) -> Callable[[], object]:
+    from .archive import AstractArchive
+
+    class BenchArchive(AstractArchive):
+        def get_create_snapshot_cmd(self) -> str:
+            return "true"
+
+        def get_delete_snapshot_cmd(self, snapshot_path) -> str:
+            return "true"
+
+    tmp = tempfile.TemporaryDirectory(prefix="bkang-bench-")
+    root = Path(tmp.name)
+    (root / "current").mkdir()
+    (root / "snapshots").mkdir()
+    for name in names:
+        (root / "snapshots" / name).mkdir()
+    archive = BenchArchive(root)
+
+    def run():
+        return archive.get_prune_snapshots()
+    run.tmp = tmp  # keeps the directory alive as long as the closure
+    return run
+
+
+def run_benchmarks(sizes: List[int], timelines: List[str], repeat: int = 3, seed: int = 0, archive_max_size: int = 10000) -> Iterator[Dict[str, object]]:
+    """
+    Yield one record per benchmark, timeline and size.
+    """
+    for kind in timelines:
+        for size in sizes:
+            epochs = synthetic_timeline(kind, size, seed=seed)
+            names = [Datename.from_epoch(e).date_str for e in epochs.tolist()]
+            shuffled = names.copy()
+            random.Random(seed).shuffle(shuffled)
+            paths = [Path("/archive/snapshots") / name for name in shuffled]
+            datenames = [Datename(name) for name in shuffled]
+            benchmarks = {
+                "datename_construct": lambda: [Datename(name) for name in names],
+                "datename_compare": lambda: sorted(datenames),
+                "parse_many": lambda: Datename.parse_many(names),
+                "plan_retention": lambda: plan_retention(epochs),
+                "get_prune_list": lambda: get_prune_list(paths),
+            }
+            if size <= archive_max_size:
+                try:
+                    benchmarks["archive_get_prune_snapshots"] = _archive_prune_snapshots(names)
+                except AssertionError as e:
+                    yield {"benchmark": "archive_get_prune_snapshots", "timeline": kind, "size": size, "skipped": str(e)}
+            for name, fn in benchmarks.items():
+                record = {"benchmark": name, "timeline": kind, "size": size, "repeat": repeat}
+                record.update(_measure(fn, repeat))
+                record["items_per_second"] = size / record["seconds"] if record["seconds"] > 0 else float("inf")
+                yield record
+
+
+def _python_seconds(code: str, repeat: int) -> Tuple[float, List[str]]:
+    """
+    Best wall time of a fresh interpreter running code, and the modules it ended up with.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([str(Path(__file__).parent.parent)] + [p for p in env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    script = f"{code}\nimport sys\nprint(' '.join(sys.modules))"
+    best, modules = float("inf"), []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", script], env=env, check=True, capture_output=True, text=True).stdout
+        best = min(best, time.perf_counter() - start)
+        modules = output.splitlines()[-1].split() if output else []
+    return best, modules
+
+
+_ENTRY_POINT_SCRIPT = """
+import os, sys
+from pathlib import Path
+import bkang.config
+bkang.config.get_config_path = lambda: Path({config!r})
+sys.argv = [{command!r}, "-archive_root={archive_root}", "-verbose=0"]
+from {module} import {function}
+stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+try:
+    {function}()
+except SystemExit:
+    pass
+sys.stdout = stdout
+"""
+
+
+def run_import_benchmarks(repeat: int = 5) -> Iterator[Dict[str, object]]:
+    """
+    Yield the startup cost of every cron run entry point over a bare interpreter.
+
+    Each entry point runs for real, as a dry run on an empty archive with the
+    default configuration, so whatever it imports on the way is measured.
+    """
+    baseline, _ = _python_seconds("pass", repeat)
+    with tempfile.TemporaryDirectory(prefix="bkang-bench-") as tmp:
+        config_path = Path(tmp) / "config.toml"
+        config_path.write_text((Path(__file__).parent / "resources" / "default_config.toml").read_text())
+        archive_root = Path(tmp) / "archive"
+        (archive_root / "current").mkdir(parents=True)
+        (archive_root / "snapshots").mkdir()
+        for command, (entry_point, forbidden, budget_ms) in CLI_ENTRY_POINTS.items():
+            module, function = entry_point.split(":")
+            code = _ENTRY_POINT_SCRIPT.format(config=str(config_path), command=command, archive_root=archive_root, module=module, function=function)
+            seconds, modules = _python_seconds(code, repeat)
+            loaded = sorted({m.split(".")[0] for m in modules} & set(forbidden))
+            yield {"benchmark": "import", "command": command, "repeat": repeat, "seconds": seconds - baseline, "budget_seconds": budget_ms / 1000, "forbidden_modules": loaded}
+
+
+def run_config_benchmark(repeat: int = 100) -> Dict[str, object]:
+    """
+    Time loading the default configuration parsed from toml and from the cache.
+    """
+    from .config import _loaded_configs, get_config_cache_path, load_config
+    with tempfile.TemporaryDirectory(prefix="bkang-bench-") as tmp:
+        config_path = Path(tmp) / "config.toml"
+        config_path.write_text((Path(__file__).parent / "resources" / "default_config.toml").read_text())
+
+        def parse():
+            get_config_cache_path(config_path).unlink(missing_ok=True)
+            _loaded_configs.clear()
+            return load_config(config_path)
+
+        def cached():
+            _loaded_configs.clear()
+            return load_config(config_path)
+        record = {"benchmark": "load_config", "repeat": repeat}
+        record["parse_seconds"] = _measure(parse, repeat)["seconds"]
+        record["cached_seconds"] = _measure(cached, repeat)["seconds"]
+    return record
+
+
+def benchmark_main():
+    import resource
+    import fargv
+    p = {
+        "sizes": "1000,10000,100000,1000000",
+        "timelines": ",".join(TIMELINES),
+        "repeat": 3,
+        "seed": 0,
+        "archive_max_size": 10000,
+        "output": "",
+        "import_repeat": 5,
+        "import_budget_scale": (1.0, "Multiply the startup budget of every command, eg. on a slow machine, 0 disables the check"),
+    }
+    args, _ = fargv.fargv(p)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    timelines = [t.strip() for t in args.timelines.split(",") if t.strip()]
+    out = open(args.output, "w") if args.output else sys.stdout
+    regressions = []
+    try:
+        if args.import_repeat > 0:
+            for record in run_import_benchmarks(args.import_repeat):
+                print(json.dumps(record), file=out, flush=True)
+                if record["forbidden_modules"]:
+                    regressions.append(f"{record['command']} loads {', '.join(record['forbidden_modules'])}")
+                budget = record["budget_seconds"] * args.import_budget_scale
+                if budget > 0 and record["seconds"] > budget:
+                    regressions.append(f"{record['command']} takes {record['seconds'] * 1000:.0f}ms to start, the budget is {budget * 1000:.0f}ms")
+            print(json.dumps(run_config_benchmark()), file=out, flush=True)
+        for record in run_benchmarks(sizes, timelines, args.repeat, args.seed, args.archive_max_size):
+            print(json.dumps(record), file=out, flush=True)
+        # ru_maxrss is in kilobytes on linux
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        print(json.dumps({"benchmark": "process", "max_rss_bytes": max_rss}), file=out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    for regression in regressions:
+        print(f"Startup regression: {regression}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
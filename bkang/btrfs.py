@@ -0,0 +1,97 @@
+import os
+import re
+import shlex
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import IO, List, Optional, Tuple, Union
+
+from .util import run_cmd
+
+
+_ERROR_PATH_RE = re.compile(r"'([^']+)'")
+
+
+class SubvolumeDeletion:
+    """
+    What a batched deletion of btrfs subvolumes did.
+    """
+    def __init__(self, subvolume_count: int) -> None:
+        self.start_time: float = time.monotonic()
+        self.subvolume_count: int = subvolume_count
+        self.deleted: List[str] = []
+        self.commands: int = 0
+        self.errors: List[Tuple[str, str]] = []
+        self.cleaner_seconds: Optional[float] = None
+        self.reclaimed_bytes: Optional[int] = None  # only known once the cleaner is done
+
+    def __str__(self) -> str:
+        result = f"[deleted {len(self.deleted)}/{self.subvolume_count} subvolumes in {self.commands} commands, {len(self.errors)} errors"
+        if self.cleaner_seconds is not None:
+            result += f", cleaner done after {self.cleaner_seconds:.1f}s"
+        if self.reclaimed_bytes is not None:
+            from .space import format_bytes
+            result += f", reclaimed {format_bytes(self.reclaimed_bytes)}"
+        return result + f", {time.monotonic() - self.start_time:.1f}s]"
+
+
+def delete_commands(subvolumes: List[str], batch_size: int = 100, commit: bool = True) -> List[str]:
+    """
+    The btrfs subvolume delete commands removing subvolumes, batch_size per command.
+
+    Only the last command waits for a transaction commit (-c), which makes
+    the deletions of all the batches before it durable as well.
+    """
+    batch_size = max(1, batch_size)
+    batches = [subvolumes[n:n + batch_size] for n in range(0, len(subvolumes), batch_size)]
+    return [f"btrfs subvolume delete {'-c ' if commit and n == len(batches) - 1 else ''}{' '.join(shlex.quote(s) for s in batch)}" for n, batch in enumerate(batches)]
+
+
+def delete_subvolumes(subvolumes: List[Union[str, Path]], batch_size: int = 100, commit: bool = True, wait_cleaner: bool = False, progress_file: Optional[IO] = sys.stderr) -> SubvolumeDeletion:
+    """
+    Delete btrfs subvolumes with a few btrfs invocations and a single commit.
+
+    A subvolume counts as deleted once its path is gone, errors are taken
+    from the ERROR lines the btrfs tool writes. With wait_cleaner the call
+    returns once the cleaner has freed the space of the deleted subvolumes,
+    which is then reported. The btrfs executable is the first one on PATH.
+    """
+    subvolumes = [str(s) for s in subvolumes]
+    deletion = SubvolumeDeletion(len(subvolumes))
+    if not subvolumes:
+        return deletion
+    filesystem = os.path.dirname(subvolumes[0].rstrip("/")) or "."
+    free_before = shutil.disk_usage(filesystem).free if wait_cleaner else None
+    batch_size = max(1, batch_size)
+    for n, cmd in enumerate(delete_commands(subvolumes, batch_size, commit)):
+        batch = subvolumes[n * batch_size:(n + 1) * batch_size]
+        messages: List[str] = []
+
+        def collect(stream: str, line: str) -> None:
+            if line.startswith("ERROR:"):
+                messages.append(line)
+        result = run_cmd(cmd, show_cmd=progress_file is not None, show_output=False, output_file=progress_file or sys.stderr, tail_lines=20, on_line=collect)
+        deletion.commands += 1
+        for subvolume in batch:
+            if not os.path.lexists(subvolume):
+                deletion.deleted.append(subvolume)
+                continue
+            # the tool names the subvolume it failed on, the rest of the batch may have gone through
+            error = next((m for m in messages if subvolume in _ERROR_PATH_RE.findall(m)), None)
+            if error is None:
+                error = messages[-1] if messages else f"btrfs exited with {result.returncode}, {result.stderr or 'no output'}"
+            deletion.errors.append((subvolume, error))
+        if progress_file is not None:
+            print(deletion, file=progress_file, flush=True)
+    if wait_cleaner and deletion.deleted:
+        start = time.monotonic()
+        result = run_cmd(f"btrfs subvolume sync {shlex.quote(filesystem)}", show_cmd=progress_file is not None, show_output=False, output_file=progress_file or sys.stderr, tail_lines=20)
+        if result.ok:
+            deletion.cleaner_seconds = time.monotonic() - start
+            deletion.reclaimed_bytes = max(0, shutil.disk_usage(filesystem).free - free_before)
+        else:
+            deletion.errors.append((filesystem, f"waiting for the cleaner failed ({result.returncode}): {result.stderr}"))
+        if progress_file is not None:
+            print(deletion, file=progress_file, flush=True)
+    return deletion
@@ -0,0 +1,160 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .datename import Datename
+
+
+class SnapshotCatalog:
+    """
+    The snapshot directories of an archive, oldest first.
+
+    The snapshots directory is listed with a single shallow os.scandir pass,
+    directories are recognised from d_type so snapshot contents are never
+    touched. The result (names, epochs, creation times) is kept in a small
+    index file which stays valid as long as the mtime of the snapshots
+    directory does not change, ie. no snapshot was added, removed or renamed.
+    """
+    version = 1
+    index_name = ".bkang_catalog.json"
+
+    def __init__(self, snapshots_path: Union[str, Path], index_path: Union[str, Path, None] = None) -> None:
+        self.snapshots_path: Path = Path(snapshots_path)
+        if index_path is None:
+            index_path = self.snapshots_path.parent / self.index_name
+        self.index_path: Path = Path(index_path)
+        self.names: List[str] = []
+        self.epochs: np.ndarray = np.zeros(0, dtype=np.int64)
+        self.ctimes: np.ndarray = np.zeros(0, dtype=np.float64)
+        self.mtime_ns: Optional[int] = None
+        self.refresh()
+
+    def _directory_mtime_ns(self) -> Optional[int]:
+        try:
+            return os.stat(self.snapshots_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load_index(self) -> Optional[Dict]:
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            if index.get("version") != self.version or index.get("snapshots_path") != str(self.snapshots_path):
+                return None
+            return index
+        except (OSError, ValueError):
+            return None
+
+    def _save_index(self) -> None:
+        # A directory modified within the last second could be modified again
+        # without its mtime changing, such an index would never be invalidated.
+        if self.mtime_ns is None or time.time_ns() - self.mtime_ns < 1_000_000_000:
+            return
+        index = {
+            "version": self.version,
+            "snapshots_path": str(self.snapshots_path),
+            "mtime_ns": self.mtime_ns,
+            "names": self.names,
+            "epochs": self.epochs.tolist(),
+            "ctimes": self.ctimes.tolist(),
+        }
+        tmp_path = self.index_path.with_name(f".{self.index_path.name}.tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            pass  # a read only archive simply gets scanned every time
+
+    def _scan(self, known: Dict[str, Tuple[int, float]]) -> List[Tuple[str, int, float]]:
+        """
+        List snapshot directories, only entries not in known are stat'ed.
+        """
+        entries = []
+        with os.scandir(self.snapshots_path) as it:
+            for entry in it:
+                if entry.name in known:
+                    epoch, ctime = known[entry.name]
+                    if entry.is_dir(follow_symlinks=False):
+                        entries.append((entry.name, epoch, ctime))
+                    continue
+                if not Datename.is_valid_date_str(entry.name) or not entry.is_dir(follow_symlinks=False):
+                    continue
+                ctime = entry.stat(follow_symlinks=False).st_ctime
+                entries.append((entry.name, Datename(entry.name).epoch, ctime))
+        entries.sort(key=lambda e: (e[1], e[0]))
+        return entries
+
+    def refresh(self) -> bool:
+        """
+        Bring the catalog up to date, returns True if anything was re-read.
+        """
+        mtime_ns = self._directory_mtime_ns()
+        if mtime_ns is None:
+            changed = len(self.names) > 0
+            self.names, self.mtime_ns = [], None
+            self.epochs = np.zeros(0, dtype=np.int64)
+            self.ctimes = np.zeros(0, dtype=np.float64)
+            return changed
+        if mtime_ns == self.mtime_ns:
+            return False
+        index = self._load_index()
+        if index is not None and index["mtime_ns"] == mtime_ns:
+            self.names = index["names"]
+            self.epochs = np.array(index["epochs"], dtype=np.int64)
+            self.ctimes = np.array(index["ctimes"], dtype=np.float64)
+            self.mtime_ns = mtime_ns
+            return True
+        if index is not None and len(self.names) == 0:
+            known = {n: (e, c) for n, e, c in zip(index["names"], index["epochs"], index["ctimes"])}
+        else:
+            known = {n: (e, c) for n, e, c in zip(self.names, self.epochs.tolist(), self.ctimes.tolist())}
+        entries = self._scan(known)
+        self.names = [e[0] for e in entries]
+        self.epochs = np.array([e[1] for e in entries], dtype=np.int64)
+        self.ctimes = np.array([e[2] for e in entries], dtype=np.float64)
+        self.mtime_ns = mtime_ns
+        self._save_index()
+        return True
+
+    def paths(self) -> List[Path]:
+        """
+        Snapshot paths, oldest first.
+        """
+        return [self.snapshots_path / name for name in self.names]
+
+    def newest(self) -> Optional[Path]:
+        if len(self.names) == 0:
+            return None
+        return self.snapshots_path / self.names[-1]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __repr__(self) -> str:
+        return f"SnapshotCatalog({str(self.snapshots_path)}, {len(self.names)} snapshots)"
+
+
+def newest_snapshot(snapshots_path: Union[str, Path]) -> Optional[Path]:
+    """
+    The newest snapshot from a single listing of names, without the index.
+
+    Nothing is stat'ed, so this stays cheap while a full SnapshotCatalog is
+    still being loaded (eg. by the browser at startup).
+    """
+    newest, newest_epoch = None, None
+    try:
+        with os.scandir(snapshots_path) as it:
+            for entry in it:
+                if not Datename.is_valid_date_str(entry.name) or not entry.is_dir(follow_symlinks=False):
+                    continue
+                epoch = Datename(entry.name).epoch
+                if newest_epoch is None or epoch > newest_epoch:
+                    newest, newest_epoch = entry.name, epoch
+    except FileNotFoundError:
+        return None
+    return Path(snapshots_path) / newest if newest is not None else None
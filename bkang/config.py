@@ -1,13 +1,8 @@
 from pathlib import Path
-import toml
-import importlib.resources as pkg_resources
+import json
 import os
-import tempfile
-import subprocess
-from crontab import CronTab
 
-from . import resources
-from typing import Any
+from typing import Any, Dict, Optional, Tuple
 
 
 def get_config_path() -> Path:
@@ -16,42 +11,107 @@ def get_config_path() -> Path:
 
 
 def test_ssh_noauth(host, port=22, username=None, timeout=2):
-    ssh_command = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=" + str(timeout)]
-    if port != 22:
-        ssh_command += ["-p", str(port)]
-    if username:
-        ssh_command.append(f"{username}@{host}")
-    else:
-        ssh_command.append(host)
-
+    from .ssh import SSHConnection
+    address = f"{username}@{host}" if username else host
+    connection = SSHConnection(address, port, connect_timeout=timeout)
     try:
-        result = subprocess.run(ssh_command + ["exit"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return result.returncode == 0
+        return connection.health_check()
     except Exception as e:
         print(f"SSH attempt failed: {e}")
         return False
+    finally:
+        connection.stop()
+
+
+# parsed configurations by path, with the (mtime_ns, size) they were read at
+_loaded_configs: Dict[str, Tuple[Tuple[int, int], dict]] = {}
+
+
+def get_config_cache_path(config_path: Path) -> Path:
+    return config_path.with_name(f".{config_path.name}.cache.json")
+
+
+def validate_config(config: dict) -> None:
+    """
+    Raise ValueError if a key of config has another type than in the default configuration.
+    """
+    import toml
+    default_config_path = Path(__file__).parent / "resources" / "default_config.toml"
+    with open(default_config_path, "r") as f:
+        default_config = toml.load(f)
+    for key, value in config.items():
+        if key not in default_config:
+            continue
+        expected = type(default_config[key])
+        if expected is float and type(value) is int:
+            continue
+        if type(value) is not expected:
+            raise ValueError(f"Invalid value for {key} in the configuration: {value!r}. Expected a {expected.__name__}")
+
+
+def _read_config_cache(cache_path: Path, key: Tuple[int, int]) -> Optional[dict]:
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or tuple(cache.get("key", ())) != key:
+        return None
+    return cache.get("config")
+
+
+def _write_config_cache(cache_path: Path, key: Tuple[int, int], config: dict) -> None:
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, "w") as f:
+            json.dump({"key": list(key), "config": config}, f)
+        os.replace(tmp_path, cache_path)
+    except (OSError, TypeError, ValueError):
+        # a read only install or values json can not hold, the next run parses the toml again
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
 
 
-def load_config() -> dict:
+def load_config(config_path: Optional[Path] = None) -> dict:
     """
     Load the configuration file.
+
+    The parsed and validated configuration is cached next to the file as
+    json, keyed on its mtime and size, so most runs never parse the toml.
     """
-    config_path = get_config_path()
+    if config_path is None:
+        config_path = get_config_path()
+    config_path = Path(config_path)
     if not config_path.is_file():
         default_config_path = Path(__file__).parent / "resources" / "default_config.toml"
         open(config_path, "w").write(open(default_config_path, "r").read())
     if not config_path.is_file():
-        raise FileNotFoundError(f"Configuration file (and default) not found: {config_path}")    
-    with open(config_path, "r") as f:
-        config = toml.load(f)
-    return config
+        raise FileNotFoundError(f"Configuration file (and default) not found: {config_path}")
+    st = os.stat(config_path)
+    key = (st.st_mtime_ns, st.st_size)
+    loaded = _loaded_configs.get(str(config_path))
+    if loaded is not None and loaded[0] == key:
+        return dict(loaded[1])
+    cache_path = get_config_cache_path(config_path)
+    config = _read_config_cache(cache_path, key)
+    if config is None:
+        import toml
+        with open(config_path, "r") as f:
+            config = toml.load(f)
+        validate_config(config)
+        _write_config_cache(cache_path, key, config)
+    _loaded_configs[str(config_path)] = (key, config)
+    return dict(config)
 
 
 def save_config(config: dict) -> None:
     """
     Save the configuration file.
     """
-    config_path = Path(__file__).parent / "resources" / "config.toml"
+    import toml
+    config_path = get_config_path()
     with open(config_path, "w") as f:
         toml.dump(config, f)
 
@@ -87,16 +147,21 @@ def update_config_from_fargv(args: Any) -> dict:
 
 
 def validate_config_str(config_file_contents: str) -> bool:
-    default_config_path = Path(__file__).parent / "resources" / "default_config.toml"
-    with open(default_config_path, "r") as f:
-        default_config = toml.load(f)
-    config = toml.loads(config_file_contents)
-    if set(config.keys()) != set(default_config.keys()):
+    """
+    Whether config_file_contents is a usable configuration.
+
+    Only the keys present are checked, the missing ones take their default
+    value, so configurations written by older versions stay valid.
+    """
+    import toml
+    try:
+        config = toml.loads(config_file_contents)
+        validate_config(config)
+    except (toml.TomlDecodeError, ValueError):
         return False
-    for key, value in default_config.items():
-        if type(value) != type(config[key]):
-            return False
-    if config["mode"] not in ["client", "server"," local"]:
+    with open(Path(__file__).parent / "resources" / "default_config.toml", "r") as f:
+        config = {**toml.load(f), **config}
+    if config["mode"] not in ["client", "server", "local"]:
         return False
     if config["mode"] == "local" and config["archive_address"] not in ["localhost", "127.0.0.1"]:
         return False
@@ -104,6 +169,8 @@ def validate_config_str(config_file_contents: str) -> bool:
 
 
 def edit_file_like_visudo(original_path):
+    import subprocess
+    import tempfile
     editor = os.environ.get('EDITOR', 'vi')
     with tempfile.NamedTemporaryFile(mode='w+', delete=False) as tmp_file:
         temp_path = tmp_file.name
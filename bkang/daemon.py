@@ -0,0 +1,372 @@
+import asyncio
+import datetime
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Callable, Dict, List, Optional, Set
+
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "bkang-daemon.sock")
+
+_CRON_MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+_CRON_NAMES = (
+    {},
+    {},
+    {},
+    {name: n + 1 for n, name in enumerate(("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"))},
+    {name: n for n, name in enumerate(("sun", "mon", "tue", "wed", "thu", "fri", "sat"))},
+)
+# minute, hour, day of month, month, day of week
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+class CronSchedule:
+    """
+    A five field crontab expression with the semantics of cron.
+
+    As in cron, when both the day of month and the day of week are
+    restricted a day matching either of them matches.
+    """
+    def __init__(self, expression: str) -> None:
+        self.expression: str = expression.strip()
+        fields = _CRON_MACROS.get(self.expression, self.expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid crontab expression: {expression!r}")
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [self._parse_field(f, n) for n, f in enumerate(fields)]
+        self.weekdays = {d % 7 for d in self.weekdays}
+        self.any_day: bool = fields[2] == "*"
+        self.any_weekday: bool = fields[4] == "*"
+
+    @staticmethod
+    def _parse_field(field: str, n: int) -> Set[int]:
+        low, high = _CRON_RANGES[n]
+
+        def value(token: str) -> int:
+            result = _CRON_NAMES[n].get(token.lower())
+            result = int(token) if result is None else result
+            if not low <= result <= high:
+                raise ValueError(f"Invalid crontab value: {token!r}")
+            return result
+        values = set()
+        for part in field.split(","):
+            part, _, step = part.partition("/")
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (value(t) for t in part.split("-", 1))
+            else:
+                start = value(part)
+                end = high if step else start
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, day: datetime.datetime) -> bool:
+        in_days, in_weekdays = day.day in self.days, (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after: datetime.datetime) -> datetime.datetime:
+        """
+        The first minute strictly after after that the expression matches.
+        """
+        current = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = current + datetime.timedelta(days=366 * 5)
+        while current < limit:
+            if current.month not in self.months:
+                current = (current.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(current):
+                current = current.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif current.hour not in self.hours:
+                current = current.replace(minute=0) + datetime.timedelta(hours=1)
+            elif current.minute not in self.minutes:
+                current += datetime.timedelta(minutes=1)
+            else:
+                return current
+        raise ValueError(f"The crontab expression {self.expression!r} never matches")
+
+    def __repr__(self) -> str:
+        return f"CronSchedule({self.expression!r})"
+
+
+class DaemonJob:
+    """
+    A job of the daemon and the outcome of its last run.
+    """
+    def __init__(self, name: str, freq_key: str, run: Callable[[], Optional[int]]) -> None:
+        self.name: str = name
+        self.freq_key: str = freq_key
+        self.run: Callable[[], Optional[int]] = run
+        self.next_time: Optional[datetime.datetime] = None
+        self.queued: bool = False
+        self.running: bool = False
+        self.runs: int = 0
+        self.last_start: Optional[float] = None
+        self.last_seconds: Optional[float] = None
+        self.last_returncode: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    def status(self) -> Dict:
+        return {
+            "next": self.next_time.isoformat() if self.next_time is not None else None,
+            "queued": self.queued,
+            "running": self.running,
+            "runs": self.runs,
+            "last_start": datetime.datetime.fromtimestamp(self.last_start).isoformat() if self.last_start is not None else None,
+            "last_seconds": self.last_seconds,
+            "last_returncode": self.last_returncode,
+            "last_error": self.last_error,
+        }
+
+
+def job_args(params: Dict) -> SimpleNamespace:
+    """
+    The arguments a main would parse from params and the configuration, without a command line.
+    """
+    from .config import update_fargv_dict
+    params = update_fargv_dict(dict(params))
+    # tuples are choices, the configured one comes first
+    args = {key: value[0] if isinstance(value, tuple) else value for key, value in params.items()}
+    args["no_dry_run"] = True
+    return SimpleNamespace(**args)
+
+
+class BkangDaemon:
+    """
+    Runs the sync, snapshot and prune jobs of the configured mode on their crontab frequencies.
+
+    Every job goes through a single queue, so jobs touching the archive disk
+    never overlap, and a job already waiting is not queued twice. The
+    snapshot catalog and the retention state of the last prune stay in
+    memory between runs. The configuration is read again on every tick,
+    which costs a stat while the file is unchanged.
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, verbose: int = 1) -> None:
+        from .config import load_config
+        self.socket_path: str = socket_path
+        self.verbose: int = verbose
+        self.mode: str = load_config()["mode"]
+        self.jobs: Dict[str, DaemonJob] = {}
+        if self.mode in ("client", "local"):
+            self.jobs["sync"] = DaemonJob("sync", "sync_crontab_freq", self._sync)
+        if self.mode in ("server", "local"):
+            self.jobs["snapshot"] = DaemonJob("snapshot", "snapshot_crontab_freq", self._snapshot)
+            self.jobs["prune"] = DaemonJob("prune", "prune_crontab_freq", self._prune)
+        self.catalog = None
+        self.retention_state = None
+        self.start_time: float = time.time()
+        self._queue: Optional[asyncio.Queue] = None
+        self._stop: Optional[asyncio.Event] = None
+
+    def _log(self, message: str) -> None:
+        if self.verbose > 0:
+            print(f"[bkang-daemon {datetime.datetime.now().isoformat(timespec='seconds')}] {message}", file=sys.stderr, flush=True)
+
+    def _args(self, params: Dict) -> SimpleNamespace:
+        args = job_args(params)
+        if "verbose" in params:
+            args.verbose = self.verbose
+        return args
+
+    def _catalog(self, args: SimpleNamespace):
+        from pathlib import Path
+        from .catalog import SnapshotCatalog
+        snapshots_path = Path(args.archive_root) / args.snapshots_name
+        if self.catalog is None or self.catalog.snapshots_path != snapshots_path:
+            self.catalog = SnapshotCatalog(snapshots_path)
+            self.retention_state = None
+        return self.catalog
+
+    def _sync(self) -> Optional[int]:
+        from .datename import SYNC_PARAMS, sync_current
+        return sync_current(self._args(SYNC_PARAMS))
+
+    def _snapshot(self) -> Optional[int]:
+        from .datename import SNAPSHOT_PARAMS, take_snapshot
+        args = self._args(SNAPSHOT_PARAMS)
+        returncode = take_snapshot(args)
+        self._catalog(args).refresh()
+        return returncode
+
+    def _prune(self) -> Optional[int]:
+        from .datename import PRUNE_PARAMS, prune_archive
+        args = self._args(PRUNE_PARAMS)
+        returncode, state = prune_archive(args, self._catalog(args), self.retention_state)
+        self.retention_state = state
+        return returncode
+
+    def enqueue(self, name: str) -> bool:
+        """
+        Queue the job name unless it is already waiting.
+        """
+        job = self.jobs[name]
+        if job.queued:
+            return False
+        job.queued = True
+        self._queue.put_nowait(job)
+        return True
+
+    async def _schedule(self, job: DaemonJob) -> None:
+        from .config import load_config
+        while True:
+            freq = str(load_config().get(job.freq_key, "")).strip()
+            if freq == "":
+                # only triggered from the control socket, look again for a new frequency later
+                job.next_time = None
+                await asyncio.sleep(60)
+                continue
+            try:
+                schedule = CronSchedule(freq)
+            except ValueError as e:
+                job.next_time = None
+                job.last_error = str(e)
+                await asyncio.sleep(60)
+                continue
+            job.next_time = schedule.next_after(datetime.datetime.now())
+            # sleeping in short steps follows clock changes and edited frequencies
+            while datetime.datetime.now() < job.next_time:
+                await asyncio.sleep(min(60.0, max(0.0, (job.next_time - datetime.datetime.now()).total_seconds())))
+                if str(load_config().get(job.freq_key, "")).strip() != freq:
+                    break
+            else:
+                if not self.enqueue(job.name):
+                    self._log(f"{job.name} is still waiting from its previous tick")
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            job.queued, job.running = False, True
+            job.last_start = time.time()
+            self._log(f"{job.name} started")
+            try:
+                # job priorities cannot be raised back, so each job gets a thread of its own
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bkang-{job.name}")
+                try:
+                    job.last_returncode = await loop.run_in_executor(executor, job.run)
+                finally:
+                    executor.shutdown(wait=False)
+                job.last_error = None
+            except Exception as e:
+                job.last_returncode, job.last_error = -1, f"{type(e).__name__}: {e}"
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                job.running = False
+                job.runs += 1
+                job.last_seconds = time.time() - job.last_start
+            self._log(f"{job.name} ended with {job.last_returncode} after {job.last_seconds:.1f}s")
+
+    def status(self) -> Dict:
+        status = {"pid": os.getpid(), "mode": self.mode, "uptime": time.time() - self.start_time, "jobs": {name: job.status() for name, job in self.jobs.items()}}
+        if self.catalog is not None:
+            status["snapshots"] = len(self.catalog)
+            status["newest"] = self.catalog.names[-1] if len(self.catalog) else None
+        return status
+
+    def control(self, command: List[str]) -> Dict:
+        """
+        Answer a control command: status, run <job> or stop.
+        """
+        if command == ["status"]:
+            return self.status()
+        if len(command) == 2 and command[0] == "run":
+            if command[1] not in self.jobs:
+                return {"error": f"No job {command[1]} in {self.mode} mode, one of {', '.join(self.jobs)}"}
+            return {"queued": self.enqueue(command[1])}
+        if command == ["stop"]:
+            self._stop.set()
+            return {"stopping": True}
+        return {"error": f"Unknown command: {' '.join(command)}"}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            line = await reader.readline()
+            response = self.control(line.decode("utf-8", "replace").split())
+            writer.write(json.dumps(response).encode() + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        self._queue = asyncio.Queue()
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._stop.set)
+        if os.path.exists(self.socket_path):
+            # a socket nobody listens to is a leftover of a killed daemon
+            if send_command(["status"], self.socket_path) is not None:
+                raise RuntimeError(f"A daemon is already listening on {self.socket_path}")
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        tasks = [asyncio.create_task(self._schedule(job)) for job in self.jobs.values()]
+        tasks.append(asyncio.create_task(self._work()))
+        self._log(f"{self.mode} mode, jobs {', '.join(self.jobs)}, listening on {self.socket_path}")
+        try:
+            await self._stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            # a job still running on its thread is waited for at interpreter exit
+            self._log("stopped")
+
+
+def send_command(command: List[str], socket_path: str = DEFAULT_SOCKET_PATH, timeout: float = 10.0) -> Optional[Dict]:
+    """
+    Send a control command to a running daemon, None if none is listening.
+    """
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        sock.sendall(" ".join(command).encode() + b"\n")
+        response = b""
+        while not response.endswith(b"\n"):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            response += chunk
+    return json.loads(response) if response else None
+
+
+def daemon_main():
+    import fargv
+    p = {
+        "control": "",
+        "socket_path": DEFAULT_SOCKET_PATH,
+        "verbose": 1,
+    }
+    args, _ = fargv.fargv(p)
+    if args.control:
+        response = send_command(args.control.split(), args.socket_path)
+        if response is None:
+            print(f"No bkang daemon is listening on {args.socket_path}", file=sys.stderr)
+            sys.exit(1)
+        print(json.dumps(response, indent=2))
+        if "error" in response:
+            sys.exit(1)
+        return
+    asyncio.run(BkangDaemon(args.socket_path, args.verbose).serve())
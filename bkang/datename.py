@@ -1,12 +1,104 @@
 import datetime
-from typing import Dict, List, Optional, Self, Tuple, Union
+import numbers
+from typing import Iterable, List, Optional, Self, Tuple, Union
 from pathlib import Path
 
+from .tracing import traced
+
+
+_SECONDS_PER_DAY = 86400
+_DATE_STR_LEN = 19  # len("YYYY-mm-dd-HH-MM-SS")
+_DATE_STR_SEPARATORS = (4, 7, 10, 13, 16)
+_DATE_STR_FIELDS = ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19))
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _days_from_civil(year, month, day):
+    """
+    Days since 1970-01-01 of a proleptic gregorian date.
+
+    Works both on python ints and on numpy integer arrays.
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def _civil_from_days(days):
+    """
+    Inverse of _days_from_civil, returns (year, month, day).
+
+    Works both on python ints and on numpy integer arrays.
+    """
+    days = days + 719468
+    era = days // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096) // 365
+    day_of_year = day_of_era - (365 * year_of_era + year_of_era // 4 - year_of_era // 100)
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = (shifted_month + 2) % 12 + 1
+    year = year_of_era + era * 400 + (month <= 2)
+    return year, month, day
+
+
+def _days_in_month(year: int, month: int) -> int:
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _DAYS_IN_MONTH[month - 1]
+
+
+def _fields_to_epoch(year: int, month: int, day: int, hour: int, minute: int, second: int) -> int:
+    return _days_from_civil(year, month, day) * _SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+
+
+def _epoch_to_date_str(epoch: int) -> str:
+    days, seconds = divmod(epoch, _SECONDS_PER_DAY)
+    year, month, day = _civil_from_days(days)
+    hour, seconds = divmod(seconds, 3600)
+    minute, second = divmod(seconds, 60)
+    return f"{year:04d}-{month:02d}-{day:02d}-{hour:02d}-{minute:02d}-{second:02d}"
+
+
+def _fast_parse_date_str(date_str: str) -> Optional[int]:
+    """
+    Parse a canonical "%Y-%m-%d-%H-%M-%S" string by fixed offsets.
+
+    Returns None if the string is not in canonical (zero padded) form.
+    """
+    if len(date_str) != _DATE_STR_LEN:
+        return None
+    for pos in _DATE_STR_SEPARATORS:
+        if date_str[pos] != "-":
+            return None
+    fields = []
+    for start, end in _DATE_STR_FIELDS:
+        field = date_str[start:end]
+        if not (field.isascii() and field.isdigit()):
+            return None
+        fields.append(int(field))
+    year, month, day, hour, minute, second = fields
+    if not (1 <= month <= 12 and 1 <= day <= _days_in_month(year, month) and hour < 24 and minute < 60 and second < 60):
+        return None
+    return _fields_to_epoch(year, month, day, hour, minute, second)
+
 
 class Datename:
+    """
+    A snapshot name such as "2023-01-31-23-59-00".
+
+    The name is parsed once into an integer epoch, the seconds since
+    1970-01-01-00-00-00 in the wall-clock time of the name. Ordering, hashing
+    and arithmetic work on that integer and are free of timezone and DST
+    shifts, date_str holds the canonical name.
+    """
+    __slots__ = ("epoch", "date_str")
     __date_str_format = "%Y-%m-%d-%H-%M-%S"
 
-    def _get_date_str(self, date: Optional[Self] = None) -> str:
+    def _get_date_str(self, date: Optional[datetime.datetime] = None) -> str:
         """
         Get a string representation of the date.
         """
@@ -14,23 +106,20 @@ class Datename:
             date = datetime.datetime.now()
         return date.strftime(self.__date_str_format)
 
-
-    def _parse_date_str(self, date_str: str) -> Dict[str, int]:
+    @staticmethod
+    def _parse_date_str(date_str: str) -> int:
         """
-        Parse a date string into a dictionary.
+        Parse a date string into an epoch.
         """
+        epoch = _fast_parse_date_str(date_str)
+        if epoch is not None:
+            return epoch
         try:
-            date = datetime.datetime.strptime(date_str, self.__date_str_format)
-            return {
-                "year": date.year,
-                "month": date.month,
-                "day": date.day,
-                "hour": date.hour,
-                "minute": date.minute,
-                "second": date.second
-            }
+            # Non canonical forms (eg. not zero padded) that strptime accepts.
+            date = datetime.datetime.strptime(date_str, Datename.__date_str_format)
         except ValueError:
             raise ValueError(f"Invalid date string: {date_str}")
+        return _fields_to_epoch(date.year, date.month, date.day, date.hour, date.minute, date.second)
 
     @staticmethod
     def path_to_datename(s: Union[Path, str]) -> Self:
@@ -41,281 +130,651 @@ class Datename:
             s = Path(s)
         date_str = s.stem
         return Datename(date_str)
-    
+
     @staticmethod
     def is_valid_date_str(date_str: str) -> bool:
         """
         Check if a date string is valid.
         """
+        if _fast_parse_date_str(date_str) is not None:
+            return True
         try:
-            date = datetime.datetime.strptime(date_str, Datename.__date_str_format)
+            datetime.datetime.strptime(date_str, Datename.__date_str_format)
             return True
         except ValueError:
             return False
-    
-    def __init__(self, date: Union[Path, str, Self, int, None] = None) -> None:
+
+    @classmethod
+    def from_epoch(cls, epoch: int) -> Self:
+        """
+        Create a Datename from an epoch without any parsing.
+        """
+        result = cls.__new__(cls)
+        result.epoch = int(epoch)
+        result.date_str = _epoch_to_date_str(result.epoch)
+        return result
+
+    @staticmethod
+    @traced("Datename.parse_many")
+    def parse_many(names: Iterable[Union[Path, str]]) -> "np.ndarray":
+        """
+        Parse many date strings at once into an int64 array of epochs.
+
+        Canonical names are parsed in a single vectorized pass, anything else
+        falls back to the one by one parser which raises on invalid names.
+        """
+        import numpy as np
+        names = [n.stem if isinstance(n, Path) else str(n) for n in names]
+        if len(names) == 0:
+            return np.zeros(0, dtype=np.int64)
+        joined = "".join(names)
+        if not joined.isascii() or any(len(n) != _DATE_STR_LEN for n in names):
+            return np.array([Datename._parse_date_str(n) for n in names], dtype=np.int64)
+        chars = np.frombuffer(joined.encode("ascii"), dtype=np.uint8).reshape(-1, _DATE_STR_LEN)
+        digits = chars.astype(np.int64) - ord("0")
+        digit_columns = [c for start, end in _DATE_STR_FIELDS for c in range(start, end)]
+        well_formed = (chars[:, _DATE_STR_SEPARATORS] == ord("-")).all(axis=1)
+        well_formed &= ((digits[:, digit_columns] >= 0) & (digits[:, digit_columns] <= 9)).all(axis=1)
+        fields = []
+        for start, end in _DATE_STR_FIELDS:
+            value = np.zeros(len(names), dtype=np.int64)
+            for column in range(start, end):
+                value = value * 10 + digits[:, column]
+            fields.append(value)
+        year, month, day, hour, minute, second = fields
+        leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+        month_length = np.array(_DAYS_IN_MONTH, dtype=np.int64)[np.clip(month, 1, 12) - 1] + (leap & (month == 2))
+        well_formed &= (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_length)
+        well_formed &= (hour < 24) & (minute < 60) & (second < 60)
+        epochs = _days_from_civil(year, month, day) * _SECONDS_PER_DAY + hour * 3600 + minute * 60 + second
+        for idx in np.flatnonzero(~well_formed):
+            epochs[idx] = Datename._parse_date_str(names[idx])
+        return epochs
+
+    def __init__(self, date: Union[Path, str, Self, int, datetime.datetime, None] = None) -> None:
+        if isinstance(date, Datename):
+            self.epoch = date.epoch
+            self.date_str = date.date_str
+            return
         if date is None:
-            self.date_str = self._get_date_str()
-        elif isinstance(date, Path):
-            date_str = date.stem
-            self.date_str = date_str
-        elif isinstance(date, str):
+            date = datetime.datetime.now()
+        if isinstance(date, Path):
+            date = date.stem
+        if isinstance(date, str):
+            epoch = _fast_parse_date_str(date)
+            if epoch is None:
+                epoch = self._parse_date_str(date)
+                date = _epoch_to_date_str(epoch)
+            self.epoch = epoch
             self.date_str = date
         elif isinstance(date, datetime.datetime):
-            self.date_str = self._get_date_str(date)
-        elif isinstance(date, Datename):
-            self.date_str = date.date_str
-        elif isinstance(date, int):
-            unix_time = date
-            date = datetime.datetime.fromtimestamp(unix_time)
-            self.date_str = self._get_date_str(date)
+            self.epoch = _fields_to_epoch(date.year, date.month, date.day, date.hour, date.minute, date.second)
+            self.date_str = _epoch_to_date_str(self.epoch)
+        elif isinstance(date, numbers.Integral):
+            self.epoch = int(date)
+            self.date_str = _epoch_to_date_str(self.epoch)
         else:
             raise ValueError(f"Invalid date type: {type(date)}")
-        # Validate the date string
-        _ = self._parse_date_str(self.date_str)
-    
+
+    @staticmethod
+    def _coerce(other: Union[Path, str, Self, int]) -> Self:
+        if isinstance(other, Datename):
+            return other
+        return Datename(other)
+
     @property
     def unix_time(self) -> int:
-        return int(datetime.datetime.strptime(self.date_str, self.__date_str_format).timestamp())
+        """
+        The epoch of the name, it is not corrected for the local timezone.
+        """
+        return self.epoch
 
+    def to_datetime(self) -> datetime.datetime:
+        """
+        The name as a naive datetime.
+        """
+        return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=self.epoch)
 
     def __str__(self) -> str:
         return self.date_str
-    
+
     def __repr__(self) -> str:
         return f"DateName({self.date_str})"
-    
+
     def __sub__(self, other: Self) -> Self:
-        other = Datename(other)
-        return Datename(self.unix_time - other.unix_time)
-    
-    def __add__(self, other: Self) -> int:
-        other = Datename(other)
-        return Datename(self.unix_time + other.unix_time)
-    
+        return Datename.from_epoch(self.epoch - Datename._coerce(other).epoch)
+
+    def __add__(self, other: Self) -> Self:
+        return Datename.from_epoch(self.epoch + Datename._coerce(other).epoch)
+
     def __eq__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.date_str == other.date_str
-    
+        return self.epoch == Datename._coerce(other).epoch
+
     def __lt__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.unix_time < other.unix_time
-    
+        return self.epoch < Datename._coerce(other).epoch
+
     def __le__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.unix_time <= other.unix_time
-    
+        return self.epoch <= Datename._coerce(other).epoch
+
     def __gt__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.unix_time > other.unix_time
-    
+        return self.epoch > Datename._coerce(other).epoch
+
     def __ge__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.unix_time >= other.unix_time
-    
+        return self.epoch >= Datename._coerce(other).epoch
+
     def __ne__(self, other: Self) -> bool:
-        other = Datename(other)
-        return self.date_str != other.date_str
-    
+        return self.epoch != Datename._coerce(other).epoch
+
     def __hash__(self) -> int:
-        return hash(self.date_str)
-    
+        return hash(self.epoch)
+
     def __int__(self) -> int:
-        return self.unix_time
-    
+        return self.epoch
+
     def pretty(self) -> str:
         """
         Pretty print the date.
         """
-        date = datetime.datetime.strptime(self.date_str, self.__date_str_format)
-        return date.strftime("%a %d %b %Y %H:%M")
-    
+        return self.to_datetime().strftime("%a %d %b %Y %H:%M")
+
     @classmethod
-    def one_year(cls) -> str:
-        # any date would do
-        return Datename("2024-01-01-00-00-00") - Datename("2023-01-01-00-00-00")
+    def one_year(cls) -> Self:
+        return Datename.from_epoch(365 * _SECONDS_PER_DAY)
 
     @classmethod
-    def one_month(cls) -> str:
-        # any date would do
-        return Datename("2023-02-01-00-00-00") - Datename("2023-01-01-00-00-00")
+    def one_month(cls) -> Self:
+        return Datename.from_epoch(31 * _SECONDS_PER_DAY)
 
     @classmethod
-    def one_week(cls) -> str:
-        # any date would do
-        return Datename("2023-01-08-00-00-00") - Datename("2023-01-01-00-00-00")
-    
+    def one_week(cls) -> Self:
+        return Datename.from_epoch(7 * _SECONDS_PER_DAY)
+
     @classmethod
-    def one_day(cls) -> str:
-        # any date would do
-        return Datename("2023-01-08-00-00-00") - Datename("2023-01-01-00-00-00")
-    
+    def one_day(cls) -> Self:
+        return Datename.from_epoch(_SECONDS_PER_DAY)
+
     @classmethod
-    def one_hour(cls) -> str:
-        # any date would do
-        return Datename("2023-01-01-01-00-00") - Datename("2023-01-01-00-00-00")
-    
+    def one_hour(cls) -> Self:
+        return Datename.from_epoch(3600)
+
     @classmethod
-    def one_minute(cls) -> str:
-        # any date would do
-        return Datename("2023-01-01-00-01-00") - Datename("2023-01-01-00-00-00")
-
-
-def get_prune_list(snapshots: List[Path], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0) -> Tuple[List[Path], List[Path]]:
-        old_to_new_snapshots = list((sorted(snapshots.copy())))
-        if len(old_to_new_snapshots) == 0:
-            return [], []
-        keep = [old_to_new_snapshots[0]]
-        keep_years = [old_to_new_snapshots[0]]
-        keep_months = [keep[0]]
-        keep_weeks = [keep[0]]
-        keep_days = [keep[0]]
-        keep_hours = [keep[0]]
-        keep_minutes = [keep[0]]
-        for snapshot in old_to_new_snapshots[1:]:
-            snapshot_date = Datename(snapshot.name)
-            if (yearly_count < 0 or len(keep_years) < yearly_count) and snapshot_date - Datename(keep_years[-1]) >= Datename.one_year():
-                keep_years.append(snapshot)
-            if (monthly_count < 0 or len(keep_months) < monthly_count) and snapshot_date - Datename(keep_months[-1]) >= Datename.one_month():
-                keep_months.append(snapshot)
-            if (weekly_count < 0 or len(keep_weeks) < weekly_count) and snapshot_date - Datename(keep_weeks[-1]) >= Datename.one_week():
-                keep_weeks.append(snapshot)
-            if (daily_count < 0 or len(keep_days) < daily_count) and snapshot_date - Datename(keep_days[-1]) >= Datename.one_day():
-                keep_days.append(snapshot)
-            if (hourly_count < 0 or len(keep_hours) < hourly_count) and snapshot_date - Datename(keep_hours[-1]) >= Datename.one_hour():
-                keep_hours.append(snapshot)
-            if (minute_count < 0 or len(keep_minutes) < minute_count) and  snapshot_date - Datename(keep_minutes[-1]) >= Datename.one_minute():
-                keep_minutes.append(snapshot)
-        keep = keep_years + keep_months + keep_weeks + keep_days + keep_hours + keep_minutes
-        keep = set(keep)
-        prune = set(old_to_new_snapshots) - keep
-        prune = [str(s) for s in prune]
-        keep = [str(s) for s in keep]
-        return list(prune), list(keep)
+    def one_minute(cls) -> Self:
+        return Datename.from_epoch(60)
+
+
+def _sort_snapshots(snapshots: List[Path]) -> Tuple[List[Path], "np.ndarray"]:
+    """
+    Snapshot paths oldest first and their epochs.
+    """
+    import numpy as np
+    snapshots = list(snapshots)
+    epochs = Datename.parse_many(snapshots)
+    # ordering by epoch avoids comparing Path objects which is very slow
+    order = np.argsort(epochs, kind="stable")
+    return [snapshots[idx] for idx in order], epochs[order]
+
+
+@traced()
+def get_prune_plan(snapshots: List[Path], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0) -> Tuple[List[Path], "RetentionPlan"]:
+    """
+    Sort snapshot paths oldest first and plan their retention.
+
+    The indexes of the returned plan refer to the returned sorted paths.
+    """
+    from .retention import plan_retention
+    old_to_new_snapshots, epochs = _sort_snapshots(snapshots)
+    plan = plan_retention(epochs, yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)
+    return old_to_new_snapshots, plan
+
+
+def get_prune_list(snapshots: List[Path], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0) -> Tuple[List[str], List[str]]:
+    """
+    Split snapshot paths into the ones to prune and the ones to keep, oldest first.
+    """
+    old_to_new_snapshots, plan = get_prune_plan(snapshots, yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)
+    prune = [str(old_to_new_snapshots[idx]) for idx in plan.prune]
+    keep = [str(old_to_new_snapshots[idx]) for idx in plan.keep]
+    return prune, keep
+
+
+@traced()
+def get_incremental_prune_plan(snapshots: List[Path], state_path: Optional[Path], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0, state: Optional["RetentionState"] = None) -> Tuple[List[Path], List[str], "RetentionState"]:
+    """
+    Plan retention reusing the state persisted at state_path when it is still valid.
+
+    A state already in memory can be passed instead, state_path is then not read.
+
+    Returns the snapshots oldest first, the ones to prune and the new state,
+    which the caller saves once the pruning has actually happened.
+    """
+    from .retention import RetentionState, plan_incremental
+    old_to_new_snapshots, epochs = _sort_snapshots(snapshots)
+    if state is None and state_path is not None:
+        state = RetentionState.load(state_path)
+    prune, state, _ = plan_incremental(epochs, state, yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)
+    return old_to_new_snapshots, [str(old_to_new_snapshots[idx]) for idx in prune], state
+
+
+# what the commands exit with when the archive lock timed out, EX_TEMPFAIL
+LOCK_TIMEOUT_EXIT = 75
+
+PRUNE_PARAMS = {
+    "archive_root": "./",
+    "snapshots_name": "snapshots",
+    "yearly_count": -1,
+    "monthly_count": 12,
+    "weekly_count": 5,
+    "daily_count": 7,
+    "hourly_count": 24,
+    "minute_count": 0,
+    "incremental": True,
+    "state_name": ".bkang_prune_state.json",
+    "delete_workers": 16,
+    "btrfs_batch_size": 100,
+    "btrfs_wait_cleaner": False,
+    "space_report": False,
+    "free_space_gb": 0.0,
+    "free_space_force": False,
+    "space_cache_name": ".bkang_space",
+    "current_name": "current",
+    "scan_workers": 16,
+    "version_index": False,
+    "name_index": False,
+    "verbose": 1,
+    "no_dry_run": False,
+    "lock_timeout": 3600.0,
+    "io_class": "best-effort",
+    "io_level": 7,
+    "cpu_nice": 10,
+    "metrics_jsonl": "",
+    "metrics_textfile_dir": "",
+    "trace_output": "",
+    "fstype": ("btrfs", "hardlinks", "list")
+}
+
+SYNC_PARAMS = {
+    "archive_address": "127.0.0.1",
+    "backup_src": "/home/",
+    "archive_root": "./",
+    "current_name": "current",
+    "snapshots_name": "snapshots",
+    "verbose": 1,
+    "no_dry_run": False,
+    "sync_mode": ("current", "linkdest"),
+    "sync_shards": 1,
+    "shard_depth": 2,
+    "lock_timeout": 3600.0,
+    "io_class": "best-effort",
+    "io_level": 7,
+    "cpu_nice": 10,
+    "metrics_jsonl": "",
+    "metrics_textfile_dir": "",
+    "trace_output": "",
+    "ssh_multiplex": True
+}
+
+SNAPSHOT_PARAMS = {
+    "archive_root": "./",
+    "current_name": "current",
+    "snapshots_name": "snapshots",
+    "link_workers": 16,
+    "version_index": False,
+    "name_index": False,
+    "no_dry_run": False,
+    "lock_timeout": 3600.0,
+    "io_class": "best-effort",
+    "io_level": 7,
+    "cpu_nice": 10,
+    "metrics_jsonl": "",
+    "metrics_textfile_dir": "",
+    "trace_output": "",
+    "fstype": ("btrfs", "hardlinks")
+}
+
+
+def _strip_slash(path: str) -> str:
+    return path[:-1] if path.endswith("/") else path
+
+
+def prune_archive(args, catalog: Optional["SnapshotCatalog"] = None, state: Optional["RetentionState"] = None) -> Tuple[Optional[int], Optional["RetentionState"]]:
+    """
+    Prune the snapshots of an archive as configured by args (see PRUNE_PARAMS).
+
+    A long running caller passes its catalog and the state of the previous
+    prune instead of having them read from disk. Returns the exit code, None
+    if the archive lock timed out, and the retention state that was saved.
+    """
+    from .locks import LockTimeout, archive_job
+    from .metrics import job_metrics
+    from .tracing import session
+    with session(args.trace_output, "prune"):
+        with job_metrics(args, "prune") as metrics:
+            try:
+                with archive_job(args, "prune", metrics=metrics):
+                    returncode, state = _prune_archive(args, catalog, state, metrics)
+            except LockTimeout:
+                returncode, state = None, None
+            metrics.exit_code = LOCK_TIMEOUT_EXIT if returncode is None else returncode
+    return returncode, state
+
+
+def _prune_archive(args, catalog: Optional["SnapshotCatalog"], state: Optional["RetentionState"], metrics: "RunMetrics") -> Tuple[Optional[int], Optional["RetentionState"]]:
+    from .catalog import SnapshotCatalog
+    from .deletion import delete_snapshots, interrupted_deletions
+    import sys
+    if args.no_dry_run:
+        assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
+    with metrics.phase("enumerate"):
+        if catalog is None:
+            catalog = SnapshotCatalog(Path(args.archive_root) / args.snapshots_name)
+        else:
+            catalog.refresh()
+        snapshots = catalog.paths()
+    state_path = Path(args.archive_root) / args.state_name
+    with metrics.phase("plan"):
+        snapshots, prune, state = get_incremental_prune_plan(snapshots, state_path if args.incremental else None, args.yearly_count, args.monthly_count, args.weekly_count, args.daily_count, args.hourly_count, args.minute_count, state=state if args.incremental else None)
+        reasons = state.explain()
+    space_pruned = []
+    if (args.space_report or args.free_space_gb > 0) and args.fstype == "btrfs":
+        print("Space accounting relies on hard links, it is not available for btrfs snapshots.", file=sys.stderr)
+    elif args.space_report or args.free_space_gb > 0:
+        with metrics.phase("space"):
+            import shutil
+            from .space import SpaceAccounting, format_bytes
+            current_path = Path(args.archive_root) / args.current_name
+            # files unchanged since the newest snapshot are also linked from current
+            holders = [current_path] if current_path.is_dir() and not current_path.is_symlink() else []
+            accounting = SpaceAccounting(snapshots, Path(args.archive_root) / args.space_cache_name, holders, workers=args.scan_workers, progress_file=sys.stderr if args.verbose > 0 else None)
+            prune_set = set(prune)
+            pruned = [n for n, s in enumerate(snapshots) if str(s) in prune_set]
+            if args.space_report:
+                print("Snapshot\tTotal\tUnique\tShared previous\tShared next", file=sys.stderr)
+                for usage in accounting.report():
+                    print("\t".join([usage["snapshot"]] + [format_bytes(usage[k]) for k in ("total", "unique", "shared_previous", "shared_next")]), file=sys.stderr)
+                print(f"Pruning frees {format_bytes(accounting.freed_bytes(pruned))}\n", file=sys.stderr)
+            if args.free_space_gb > 0:
+                needed = int(args.free_space_gb * 1024 ** 3) - shutil.disk_usage(args.archive_root).free - accounting.freed_bytes(pruned)
+                # the newest snapshot is never given up for space
+                candidates = sorted(set(range(len(snapshots) - 1)) - set(pruned))
+                picked, freed = accounting.plan_free_space(needed, candidates, pruned) if needed > 0 else ([], 0)
+                # the picked snapshots are kept by the retention rules, they only go when asked to and when that is enough
+                if freed < needed:
+                    print(f"Even pruning every other snapshot leaves {format_bytes(needed - freed)} short of {args.free_space_gb} GB free, pruning none of them.", file=sys.stderr)
+                elif picked and not args.free_space_force:
+                    print(f"Reaching {args.free_space_gb} GB free needs pruning these kept snapshots, set free_space_force to do so:\n\t" + "\n\t".join(str(snapshots[n]) for n in picked), "\n", file=sys.stderr)
+                else:
+                    space_pruned = [str(snapshots[n]) for n in picked]
+                    prune_set.update(space_pruned)
+                    prune = [str(s) for s in snapshots if str(s) in prune_set]
+    if args.verbose > 0:
+        epochs = Datename.parse_many(snapshots).tolist()
+        keep = [f"{s} ({', '.join(reasons[e])})" for s, e in zip(snapshots, epochs) if e in reasons and str(s) not in space_pruned]
+        print("Snapshots to prune:\n\t" + "\n\t".join(prune), "\n", file=sys.stderr)
+        if space_pruned:
+            print("Of which for free space:\n\t" + "\n\t".join(space_pruned), "\n", file=sys.stderr)
+        print("Snapshots to keep:\n\t" + "\n\t".join(keep), "\n", file=sys.stderr)
+    metrics.count("snapshots", len(snapshots))
+    metrics.count("snapshots_pruned", len(prune))
+    metrics.count("snapshots_pruned_for_space", len(space_pruned))
+    metrics.count("snapshots_kept", len(snapshots) - len(prune))
+    if args.fstype == "hardlinks" and args.no_dry_run:
+        from .hardlink import abandoned_creations
+        # leftovers of an interrupted prune or snapshot are not snapshots but still need deleting
+        prune += [str(p) for p in interrupted_deletions(Path(args.archive_root) / args.snapshots_name)]
+        prune += [str(p) for p in abandoned_creations(Path(args.archive_root) / args.snapshots_name, snapshots[-1].name if snapshots else None)]
+        with metrics.phase("delete"):
+            progress = delete_snapshots(prune, workers=args.delete_workers, progress_file=sys.stderr if args.verbose > 0 else None)
+        metrics.count("files_deleted", progress.files)
+        metrics.count("dirs_deleted", progress.dirs)
+        metrics.count("errors", len(progress.errors))
+        for path, error in progress.errors:
+            print(f"Error deleting {path}: {error}", file=sys.stderr)
+        if progress.errors:
+            return 1, None
+    elif args.fstype == "btrfs" and args.no_dry_run:
+        from .btrfs import delete_subvolumes
+        with metrics.phase("delete"):
+            deletion = delete_subvolumes(prune, batch_size=args.btrfs_batch_size, wait_cleaner=args.btrfs_wait_cleaner, progress_file=sys.stderr if args.verbose > 0 else None)
+        metrics.count("subvolumes_deleted", len(deletion.deleted))
+        metrics.count("errors", len(deletion.errors))
+        if deletion.cleaner_seconds is not None:
+            metrics.phases["cleaner"] = deletion.cleaner_seconds
+        if deletion.reclaimed_bytes is not None:
+            metrics.count("bytes_reclaimed", deletion.reclaimed_bytes)
+        for path, error in deletion.errors:
+            print(f"Error deleting {path}: {error}", file=sys.stderr)
+        if deletion.errors:
+            return 1, None
+    elif args.fstype == "btrfs":
+        from .btrfs import delete_commands
+        for cmd in delete_commands(prune, args.btrfs_batch_size):
+            print(cmd, file=sys.stdout)
+    elif args.fstype in ("list", "hardlinks"):
+        # list only names the snapshots, with or without no_dry_run
+        for snapshot in prune:
+            print(snapshot if args.fstype == "list" else f"rm -Rf {snapshot}", file=sys.stdout)
+    else:
+        raise ValueError(f"Invalid fstype: {args.fstype}")
+    saved_state = None
+    if args.no_dry_run and args.incremental and not space_pruned and args.fstype != "list":
+        # a prune that did not complete is detected by the next run, which recomputes
+        # from scratch, as is one that dropped snapshots the state keeps
+        state.save(state_path)
+        saved_state = state
+    if args.no_dry_run and (args.version_index or args.name_index):
+        catalog.refresh()
+    if args.no_dry_run and args.version_index:
+        from .versions import update_version_index
+        with metrics.phase("index"):
+            update_version_index(Path(args.archive_root) / args.snapshots_name, workers=args.scan_workers, progress_file=sys.stderr if args.verbose > 0 else None)
+    if args.no_dry_run and args.name_index:
+        from .names import update_name_index
+        with metrics.phase("index"):
+            update_name_index(Path(args.archive_root) / args.snapshots_name, workers=args.scan_workers, progress_file=sys.stderr if args.verbose > 0 else None)
+    return 0, saved_state
 
 
 def list_prune_main():
     from .config import update_fargv_dict
-    from .util import get_cmd_output, single_instance_aborting
     import fargv
-    import glob
     import sys
-    p = {
-        "archive_root": "./",
-        "snapshots_name": "snapshots",
-        "yearly_count": -1,
-        "monthly_count": 12,
-        "weekly_count": 5,
-        "daily_count": 7,
-        "hourly_count": 24,
-        "verbose": 1,
-        "no_dry_run": False,
-        "fstype": ("btrfs", "hardlinks")
-    }
+    p = dict(PRUNE_PARAMS)
     update_fargv_dict(p)
     args, _ = fargv.fargv(p)
+    returncode, _ = prune_archive(args)
+    if returncode is None:
+        sys.exit(LOCK_TIMEOUT_EXIT)
+    if returncode:
+        sys.exit(returncode)
+
+
+def _count_rsync_stats(metrics: "RunMetrics", result: "CommandResult") -> None:
+    for key in ("number_of_files", "number_of_regular_files_transferred", "total_file_size", "total_transferred_file_size", "total_bytes_sent", "total_bytes_received"):
+        if key in result.stats:
+            metrics.count(key, result.stats[key])
+
+
+def sync_current(args) -> Optional[int]:
+    """
+    Rsync the source into the archive as configured by args (see SYNC_PARAMS).
+
+    Returns the exit code, None if the archive lock timed out.
+    """
+    from .locks import LockTimeout, archive_job
+    from .metrics import job_metrics
+    from .tracing import session
+    with session(args.trace_output, "sync"):
+        with job_metrics(args, "sync") as metrics:
+            try:
+                with archive_job(args, "sync", metrics=metrics):
+                    returncode = _sync_current(args, metrics)
+            except LockTimeout:
+                returncode = None
+            metrics.exit_code = LOCK_TIMEOUT_EXIT if returncode is None else returncode
+    return returncode
+
+
+def _sync_current(args, metrics: "RunMetrics") -> int:
+    from .ssh import get_connection
+    from .sync import RSYNC_FLAGS, RSYNC_PROGRESS_FLAGS, ShardEstimates, current_rsync_target, current_sync_cmd, linkdest_rsync_target, linkdest_sync_cmds, plan_shards, run_sharded, sharded_rsync_cmds
+    from .util import RSYNC_OK_CODES, run_cmd
+    import sys
+    import tempfile
     if args.no_dry_run:
         assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-    snapshots = glob.glob(f"{args.archive_root}/{args.snapshots_name}/*")
-    snapshots = [Path(s) for s in snapshots]
-    snapshots = [s for s in snapshots if s.is_dir() and Datename.is_valid_date_str(s.name)]
-    prune, keep = get_prune_list(snapshots, args.yearly_count, args.monthly_count, args.weekly_count, args.daily_count, args.hourly_count)
-    if args.verbose > 0:
-        print(f"Snapshots to prune:\n\t{'\n\t'.join(prune)}", "\n", file=sys.stderr)
-        print(f"Snapshots to keep:\n\t{'\n\t'.join(keep)}", "\n", file=sys.stderr)
-    for snapshot in prune:
-        if args.mode == "list":
-            res_str = f"{snapshot}"
-        elif args.mode == "btrfs":
-            res_str = f"btrfs subvolume delete {snapshot}"
-        elif args.mode == "hardlinks":
-            res_str = f"rm -Rf {snapshot}"
+    backup_src, archive_root, current_name, snapshots_name = (_strip_slash(a) for a in (args.backup_src, args.archive_root, args.current_name, args.snapshots_name))
+    flags = f"{RSYNC_FLAGS} {RSYNC_PROGRESS_FLAGS}" if args.verbose > 0 else RSYNC_FLAGS
+    ssh = "ssh"
+    connection = None
+    if args.ssh_multiplex and args.no_dry_run:
+        # every rsync and remote command of this run shares one ssh master
+        connection = get_connection(args.archive_address)
+        if connection.start():
+            flags = f"{flags} {connection.rsync_flags()}"
+            ssh = connection.ssh_cmd()
         else:
-            raise ValueError(f"Invalid mode: {args.mode}")
+            print(f"Could not start an ssh master for {args.archive_address}, connecting per command", file=sys.stderr)
+            connection = None
+    snapshot_name = str(Datename())
+    if args.sync_mode == "current":
+        cmds = [current_sync_cmd(backup_src, args.archive_address, archive_root, current_name, flags)]
+        extra, dest = current_rsync_target(backup_src, args.archive_address, archive_root, current_name)
+        link_dest = None
+    elif args.sync_mode == "linkdest":
+        cmds = linkdest_sync_cmds(backup_src, args.archive_address, archive_root, current_name, snapshots_name, snapshot_name, flags, ssh)
+        extra, dest, link_dest = linkdest_rsync_target(backup_src, args.archive_address, archive_root, current_name, snapshots_name, snapshot_name)
+    else:
+        raise ValueError(f"Invalid sync_mode: {args.sync_mode}")
+    rsync_idx = [n for n, cmd in enumerate(cmds) if cmd.startswith("rsync")][0]
+    with tempfile.TemporaryDirectory(prefix="bkang-shards-") as filter_dir:
+        if args.sync_shards > 1:
+            # the single rsync is replaced by dir passes and concurrent shards
+            with metrics.phase("plan"):
+                plan = plan_shards(backup_src, args.sync_shards, ShardEstimates(backup_src, max_depth=args.shard_depth))
+            dir_cmds, shard_cmds = sharded_rsync_cmds(plan, flags, extra, backup_src, dest, filter_dir, link_dest)
+            if args.verbose > 0:
+                print(f"{plan}, estimated costs {[int(c) for c in plan.costs]}", file=sys.stderr)
         if args.no_dry_run:
-            @single_instance_aborting("prune_snapshot")
-            def prune_snapshot():
-                get_cmd_output(res_str, show_cmd=False, show_output=True)
-            prune_snapshot()
+            try:
+                for n, cmd in enumerate(cmds):
+                    if n == rsync_idx and args.sync_shards > 1:
+                        results = []
+                        with metrics.phase("transfer"):
+                            returncode = run_sharded(dir_cmds, shard_cmds, RSYNC_OK_CODES, show_output=args.verbose > 0, results=results)
+                        for result in results:
+                            _count_rsync_stats(metrics, result)
+                        if returncode != 0:
+                            return returncode
+                        continue
+                    with metrics.phase("transfer" if n == rsync_idx else "commands"):
+                        result = run_cmd(cmd, show_cmd=True, show_output=args.verbose > 0)
+                    if n == rsync_idx:
+                        _count_rsync_stats(metrics, result)
+                    # only rsync may end with a partial transfer (vanished files)
+                    ok_codes = RSYNC_OK_CODES if n == rsync_idx else (0,)
+                    if result.returncode not in ok_codes:
+                        print(f"Failed ({result.returncode}) after {result.elapsed:.1f}s: {cmd}", file=sys.stderr)
+                        return result.returncode
+                return 0
+            finally:
+                if connection is not None:
+                    connection.stop()
         else:
-            print(res_str, file=sys.stdout)
+            if args.sync_shards > 1:
+                # dir passes run in order, the shards concurrently
+                shards = " & ".join(shard_cmds) + " & wait"
+                cmds[rsync_idx] = "(" + " && ".join(dir_cmds + [f"({shards})"]) + ")"
+            print(" && ".join(cmds), file=sys.stdout)
+            return 0
 
 
 def sync_current_main():
     from .config import update_fargv_dict
-    from .util import get_cmd_output, single_instance_aborting
     import fargv
-    import glob
     import sys
-    p = {
-        "archive_address": "127.0.0.1",
-        "backup_src": "/home/",
-        "archive_root": "./",
-        "current_name": "current",
-        "verbose": 1,
-        "no_dry_run": False,
-        "mode": ("btrfs", "hardlinks")
-    }
+    p = dict(SYNC_PARAMS)
     update_fargv_dict(p)
     args, _ = fargv.fargv(p)
+    returncode = sync_current(args)
     if args.no_dry_run:
-        assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-    if args.backup_src.endswith("/"):
-        args.backup_src = args.input[:-1]
-    if args.archive_root.endswith("/"):
-        args.archive_root = args.archive_root[:-1]
-    if args.current_name.endswith("/"):
-        args.current_name = args.current_name[:-1]
-    cmd = f"rsync -aAXH --delete {args.backup_src}/ {args.archive_address}:{args.archive_root}/{args.current_name}{args.backup_src}/"
-    if args.no_dry_run:
-        assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-        @single_instance_aborting("sync_current")
-        def sync_current():
-            get_cmd_output(cmd, show_cmd=True, show_output=True)
-        sync_current()
-    else:
-        print(cmd, file=sys.stdout)
+        sys.exit(LOCK_TIMEOUT_EXIT if returncode is None else returncode)
 
 
-def take_snapshot_main():
-    from .config import update_fargv_dict
-    from .util import get_cmd_output, single_instance_aborting
-    import fargv
-    import glob
+def take_snapshot(args) -> Optional[int]:
+    """
+    Snapshot current as configured by args (see SNAPSHOT_PARAMS).
+
+    Returns the exit code, None if the archive lock timed out.
+    """
+    from .locks import LockTimeout, archive_job
+    from .metrics import job_metrics
+    from .tracing import session
+    with session(args.trace_output, "snapshot"):
+        with job_metrics(args, "snapshot") as metrics:
+            try:
+                with archive_job(args, "snapshot", metrics=metrics):
+                    returncode = _take_snapshot(args, metrics)
+            except LockTimeout:
+                returncode = None
+            metrics.exit_code = LOCK_TIMEOUT_EXIT if returncode is None else returncode
+    return returncode
+
+
+def _take_snapshot(args, metrics: "RunMetrics") -> int:
+    from .hardlink import create_hardlink_snapshot
+    from .util import run_cmd
     import sys
-    p = {
-        "archive_root": "./",
-        "current_name": "current",
-        "snapshots_name": "snapshots",
-        "no_dry_run": False,
-        "fstype": ("btrfs", "hardlinks")
-    }
-    update_fargv_dict(p)
-    args, _ = fargv.fargv(p)
     if args.no_dry_run:
         assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-    if args.archive_root.endswith("/"):
-        args.archive_root = args.archive_root[:-1]
-    if args.current_name.endswith("/"):
-        args.current_name = args.current_name[:-1]
-    if args.snapshots_name.endswith("/"):
-        args.snapshots_name = args.snapshots_name[:-1]
+    archive_root, current_name, snapshots_name = (_strip_slash(a) for a in (args.archive_root, args.current_name, args.snapshots_name))
     if args.fstype == "btrfs":
-        cmd = f"btrfs subvolume snapshot {args.archive_root}/{args.current_name} {args.archive_root}/{args.snapshots_name}/{str(Datename())}"
+        cmd = f"btrfs subvolume snapshot {archive_root}/{current_name} {archive_root}/{snapshots_name}/{str(Datename())}"
         if args.no_dry_run:
-            assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-            get_cmd_output(cmd, show_cmd=False, show_output=True)
+            with metrics.phase("link"):
+                result = run_cmd(cmd, show_cmd=False, show_output=True)
+            if not result.ok:
+                return result.returncode
         else:
             print(cmd, file=sys.stdout)
     elif args.fstype == "hardlinks":
-        cmd = f"cp --link -a {args.archive_root}/{args.current_name} {args.archive_root}/{args.snapshots_name}/{str(Datename())}"
+        current_path = f"{archive_root}/{current_name}"
+        snapshot_path = f"{archive_root}/{snapshots_name}/{str(Datename())}"
         if args.no_dry_run:
-            assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
-            @single_instance_aborting("take_snapshot_main")
-            def take_snapshot_main():
-                get_cmd_output(cmd, show_cmd=True, show_output=True)
-            take_snapshot_main()
+            with metrics.phase("link"):
+                progress = create_hardlink_snapshot(current_path, snapshot_path, workers=args.link_workers)
+            metrics.count("files_linked", progress.files)
+            metrics.count("dirs_created", progress.dirs)
+            metrics.count("files_copied", progress.copied)
+            metrics.count("errors", len(progress.errors))
+            if progress.errors:
+                for path, error in progress.errors:
+                    print(f"Error linking {path}: {error}", file=sys.stderr)
+                return 1
         else:
-            print(cmd, file=sys.stdout)
+            # the equivalent of what create_hardlink_snapshot does
+            print(f"cp --link -a {current_path} {snapshot_path}", file=sys.stdout)
     else:
         raise ValueError(f"Invalid fstype: {args.fstype}")
+    if args.no_dry_run and args.version_index:
+        from .versions import update_version_index
+        with metrics.phase("index"):
+            update_version_index(f"{archive_root}/{snapshots_name}", workers=args.link_workers)
+    if args.no_dry_run and args.name_index:
+        from .names import update_name_index
+        with metrics.phase("index"):
+            update_name_index(f"{archive_root}/{snapshots_name}", workers=args.link_workers)
+    return 0
+
+
+def take_snapshot_main():
+    from .config import update_fargv_dict
+    import fargv
+    import sys
+    p = dict(SNAPSHOT_PARAMS)
+    update_fargv_dict(p)
+    args, _ = fargv.fargv(p)
+    returncode = take_snapshot(args)
+    if returncode is None:
+        sys.exit(LOCK_TIMEOUT_EXIT)
+    if returncode:
+        sys.exit(returncode)
@@ -0,0 +1,453 @@
+import errno
+import hashlib
+import os
+import sqlite3
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+from .catalog import SnapshotCatalog
+
+
+_HASH_CHUNK = 1 << 20
+
+
+def hash_file(path: str, chunk_size: int = _HASH_CHUNK, read_ahead: int = 0, max_bytes_per_second: float = 0.0, drop_cache: bool = False) -> Tuple[str, Optional[str]]:
+    """
+    The sha256 of the contents of path, None if it cannot be read.
+
+    read_ahead bytes past each chunk are requested from the kernel ahead of
+    time, max_bytes_per_second throttles the reading and drop_cache evicts
+    the file from the page cache afterwards.
+    """
+    digest = hashlib.sha256()
+    advise = hasattr(os, "posix_fadvise")
+    try:
+        with open(path, "rb") as f:
+            fd = f.fileno()
+            if advise:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            start, offset = time.monotonic(), 0
+            while True:
+                if advise and read_ahead > 0:
+                    os.posix_fadvise(fd, offset + chunk_size, read_ahead, os.POSIX_FADV_WILLNEED)
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                offset += len(chunk)
+                if max_bytes_per_second > 0:
+                    ahead = offset / max_bytes_per_second - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            if advise and drop_cache:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        return path, None
+    return path, digest.hexdigest()
+
+
+def _metadata_key(path: str, st: os.stat_result) -> str:
+    """
+    What hard linked files have to agree on besides their contents.
+    """
+    try:
+        names = sorted(os.listxattr(path, follow_symlinks=False))
+        xattrs = hashlib.sha256(b"".join(n.encode() + b"\0" + os.getxattr(path, n, follow_symlinks=False) + b"\0" for n in names)).hexdigest()[:16] if names else ""
+    except OSError as e:
+        if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+        xattrs = ""
+    return f"{st.st_mode:o}:{st.st_uid}:{st.st_gid}:{st.st_mtime_ns}:{xattrs}"
+
+
+def _scan_files(path: str, min_size: int) -> Tuple[List[Tuple[str, os.stat_result]], List[str]]:
+    """
+    The regular files of path of at least min_size bytes, and its subdirectories.
+    """
+    files, subdirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if st.st_size >= min_size:
+                    files.append((entry.path, st))
+    return files, subdirs
+
+
+def scan_files(root: Union[str, Path], min_size: int = 1, workers: int = 16) -> List[Tuple[str, os.stat_result]]:
+    """
+    Every regular file under root of at least min_size bytes, walked by a thread pool.
+    """
+    files = []
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bkang-dedup") as executor:
+        pending: Dict[Future, str] = {executor.submit(_scan_files, str(root), min_size): str(root)}
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                dir_files, subdirs = future.result()
+                files += dir_files
+                for subdir in subdirs:
+                    pending[executor.submit(_scan_files, subdir, min_size)] = subdir
+    return files
+
+
+class DedupStats:
+    def __init__(self) -> None:
+        self.start_time: float = time.monotonic()
+        self.snapshots: int = 0
+        self.files: int = 0
+        self.hashed: int = 0
+        self.hashed_bytes: int = 0
+        self.relinked: int = 0
+        self.saved_bytes: int = 0
+        self.errors: List[Tuple[str, str]] = []
+
+    def __str__(self) -> str:
+        return (f"[{self.snapshots} snapshots, {self.files} files, hashed {self.hashed} ({self.hashed_bytes} bytes), "
+                f"relinked {self.relinked} saving {self.saved_bytes} bytes, {len(self.errors)} errors, {time.monotonic() - self.start_time:.1f}s]")
+
+
+class DedupIndex:
+    """
+    The contents of the files of every deduplicated snapshot, by inode.
+
+    Every inode of at least the minimum size is kept with its size, mtime
+    and digest, so a file is hashed once however many snapshots link it.
+    Inodes with a size no other file had are kept unhashed (NULL digest)
+    until a file of the same size turns up, then both are hashed: a file
+    renamed or moved between snapshots is a new inode of a known size. For each contents
+    and metadata the index also keeps one canonical path, the inode the
+    duplicates are linked to. An inode is recognised by its number, size,
+    mtime and ctime. Every new hard link changes the ctime, so an inode
+    whose ctime moved is still recognised while the path it was last seen
+    at holds it: an inode number only gets reused once the inode is gone.
+    Rows of inodes found gone are dropped.
+    """
+    version = 3
+    index_name = ".bkang_dedup.sqlite"
+
+    def __init__(self, snapshots_path: Union[str, Path], index_path: Union[str, Path, None] = None) -> None:
+        self.snapshots_path: Path = Path(snapshots_path)
+        if index_path is None:
+            index_path = self.snapshots_path.parent / self.index_name
+        self.index_path: Path = Path(index_path)
+        self.db = sqlite3.connect(str(self.index_path), timeout=30)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript("DROP TABLE IF EXISTS inodes; DROP TABLE IF EXISTS canonical; DROP TABLE IF EXISTS snapshots;")
+        self.db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS inodes (inode INTEGER PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, ctime_ns INTEGER NOT NULL, digest TEXT, path TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS inodes_size ON inodes (size);
+            CREATE TABLE IF NOT EXISTS canonical (size INTEGER NOT NULL, digest TEXT NOT NULL, metadata TEXT NOT NULL, inode INTEGER NOT NULL, path TEXT NOT NULL, PRIMARY KEY (size, digest, metadata)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY);
+            PRAGMA user_version = {self.version};
+        """)
+
+    def processed(self) -> List[str]:
+        return [n for (n,) in self.db.execute("SELECT name FROM snapshots")]
+
+    def known_digest(self, path: str, st: os.stat_result) -> Optional[str]:
+        row = self.db.execute("SELECT size, mtime_ns, ctime_ns, digest, path FROM inodes WHERE inode = ?", (st.st_ino,)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, ctime_ns, digest, known_path = row
+        if ctime_ns != st.st_ctime_ns:
+            try:
+                alive = os.lstat(known_path).st_ino == st.st_ino
+            except OSError:
+                alive = False
+            if not alive:
+                # the inode is gone, the number was reused
+                self.db.execute("DELETE FROM inodes WHERE inode = ?", (st.st_ino,))
+                return None
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        if ctime_ns != st.st_ctime_ns or known_path != path:
+            self.add_inode(path, st, digest)
+        return digest
+
+    def has_size(self, size: int, inode: int) -> bool:
+        """
+        Whether an inode other than inode had this size.
+        """
+        return self.db.execute("SELECT 1 FROM inodes WHERE size = ? AND inode != ? LIMIT 1", (size, inode)).fetchone() is not None
+
+    def unhashed(self, size: int) -> List[Tuple[str, os.stat_result]]:
+        """
+        The inodes of this size not hashed yet which are still where they were last seen, with a path and their stat.
+        """
+        found = []
+        for inode, mtime_ns, path in self.db.execute("SELECT inode, mtime_ns, path FROM inodes WHERE size = ? AND digest IS NULL", (size,)).fetchall():
+            try:
+                st = os.lstat(path)
+            except OSError:
+                st = None
+            if st is None or st.st_ino != inode or st.st_size != size or st.st_mtime_ns != mtime_ns:
+                self.db.execute("DELETE FROM inodes WHERE inode = ?", (inode,))
+                continue
+            found.append((path, st))
+        return found
+
+    def canonical(self, size: int, digest: str, metadata: str) -> Optional[Tuple[int, str]]:
+        """
+        The inode and a path of it for these contents and metadata, if it still exists.
+        """
+        row = self.db.execute("SELECT inode, path FROM canonical WHERE size = ? AND digest = ? AND metadata = ?", (size, digest, metadata)).fetchone()
+        if row is None:
+            return None
+        try:
+            if os.lstat(row[1]).st_ino != row[0]:
+                return None
+        except OSError:
+            return None
+        return row[0], row[1]
+
+    def set_canonical(self, size: int, digest: str, metadata: str, inode: int, path: str) -> None:
+        self.db.execute("INSERT OR REPLACE INTO canonical (size, digest, metadata, inode, path) VALUES (?, ?, ?, ?, ?)", (size, digest, metadata, inode, path))
+
+    def add_inode(self, path: str, st: os.stat_result, digest: Optional[str]) -> None:
+        self.db.execute("INSERT OR REPLACE INTO inodes (inode, size, mtime_ns, ctime_ns, digest, path) VALUES (?, ?, ?, ?, ?, ?)", (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest, path))
+
+    def drop_gone(self, snapshot_names: List[str]) -> int:
+        """
+        Forget the inodes last seen in snapshots that no longer exist, returns how many.
+
+        The inodes may live on in newer snapshots, they are then hashed again.
+        """
+        prefix = str(self.snapshots_path) + os.sep
+        live = set(snapshot_names)
+        gone = [(inode,) for inode, path in self.db.execute("SELECT inode, path FROM inodes") if not path.startswith(prefix) or path[len(prefix):].split(os.sep, 1)[0] not in live]
+        with self.db:
+            self.db.executemany("DELETE FROM inodes WHERE inode = ?", gone)
+        return len(gone)
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def same_contents(path: str, other_path: str, chunk_size: int = _HASH_CHUNK) -> bool:
+    """
+    Whether two files hold the same bytes, compared in full.
+    """
+    with open(path, "rb") as f, open(other_path, "rb") as other:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk != other.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+
+def relink(canonical_path: str, path: str) -> None:
+    """
+    Atomically replace path by a hard link to canonical_path.
+
+    The parent directory keeps its timestamps, the snapshot looks untouched.
+    """
+    parent = os.path.dirname(path)
+    parent_st = os.lstat(parent)
+    tmp_path = os.path.join(parent, f".bkang-dedup-{os.getpid()}-{threading.get_ident()}")
+    os.link(canonical_path, tmp_path, follow_symlinks=False)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+    os.utime(parent, ns=(parent_st.st_atime_ns, parent_st.st_mtime_ns), follow_symlinks=False)
+
+
+def dedup_snapshot(index: DedupIndex, snapshot_path: Path, stats: DedupStats, min_size: int = 1, hash_workers: Optional[int] = None, scan_workers: int = 16, dry_run: bool = True, output_file: IO = sys.stdout) -> List[int]:
+    """
+    Link the files of one snapshot to identical files already in the index.
+
+    Only files whose size occurs in the index or more than once in the
+    snapshot are hashed, each inode once, by a process pool, together with
+    the unhashed inodes of the index of these sizes. Returns the inodes
+    files were relinked away from.
+    """
+    files = scan_files(snapshot_path, min_size, scan_workers)
+    stats.files += len(files)
+    digests: Dict[int, str] = {}
+    unknown: Dict[int, Tuple[str, os.stat_result]] = {}
+    for path, st in files:
+        if st.st_ino in digests or st.st_ino in unknown:
+            continue
+        digest = index.known_digest(path, st)
+        if digest is not None:
+            digests[st.st_ino] = digest
+        else:
+            unknown[st.st_ino] = (path, st)
+    sizes: Dict[int, int] = {}
+    for _, st in unknown.values():
+        sizes[st.st_size] = sizes.get(st.st_size, 0) + 1
+    to_hash = [(path, st) for path, st in unknown.values() if sizes[st.st_size] > 1 or index.has_size(st.st_size, st.st_ino)]
+    for path, st in unknown.values():
+        if sizes[st.st_size] == 1 and not index.has_size(st.st_size, st.st_ino):
+            index.add_inode(path, st, None)
+    # inodes of older snapshots that waited for a file of their size, they become the canonical ones
+    earlier = [e for size in sorted({st.st_size for _, st in to_hash}) for e in index.unhashed(size) if e[1].st_ino not in unknown]
+    to_hash += earlier
+    if to_hash:
+        by_path = {path: st for path, st in to_hash}
+        with ProcessPoolExecutor(max_workers=hash_workers) as executor:
+            # big files first so a single one does not end up last
+            ordered = sorted(by_path, key=lambda p: -by_path[p].st_size)
+            for path, digest in executor.map(hash_file, ordered, chunksize=16):
+                if digest is None:
+                    stats.errors.append((path, "unreadable"))
+                    continue
+                st = by_path[path]
+                digests[st.st_ino] = digest
+                index.add_inode(path, st, digest)
+                stats.hashed += 1
+                stats.hashed_bytes += st.st_size
+    for path, st in earlier:
+        digest = digests.get(st.st_ino)
+        if digest is not None:
+            metadata = _metadata_key(path, st)
+            if index.canonical(st.st_size, digest, metadata) is None:
+                index.set_canonical(st.st_size, digest, metadata, st.st_ino, path)
+    # files of one inode are all relinked or kept together
+    seen: Dict[int, Optional[Tuple[int, str]]] = {}
+    relinked: Dict[int, int] = {}
+    for path, st in files:
+        digest = digests.get(st.st_ino)
+        if digest is None:
+            continue
+        if st.st_ino not in seen:
+            metadata = _metadata_key(path, st)
+            target = index.canonical(st.st_size, digest, metadata)
+            if target is None:
+                index.set_canonical(st.st_size, digest, metadata, st.st_ino, path)
+            seen[st.st_ino] = target if target is not None and target[0] != st.st_ino else None
+        target = seen[st.st_ino]
+        if target is None:
+            continue
+        if dry_run:
+            print(f"ln -f {target[1]} {path}", file=output_file)
+        else:
+            try:
+                # a digest is only a hint, the bytes decide
+                if not same_contents(target[1], path):
+                    stats.errors.append((path, f"same digest as {target[1]} but different contents"))
+                    continue
+                relink(target[1], path)
+            except OSError as e:
+                # EMLINK: the canonical inode is full, the file stays as it is
+                stats.errors.append((path, str(e)))
+                continue
+        stats.relinked += 1
+        relinked[st.st_ino] = relinked.get(st.st_ino, 0) + 1
+        if relinked[st.st_ino] == st.st_nlink:
+            # the last link of the duplicate is gone, so is its data
+            stats.saved_bytes += st.st_blocks * 512
+    index.db.commit()
+    return [] if dry_run else list(relinked)
+
+
+def _invalidate_inode_indexes(snapshots_path: Path, first_relinked: str, replaced: List[int]) -> None:
+    """
+    Bring the indexes recording inodes in line with relinked snapshots.
+
+    The version index forgets the snapshots from first_relinked on, the
+    next update indexes them again. The verify index forgets the inodes
+    files were relinked away from.
+    """
+    from .datename import Datename
+    from .verify import VerifyIndex
+    from .versions import VersionIndex
+    if (snapshots_path.parent / VersionIndex.index_name).exists():
+        versions = VersionIndex(snapshots_path)
+        try:
+            versions.forget_from(Datename(first_relinked).epoch)
+        finally:
+            versions.close()
+    if (snapshots_path.parent / VerifyIndex.index_name).exists():
+        verify = VerifyIndex(snapshots_path)
+        try:
+            verify.forget_inodes(replaced)
+        finally:
+            verify.close()
+
+
+def dedup_snapshots(snapshots_path: Union[str, Path], min_size: int = 1, hash_workers: Optional[int] = None, scan_workers: int = 16, dry_run: bool = True, progress_file: Optional[IO] = sys.stderr, output_file: IO = sys.stdout) -> DedupStats:
+    """
+    Deduplicate the snapshots not processed yet, oldest first.
+    """
+    snapshots_path = Path(snapshots_path)
+    catalog = SnapshotCatalog(snapshots_path)
+    index = DedupIndex(snapshots_path)
+    stats = DedupStats()
+    try:
+        processed = set(index.processed())
+        index.drop_gone(catalog.names)
+        first_relinked: Optional[str] = None
+        replaced: List[int] = []
+        for name in catalog.names:
+            if name in processed:
+                continue
+            if progress_file is not None:
+                print(f"Deduplicating {name}", file=progress_file, flush=True)
+            relinked = dedup_snapshot(index, snapshots_path / name, stats, min_size, hash_workers, scan_workers, dry_run, output_file)
+            if relinked and first_relinked is None:
+                first_relinked = name
+            replaced += relinked
+            stats.snapshots += 1
+            if not dry_run:
+                with index.db:
+                    index.db.execute("INSERT INTO snapshots (name) VALUES (?)", (name,))
+                # the inodes of the snapshot changed, its cached space accounting is stale
+                space_cache = snapshots_path.parent / ".bkang_space" / f"{name}.npz"
+                if space_cache.exists():
+                    os.unlink(space_cache)
+            if progress_file is not None:
+                print(stats, file=progress_file, flush=True)
+        if first_relinked is not None:
+            _invalidate_inode_indexes(snapshots_path, first_relinked, replaced)
+    finally:
+        index.close()
+    return stats
+
+
+def dedup_main():
+    from .config import update_fargv_dict
+    from .datename import LOCK_TIMEOUT_EXIT
+    from .locks import LockTimeout, archive_job
+    from .tracing import session
+    import fargv
+    p = {
+        "archive_root": "./",
+        "snapshots_name": "snapshots",
+        "min_size": 4096,
+        "hash_workers": os.cpu_count() or 1,
+        "scan_workers": 16,
+        "verbose": 1,
+        "no_dry_run": False,
+        "lock_timeout": 3600.0,
+        "io_class": "best-effort",
+        "io_level": 7,
+        "cpu_nice": 10,
+        "trace_output": "",
+        "fstype": ("btrfs", "hardlinks")
+    }
+    update_fargv_dict(p)
+    args, _ = fargv.fargv(p)
+    if args.fstype != "hardlinks":
+        print("Deduplication relinks files across hard link snapshots, use a btrfs deduplicator (eg. duperemove) for btrfs.", file=sys.stderr)
+        sys.exit(1)
+    if args.no_dry_run:
+        assert args.archive_root.startswith("/"), "Only absolute paths are allowed when not dry running."
+    try:
+        with session(args.trace_output, "dedup"), archive_job(args, "dedup"):
+            stats = dedup_snapshots(Path(args.archive_root) / args.snapshots_name, args.min_size, args.hash_workers, args.scan_workers, dry_run=not args.no_dry_run, progress_file=sys.stderr if args.verbose > 0 else None)
+    except LockTimeout:
+        sys.exit(LOCK_TIMEOUT_EXIT)
+    for path, error in stats.errors:
+        print(f"Error deduplicating {path}: {error}", file=sys.stderr)
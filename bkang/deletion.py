@@ -0,0 +1,183 @@
+import os
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import IO, Callable, Dict, List, Optional, Tuple, Union
+
+
+DELETING_PREFIX = ".bkang-deleting-"
+
+
+class DeletionProgress:
+    """
+    Thread safe counters of a running deletion.
+    """
+    def __init__(self, snapshot_count: int) -> None:
+        self._lock = threading.Lock()
+        self.start_time: float = time.monotonic()
+        self.snapshot_count: int = snapshot_count
+        self.snapshots_done: int = 0
+        self.files: int = 0
+        self.dirs: int = 0
+        self.errors: List[Tuple[str, str]] = []
+
+    def add(self, files: int = 0, dirs: int = 0, snapshots: int = 0) -> None:
+        with self._lock:
+            self.files += files
+            self.dirs += dirs
+            self.snapshots_done += snapshots
+
+    def error(self, path: str, e: Exception) -> None:
+        with self._lock:
+            self.errors.append((path, str(e)))
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    @property
+    def files_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.files / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"[deleted {self.snapshots_done}/{self.snapshot_count} snapshots, {self.files} files, {self.dirs} dirs, {self.files_per_second:.0f} files/s, {len(self.errors)} errors]"
+
+
+def _make_writable(path: str) -> None:
+    mode = os.lstat(path).st_mode
+    os.chmod(path, stat.S_IMODE(mode) | stat.S_IRWXU)
+
+
+def _clear_directory(path: str, progress: DeletionProgress) -> List[str]:
+    """
+    Unlink everything but the subdirectories of path and return the subdirectories.
+    """
+    for attempt in range(2):
+        try:
+            subdirs, names = [], []
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    else:
+                        names.append(entry.name)
+            break
+        except PermissionError:
+            if attempt:
+                raise
+            _make_writable(path)
+    dir_fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        files = 0
+        for name in names:
+            try:
+                os.unlink(name, dir_fd=dir_fd)
+            except PermissionError:
+                # the directory is read only, unlinking needs write access to it
+                _make_writable(path)
+                os.unlink(name, dir_fd=dir_fd)
+            except FileNotFoundError:
+                continue
+            files += 1
+    finally:
+        os.close(dir_fd)
+    progress.add(files=files)
+    return subdirs
+
+
+def _remove_directories(directories: List[Tuple[int, str]], progress: DeletionProgress) -> None:
+    """
+    Remove emptied directories deepest first.
+    """
+    for _, path in sorted(directories, reverse=True):
+        try:
+            os.rmdir(path)
+            progress.add(dirs=1)
+        except OSError as e:
+            progress.error(path, e)
+
+
+def mark_for_deletion(snapshot_path: Union[str, Path]) -> Path:
+    """
+    Atomically rename a snapshot so that it stops being listed as a snapshot.
+    """
+    snapshot_path = Path(snapshot_path)
+    if snapshot_path.name.startswith(DELETING_PREFIX):
+        return snapshot_path
+    marked = snapshot_path.with_name(DELETING_PREFIX + snapshot_path.name)
+    os.rename(snapshot_path, marked)
+    return marked
+
+
+def interrupted_deletions(snapshots_path: Union[str, Path]) -> List[Path]:
+    """
+    Snapshots whose deletion was started but never completed.
+    """
+    with os.scandir(snapshots_path) as it:
+        return sorted(Path(e.path) for e in it if e.name.startswith(DELETING_PREFIX) and e.is_dir(follow_symlinks=False))
+
+
+def delete_snapshots(snapshot_paths: List[Union[str, Path]], workers: int = 16, progress_interval: float = 10.0, progress_file: Optional[IO] = sys.stderr, on_snapshot_deleted: Optional[Callable[[Path], None]] = None) -> DeletionProgress:
+    """
+    Delete snapshot trees concurrently.
+
+    Every snapshot is first renamed out of the way, then its directories are
+    emptied by a bounded thread pool, each task unlinking the files of one
+    directory and handing back its subdirectories. Once all directories of a
+    snapshot are empty they are removed bottom-up. Several snapshots share
+    the same pool, so small and large ones proceed side by side.
+    """
+    snapshot_paths = [Path(p) for p in snapshot_paths]
+    progress = DeletionProgress(len(snapshot_paths))
+    pending: Dict[Future, Tuple[int, int, str]] = {}  # future -> (snapshot, depth, path)
+    outstanding = [0] * len(snapshot_paths)
+    directories: List[List[Tuple[int, str]]] = [[] for _ in snapshot_paths]
+    roots: List[Optional[Path]] = [None] * len(snapshot_paths)
+    finishing: Dict[Future, int] = {}
+    last_report = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bkang-delete") as executor:
+        def submit(snapshot: int, depth: int, path: str) -> None:
+            pending[executor.submit(_clear_directory, path, progress)] = (snapshot, depth, path)
+            outstanding[snapshot] += 1
+            directories[snapshot].append((depth, path))
+
+        def finish(snapshot: int) -> None:
+            finishing[executor.submit(_remove_directories, directories[snapshot], progress)] = snapshot
+
+        for n, snapshot_path in enumerate(snapshot_paths):
+            try:
+                roots[n] = mark_for_deletion(snapshot_path)
+            except OSError as e:
+                progress.error(str(snapshot_path), e)
+                continue
+            submit(n, 0, str(roots[n]))
+        while pending or finishing:
+            done, _ = wait(list(pending) + list(finishing), timeout=progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in finishing:
+                    snapshot = finishing.pop(future)
+                    directories[snapshot] = []
+                    if not roots[snapshot].exists():
+                        progress.add(snapshots=1)
+                        if on_snapshot_deleted is not None:
+                            on_snapshot_deleted(snapshot_paths[snapshot])
+                    continue
+                snapshot, depth, path = pending.pop(future)
+                outstanding[snapshot] -= 1
+                try:
+                    for subdir in future.result():
+                        submit(snapshot, depth + 1, subdir)
+                except OSError as e:
+                    progress.error(path, e)
+                if outstanding[snapshot] == 0:
+                    finish(snapshot)
+            if progress_file is not None and time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                print(progress, file=progress_file, flush=True)
+    if progress_file is not None:
+        print(progress, file=progress_file, flush=True)
+    return progress
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import shlex
+import stat
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple, Union
+
+
+# btrfs gives every subvolume root this inode number
+_BTRFS_SUBVOLUME_INODE = 256
+_FIND_NEW_RE = re.compile(r"^inode \d+ file offset \d+ len \d+ disk start \d+ offset \d+ gen \d+ flags \S+ (.*)$")
+
+
+def _entry_type(mode: int) -> str:
+    if stat.S_ISDIR(mode):
+        return "dir"
+    if stat.S_ISREG(mode):
+        return "file"
+    if stat.S_ISLNK(mode):
+        return "symlink"
+    return "other"
+
+
+def _record(status: str, rel: str, a: Optional[os.stat_result], b: Optional[os.stat_result]) -> Dict:
+    record = {"status": status, "path": rel}
+    for side, st in (("old", a), ("new", b)):
+        if st is not None:
+            record[side] = {"type": _entry_type(st.st_mode), "size": st.st_size, "mtime": st.st_mtime, "inode": st.st_ino}
+    return record
+
+
+def _same_metadata(a: os.stat_result, b: os.stat_result) -> bool:
+    return a.st_mode == b.st_mode and a.st_uid == b.st_uid and a.st_gid == b.st_gid
+
+
+def btrfs_changed_paths(old: Union[str, Path], new: Union[str, Path]) -> Optional[Set[str]]:
+    """
+    Paths of new with data written after the generation of old.
+
+    Uses btrfs subvolume find-new, returns None if old and new are not
+    btrfs subvolumes or the btrfs tool is not usable.
+    """
+    from .util import run_cmd
+    old, new = str(old), str(new)
+    try:
+        if os.lstat(old).st_ino != _BTRFS_SUBVOLUME_INODE or os.lstat(new).st_ino != _BTRFS_SUBVOLUME_INODE:
+            return None
+    except OSError:
+        return None
+    show = run_cmd(f"btrfs subvolume show {shlex.quote(old)}", show_cmd=False, show_output=False)
+    generation = re.search(r"^\s*Generation:\s*(\d+)", show.stdout, re.MULTILINE)
+    if not show.ok or generation is None:
+        return None
+    changed = set()
+
+    def collect(stream: str, line: str) -> None:
+        match = _FIND_NEW_RE.match(line) if stream == "stdout" else None
+        if match is not None:
+            changed.add(match.group(1))
+    # the listing can be huge, it is collected line by line rather than from the output tail
+    find_new = run_cmd(f"btrfs subvolume find-new {shlex.quote(new)} {generation.group(1)}", show_cmd=False, show_output=False, tail_lines=10, on_line=collect)
+    return changed if find_new.ok else None
+
+
+def _diff_directory(old_root: Optional[str], new_root: str, rel: str, changed: Optional[Set[str]], expand: bool) -> Tuple[List[Dict], List[str]]:
+    """
+    Compare one directory of both snapshots.
+
+    Returns the records of its entries and the subdirectories which still
+    need comparing, those present in both or with expand those on one side.
+    """
+    def listing(root: Optional[str]) -> Dict[str, os.DirEntry]:
+        if root is None:
+            return {}
+        try:
+            with os.scandir(os.path.join(root, rel)) as it:
+                return {e.name: e for e in it}
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+    old_entries, new_entries = listing(old_root), listing(new_root)
+    records, subdirs = [], []
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        path = os.path.join(rel, name)
+        old_entry, new_entry = old_entries.get(name), new_entries.get(name)
+        if new_entry is None:
+            records.append(_record("removed", path, old_entry.stat(follow_symlinks=False), None))
+            if expand and old_entry.is_dir(follow_symlinks=False):
+                subdirs.append(path)
+            continue
+        if old_entry is None:
+            records.append(_record("added", path, None, new_entry.stat(follow_symlinks=False)))
+            if expand and new_entry.is_dir(follow_symlinks=False):
+                subdirs.append(path)
+            continue
+        a, b = old_entry.stat(follow_symlinks=False), new_entry.stat(follow_symlinks=False)
+        if stat.S_IFMT(a.st_mode) != stat.S_IFMT(b.st_mode):
+            records.append(_record("modified", path, a, b))
+            if expand and (stat.S_ISDIR(a.st_mode) or stat.S_ISDIR(b.st_mode)):
+                subdirs.append(path)
+            continue
+        if stat.S_ISDIR(a.st_mode):
+            # a directory mtime only says that its entries changed, which the walk reports
+            if not _same_metadata(a, b):
+                records.append(_record("metadata", path, a, b))
+            subdirs.append(path)
+            continue
+        same_content = a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+        if changed is None:
+            # hard link snapshots share the inode of every unchanged file, a new
+            # inode with the same size and mtime is rsync recreating a file whose
+            # mode or owner changed
+            if a.st_ino == b.st_ino:
+                continue
+            records.append(_record("metadata" if same_content else "modified", path, a, b))
+        elif path in changed or not same_content:
+            # btrfs snapshots keep inode numbers, the generation tells what was written
+            records.append(_record("modified", path, a, b))
+        elif not _same_metadata(a, b):
+            records.append(_record("metadata", path, a, b))
+    return records, subdirs
+
+
+def diff_snapshots(old: Union[str, Path, None], new: Union[str, Path], subpath: str = "", workers: int = 8, expand: bool = False) -> Iterator[Dict]:
+    """
+    Yield what changed from snapshot old to snapshot new, one record per entry.
+
+    Both trees are walked together, directories being compared concurrently
+    by a thread pool, and no file content is read. Entries are added,
+    removed, modified or metadata only. With hard link snapshots a file is
+    unchanged if both share an inode, with btrfs snapshots if it was not
+    written since the generation of old and has the same size and mtime.
+    Added and removed directories are reported, their contents only with
+    expand. An old of None compares against an empty snapshot. Records of a
+    directory come together, directories come in completion order.
+    """
+    old, new = (str(old) if old is not None else None), str(new)
+    changed = btrfs_changed_paths(old, new) if old is not None else None
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bkang-diff") as executor:
+        pending: Dict[Future, str] = {executor.submit(_diff_directory, old, new, subpath, changed, expand): subpath}
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                records, subdirs = future.result()
+                for subdir in subdirs:
+                    pending[executor.submit(_diff_directory, old, new, subdir, changed, expand)] = subdir
+                yield from records
+
+
+def diff_main():
+    from .catalog import SnapshotCatalog
+    from .config import update_fargv_dict
+    from .locks import ArchiveLock, archive_lock_path
+    from .tracing import session
+    import fargv
+    p = {
+        "archive_root": "./",
+        "snapshots_name": "snapshots",
+        "old": ("", "Older snapshot name or path, defaults to the second newest snapshot"),
+        "new": ("", "Newer snapshot name or path, defaults to the newest snapshot"),
+        "subpath": ("", "Only compare this directory, relative to the snapshots"),
+        "workers": 8,
+        "expand": (False, "Also report the contents of added and removed directories"),
+        "show_metadata": (False, "Also report entries whose only difference is metadata"),
+        "lock_timeout": 3600.0,
+        "trace_output": "",
+    }
+    update_fargv_dict(p)
+    args, _ = fargv.fargv(p)
+    snapshots_path = Path(args.archive_root) / args.snapshots_name
+    catalog = SnapshotCatalog(snapshots_path)
+    newest = catalog.paths()[-2:]
+    old = Path(args.old) if args.old else (newest[0] if len(newest) == 2 else None)
+    new = Path(args.new) if args.new else (newest[-1] if newest else None)
+    if old is None or new is None:
+        print("Need two snapshots to compare.", file=sys.stderr)
+        sys.exit(1)
+    if not old.is_absolute() and not old.exists():
+        old = snapshots_path / old
+    if not new.is_absolute() and not new.exists():
+        new = snapshots_path / new
+    # a prune must not delete the snapshots being compared
+    with session(args.trace_output, "diff"), ArchiveLock(archive_lock_path(args.archive_root), exclusive=False, timeout=args.lock_timeout, name="diff"):
+        for record in diff_snapshots(old, new, args.subpath.strip("/"), args.workers, args.expand):
+            if record["status"] == "metadata" and not args.show_metadata:
+                continue
+            print(json.dumps(record))
+    sys.stdout.flush()
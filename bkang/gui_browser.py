@@ -1,28 +1,191 @@
+import calendar
 import os
 import sys
 import subprocess
-from typing import Optional
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
 from PySide6.QtWidgets import (
     QSplitter,
     QApplication, QWidget, QVBoxLayout, QHBoxLayout,
     QPushButton, QLineEdit, QLabel, QListWidget, QListWidgetItem,
     QFileDialog, QStackedLayout, QComboBox, QListView, QStyle, QAbstractItemView,
-    QMenu
+    QMenu, QTreeView
 )
 from PySide6.QtGui import QIcon, QKeySequence, QClipboard, QAction, QPixmap, QPainter
-from PySide6.QtCore import Qt, QSize, QEvent
-
-import glob
-from .datename import Datename
+from PySide6.QtCore import Qt, QSize, QEvent, QAbstractItemModel, QAbstractListModel, QModelIndex, QThread, Signal
+
+from .catalog import SnapshotCatalog, newest_snapshot
+from .datename import Datename, _civil_from_days
+from .locks import ArchiveLock, LockTimeout, archive_lock_path
+from .names import NameIndex
+from .tracing import session, span
+from .versions import VersionIndex
 #from PySide6.QtWidgets import QListWidgetItem, QListWidget
 
 
-def get_present_version(p: str) -> Optional[str]:
-    # Dummy placeholder logic — replace with real version check
-    if os.path.exists(p) and p.endswith(".txt"):
-        return p + ".present"
+def get_present_version(p: str, snapshot_root: str, current_root: Optional[str]) -> Optional[str]:
+    """
+    The copy of p, a path inside snapshot_root, in current_root if it still exists.
+    """
+    if current_root is None:
+        return None
+    present = os.path.join(current_root, os.path.relpath(p, snapshot_root))
+    if os.path.lexists(present):
+        return present
     return None
 
+class ListingWorker(QThread):
+    """
+    Lists a directory off the UI thread, handing entries over in batches.
+
+    Entries are told apart from d_type (os.scandir), only symlinks are
+    stat'ed. A cancelled worker stops at the next entry and emits nothing more.
+    With a lock_path the listing holds the archive lock shared, so it waits
+    for a prune instead of listing a snapshot being deleted.
+    """
+    batch = Signal(int, list)
+    done = Signal(int, str)
+
+    def __init__(self, generation: int, folder: str, batch_size: int = 500, batch_interval: float = 0.05, lock_path: Optional[Path] = None, parent=None):
+        super().__init__(parent)
+        self.generation = generation
+        self.folder = folder
+        self.lock_path = lock_path
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        lock = None
+        if self.lock_path is not None:
+            lock = ArchiveLock(self.lock_path, exclusive=False, timeout=0.5, name="browse", progress_file=None)
+            while True:
+                if self._cancelled:
+                    return
+                try:
+                    lock.acquire()
+                    break
+                except LockTimeout:
+                    continue
+        try:
+            with span("ListingWorker.list", folder=self.folder):
+                self._list()
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _list(self):
+        entries: List[Tuple[str, bool]] = []
+        last_emit = time.monotonic()
+        error = ""
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if self._cancelled:
+                        return
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    entries.append((entry.name, is_dir))
+                    if len(entries) >= self.batch_size or time.monotonic() - last_emit >= self.batch_interval:
+                        self.batch.emit(self.generation, entries)
+                        entries = []
+                        last_emit = time.monotonic()
+        except OSError as e:
+            error = str(e)
+        if not self._cancelled:
+            if entries:
+                self.batch.emit(self.generation, entries)
+            self.done.emit(self.generation, error)
+
+
+class SearchWorker(QThread):
+    """
+    Runs a name index query off the UI thread, loading the index on first use.
+    """
+    results = Signal(int, list)
+
+    def __init__(self, generation: int, file_manager: "FileManager", query: str, parent=None):
+        super().__init__(parent)
+        self.generation = generation
+        self.file_manager = file_manager
+        self.query = query
+
+    def run(self):
+        with span("SearchWorker.search", query=self.query):
+            if self.file_manager.names is None:
+                self.file_manager.names = NameIndex(self.file_manager.names_path)
+            found = self.file_manager.names.search(self.query, limit=1000)
+        self.results.emit(self.generation, found)
+
+
+class FileListModel(QAbstractListModel):
+    """
+    The entries of one directory, filled in batches as a listing progresses.
+
+    Icons are only resolved when the view asks for a row, ie. for the rows
+    on screen, and come from a small per kind cache.
+    """
+    def __init__(self, style: QStyle, parent=None):
+        super().__init__(parent)
+        self.style = style
+        self.entries: List[Tuple[str, bool]] = []
+        self._icons = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def _icon(self, kind):
+        if kind not in self._icons:
+            self._icons[kind] = self.style.standardIcon(kind)
+        return self._icons[kind]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        name, is_dir = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return name
+        if role == Qt.DecorationRole:
+            if name == "..":
+                return self._icon(QStyle.SP_FileDialogToParent)
+            return self._icon(QStyle.SP_DirIcon if is_dir else QStyle.SP_FileIcon)
+        return None
+
+    def name(self, index: QModelIndex) -> Optional[str]:
+        if not index.isValid() or index.row() >= len(self.entries):
+            return None
+        return self.entries[index.row()][0]
+
+    def reset(self, entries: List[Tuple[str, bool]]):
+        self.beginResetModel()
+        self.entries = list(entries)
+        self.endResetModel()
+
+    def append(self, entries: List[Tuple[str, bool]]):
+        if not entries:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries) + len(entries) - 1)
+        self.entries.extend(entries)
+        self.endInsertRows()
+
+    def sort_entries(self):
+        """
+        Sort by name once the listing is complete, ".." staying first.
+        """
+        self.layoutAboutToBeChanged.emit()
+        head = [e for e in self.entries[:1] if e[0] == ".."]
+        self.entries = head + sorted(self.entries[len(head):])
+        self.layoutChanged.emit()
+
+
 class FileManager(QWidget):
     def update_window_title(self):
         rel_path = os.path.relpath(self.current_path, self.fake_root)
@@ -46,9 +209,12 @@ class FileManager(QWidget):
         self.update_window_title()
         self.populate_file_list(self.current_path)
     def closeEvent(self, event):
+        for worker in list(self.listing_workers):
+            worker.cancel()
+            worker.wait()
+        for worker in list(self.search_workers):
+            worker.wait()
         QApplication.quit()
-        if self.file_manager:
-            self.file_manager.set_fake_root(item.text())
 
 
 
@@ -57,10 +223,18 @@ class FileManager(QWidget):
             QApplication.quit()
             return True
         return super().eventFilter(obj, event)
-    def __init__(self, root_path):
+    def __init__(self, root_path, versions: Optional[VersionIndex] = None, current_root: Optional[str] = None, names_path: Optional[Path] = None, lock_path: Optional[Path] = None):
         super().__init__()
+        self.lock_path = lock_path
         self.fake_root = root_path
         self.current_path = root_path
+        self.versions = versions
+        self.current_root = current_root
+        # the name index is loaded by the first search
+        self.names: Optional[NameIndex] = None
+        self.names_path = names_path
+        self.search_generation = 0
+        self.search_workers = set()
 
         self.setWindowTitle("Advanced File Manager")
         self.resize(800, 600)
@@ -87,13 +261,30 @@ class FileManager(QWidget):
 
         main_layout.addLayout(top_bar)
 
-        # File view area
-        self.file_view = QListWidget()
+        # Search of the name index, results of every snapshot
+        self.search_edit = QLineEdit()
+        self.search_edit.setPlaceholderText("Search all snapshots, eg. report.xlsx or *.pdf")
+        self.search_edit.returnPressed.connect(self.start_search)
+        self.search_edit.setEnabled(names_path is not None)
+        main_layout.addWidget(self.search_edit)
+        self.search_results = QListWidget()
+        self.search_results.itemDoubleClicked.connect(self.open_search_hit)
+        self.search_results.hide()
+        main_layout.addWidget(self.search_results)
+
+        # File view area, only the visible rows are ever rendered
+        self.listing_generation = 0
+        self.listing_workers = set()
+        self.file_model = FileListModel(self.style(), self)
+        self.file_view = QListView()
+        self.file_view.setModel(self.file_model)
+        self.file_view.setUniformItemSizes(True)
+        self.file_view.setLayoutMode(QListView.Batched)
         self.file_view.setViewMode(QListView.ListMode)
         self.file_view.setIconSize(QSize(64, 64))
         self.file_view.setResizeMode(QListView.Adjust)
         self.file_view.setSelectionMode(QAbstractItemView.SingleSelection)
-        self.file_view.itemDoubleClicked.connect(self.on_item_double_clicked)
+        self.file_view.doubleClicked.connect(self.on_item_double_clicked)
         self.file_view.setContextMenuPolicy(Qt.CustomContextMenu)
         self.file_view.customContextMenuRequested.connect(self.show_context_menu)
 
@@ -122,25 +313,78 @@ class FileManager(QWidget):
             self.file_view.setViewMode(QListView.IconMode)
 
     def populate_file_list(self, folder):
-        self.file_view.clear()
+        # a listing still running for the previous folder is abandoned
+        for worker in self.listing_workers:
+            worker.cancel()
+        self.listing_generation += 1
 
         # Add ".." item if not at fake root
         if os.path.abspath(folder) != os.path.abspath(self.fake_root):
-            up_item = QListWidgetItem("..")
-            up_item.setIcon(self.style().standardIcon(QStyle.SP_FileDialogToParent))
-            self.file_view.addItem(up_item)
+            self.file_model.reset([("..", True)])
+        else:
+            self.file_model.reset([])
+
+        worker = ListingWorker(self.listing_generation, folder, lock_path=self.lock_path)
+        worker.batch.connect(self.on_listing_batch)
+        worker.done.connect(self.on_listing_done)
+        worker.finished.connect(lambda: self.listing_workers.discard(worker))
+        self.listing_workers.add(worker)
+        worker.start()
+
+    def on_listing_batch(self, generation, entries):
+        if generation == self.listing_generation:
+            self.file_model.append(entries)
+
+    def on_listing_done(self, generation, error):
+        if generation != self.listing_generation:
+            return
+        self.file_model.sort_entries()
+        if error:
+            self.file_model.append([(f"Error: {error}", False)])
+
+    def start_search(self):
+        query = self.search_edit.text().strip()
+        self.search_generation += 1
+        if not query:
+            self.search_results.hide()
+            return
+        self.search_results.clear()
+        self.search_results.addItem(QListWidgetItem("Searching..."))
+        self.search_results.show()
+        worker = SearchWorker(self.search_generation, self, query)
+        worker.results.connect(self.on_search_results)
+        worker.finished.connect(lambda: self.search_workers.discard(worker))
+        self.search_workers.add(worker)
+        worker.start()
+
+    def on_search_results(self, generation, hits):
+        if generation != self.search_generation:
+            return
+        self.search_results.clear()
+        for path, names in hits:
+            span = names[0] if len(names) == 1 else f"{names[0]} .. {names[-1]}"
+            item = QListWidgetItem(f"{path}    ({span}, {len(names)} snapshots)")
+            # hits open in the newest snapshot holding them
+            item.setData(Qt.UserRole, (path, names[-1]))
+            self.search_results.addItem(item)
+        if not hits:
+            self.search_results.addItem(QListWidgetItem("No match"))
+
+    def open_search_hit(self, item):
+        hit = item.data(Qt.UserRole)
+        if not hit:
+            return
+        path, snapshot_name = hit
+        self.fake_root = str(self.names_path / snapshot_name)
+        self.current_path = os.path.join(self.fake_root, os.path.dirname(path)) if os.path.dirname(path) else self.fake_root
+        self.path_edit.setText(self.current_path)
+        self.update_window_title()
+        self.populate_file_list(self.current_path)
 
-        try:
-            for item_name in sorted(os.listdir(folder)):
-                item_path = os.path.join(folder, item_name)
-                icon = self.style().standardIcon(QStyle.SP_DirIcon if os.path.isdir(item_path) else QStyle.SP_FileIcon)
-                item = QListWidgetItem(icon, item_name)
-                self.file_view.addItem(item)
-        except Exception as e:
-            self.file_view.addItem(QListWidgetItem(f"Error: {e}"))
-
-    def on_item_double_clicked(self, item):
-        name = item.text()
+    def on_item_double_clicked(self, index):
+        name = self.file_model.name(index)
+        if name is None:
+            return
         if name == "..":
             parent = os.path.dirname(self.current_path)
             if os.path.abspath(parent).startswith(os.path.abspath(self.fake_root)):
@@ -154,10 +398,10 @@ class FileManager(QWidget):
         self.populate_file_list(self.current_path)
 
     def show_context_menu(self, position):
-        item = self.file_view.itemAt(position)
-        if item and item.text() != "..":
-            full_path = os.path.join(self.current_path, item.text())
-            present_version = get_present_version(full_path)
+        name = self.file_model.name(self.file_view.indexAt(position))
+        if name and name != "..":
+            full_path = os.path.join(self.current_path, name)
+            present_version = get_present_version(full_path, self.fake_root, self.current_root)
 
             menu = QMenu()
 
@@ -165,6 +409,17 @@ class FileManager(QWidget):
             open_fm_action = menu.addAction("Open in File Manager")
             open_present_action = menu.addAction("Open in Present")
             open_terminal_action = menu.addAction("Open Terminal Here")
+            versions_menu = menu.addMenu("Versions")
+            version_actions = {}
+            runs = self.versions.versions(os.path.relpath(full_path, self.fake_root)) if self.versions is not None else []
+            snapshot_name = os.path.basename(self.fake_root)
+            for run in reversed(runs):
+                version_action = versions_menu.addAction(run.pretty())
+                version_action.setCheckable(True)
+                # the run holding the version being looked at
+                version_action.setChecked(Datename.is_valid_date_str(snapshot_name) and Datename(run.first_name) <= Datename(snapshot_name) <= Datename(run.last_name))
+                version_actions[version_action] = run
+            versions_menu.setEnabled(len(runs) > 0)
 
             # Enable/disable actions based on availability
             open_present_action.setEnabled(present_version is not None)
@@ -172,73 +427,218 @@ class FileManager(QWidget):
 
             action = menu.exec(self.file_view.mapToGlobal(position))
             if action == copy_action:
-                self.copy_item_path(item)
+                self.copy_item_path(name)
             elif action == open_fm_action:
                 subprocess.run(["xdg-open", os.path.dirname(full_path)])
             elif action == open_present_action and present_version:
                 subprocess.run(["xdg-open", present_version])
             elif action == open_terminal_action:
                 subprocess.run(["gnome-terminal", "--working-directory", os.path.dirname(full_path)])
+            elif action in version_actions:
+                self.set_fake_root(str(self.versions.snapshots_path / version_actions[action].last_name))
 
-    def copy_item_path(self, item):
-        full_path = os.path.join(self.current_path, item.text())
+    def copy_item_path(self, name):
+        full_path = os.path.join(self.current_path, name)
         QApplication.clipboard().setText(full_path)
 
     def copy_selected_item_path(self):
-        selected_items = self.file_view.selectedItems()
-        if selected_items:
-            item = selected_items[0]
-            if item.text() != "..":
-                self.copy_item_path(item)
-
-
-class PathSlider(QListWidget):
+        selected = self.file_view.selectedIndexes()
+        if selected:
+            name = self.file_model.name(selected[0])
+            if name and name != "..":
+                self.copy_item_path(name)
+
+
+class _TimelineNode:
+    """
+    A year, month, day or snapshot of the timeline, covering the snapshots lo to hi.
+    """
+    __slots__ = ("level", "lo", "hi", "parent", "row", "children")
+
+    def __init__(self, level: int, lo: int, hi: int, parent: Optional["_TimelineNode"], row: int):
+        self.level = level
+        self.lo = lo
+        self.hi = hi
+        self.parent = parent
+        self.row = row
+        self.children: Optional[List["_TimelineNode"]] = None
+
+
+class SnapshotTimelineModel(QAbstractItemModel):
+    """
+    The snapshots grouped by year, month and day, newest first.
+
+    Snapshots are kept as arrays sorted newest first, so every group is a
+    contiguous range. Groups are only split into children when expanded and
+    captions are only made for the rows a view shows, so the cost of a
+    catalog is a few vectorized passes whatever its size.
+    """
+    YEAR, MONTH, DAY, SNAPSHOT = range(4)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.snapshots_path: Optional[Path] = None
+        self.names: List[str] = []
+        self.epochs = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros((3, 0), dtype=np.int64)
+        self.root = _TimelineNode(-1, 0, 0, None, 0)
+        self.root.children = []
+
+    def set_catalog(self, catalog: SnapshotCatalog):
+        self.beginResetModel()
+        self.snapshots_path = catalog.snapshots_path
+        self.names = catalog.names[::-1]
+        self.epochs = catalog.epochs[::-1].copy()
+        year, month, day = _civil_from_days(self.epochs // 86400)
+        self.keys = np.stack([year, year * 100 + month, (year * 100 + month) * 100 + day])
+        self.root = _TimelineNode(-1, 0, len(self.names), None, 0)
+        self.root.children = self._split(self.root)
+        self.endResetModel()
+
+    def _split(self, node: _TimelineNode) -> List[_TimelineNode]:
+        level = node.level + 1
+        if level == self.SNAPSHOT:
+            bounds = np.arange(node.lo, node.hi + 1)
+        else:
+            keys = self.keys[level, node.lo:node.hi]
+            bounds = np.concatenate([[0], np.flatnonzero(keys[1:] != keys[:-1]) + 1, [len(keys)]]) + node.lo
+        return [_TimelineNode(level, int(lo), int(hi), node, row) for row, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+    def _node(self, index: QModelIndex) -> _TimelineNode:
+        return index.internalPointer() if index.isValid() else self.root
+
+    def index(self, row, column, parent=QModelIndex()):
+        node = self._node(parent)
+        if node.children is None or not 0 <= row < len(node.children) or column != 0:
+            return QModelIndex()
+        return self.createIndex(row, column, node.children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        node = index.internalPointer().parent
+        if node is None or node is self.root:
+            return QModelIndex()
+        return self.createIndex(node.row, 0, node)
+
+    def rowCount(self, parent=QModelIndex()):
+        node = self._node(parent)
+        return len(node.children) if node.children is not None else 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        return node.level < self.SNAPSHOT and node.hi > node.lo
+
+    def canFetchMore(self, parent):
+        node = self._node(parent)
+        return node.level < self.SNAPSHOT and node.children is None
+
+    def fetchMore(self, parent):
+        node = self._node(parent)
+        if node.children is not None:
+            return
+        children = self._split(node)
+        self.beginInsertRows(parent, 0, len(children) - 1)
+        node.children = children
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        node = index.internalPointer()
+        if role == Qt.UserRole:
+            return str(self.snapshots_path / self.names[node.lo]) if node.level == self.SNAPSHOT else None
+        if role != Qt.DisplayRole:
+            return None
+        if node.level == self.SNAPSHOT:
+            return Datename.from_epoch(self.epochs[node.lo]).pretty()
+        key = int(self.keys[node.level, node.lo])
+        count = node.hi - node.lo
+        if node.level == self.YEAR:
+            return f"{key} ({count})"
+        if node.level == self.MONTH:
+            return f"{calendar.month_name[key % 100]} ({count})"
+        return f"{Datename.from_epoch(self.epochs[node.lo]).to_datetime().strftime('%a %d')} ({count})"
+
+    def newest_index(self) -> QModelIndex:
+        """
+        The newest snapshot, fetching the groups above it.
+        """
+        index = QModelIndex()
+        for _ in range(self.SNAPSHOT + 1):
+            if self.canFetchMore(index):
+                self.fetchMore(index)
+            if self.rowCount(index) == 0:
+                return QModelIndex()
+            index = self.index(0, 0, index)
+        return index
+
+
+class CatalogLoader(QThread):
+    """
+    Refreshes a snapshot catalog off the UI thread.
+    """
+    loaded = Signal(object)
+
+    def __init__(self, snapshots_path: Union[str, Path], parent=None):
+        super().__init__(parent)
+        self.snapshots_path = snapshots_path
+
+    def run(self):
+        with span("CatalogLoader.load"):
+            catalog = SnapshotCatalog(self.snapshots_path)
+        self.loaded.emit(catalog)
+
+
+class TimelineSlider(QTreeView):
     def __init__(self, backdrop, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.backdrop = backdrop
         self.setStyleSheet("background-color: rgba(0, 0, 0, 250); color: white;")
         self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
-        self.itemClicked.connect(self.on_slider_item_selected)
-        self.captions_to_paths = {}
-
-    def populate(self, glob_pattern):
-        self.clear()
-        matches = sorted(glob.glob(glob_pattern))
-        for path in matches:
-            if os.path.isdir(path):
-                caption = Datename.path_to_datename(path).pretty()
-                self.captions_to_paths[caption] = path
-                self.addItem(QListWidgetItem(caption))
-
-    def on_slider_item_selected(self, item):
+        self.setHeaderHidden(True)
+        self.setUniformRowHeights(True)
+        self.timeline = SnapshotTimelineModel(self)
+        self.setModel(self.timeline)
+        self.clicked.connect(self.on_slider_item_selected)
+
+    def populate(self, catalog: SnapshotCatalog):
+        self.timeline.set_catalog(catalog)
+        newest = self.timeline.newest_index()
+        if newest.isValid():
+            self.scrollTo(newest)
+            self.setCurrentIndex(newest)
+
+    def on_slider_item_selected(self, index):
+        path = self.timeline.data(index, Qt.UserRole)
+        if path is None:
+            self.setExpanded(index, not self.isExpanded(index))
+            return
         if self.backdrop.file_manager:
-            caption = item.text()
-            path = self.captions_to_paths.get(caption)
             self.backdrop.file_manager.set_fake_root(path)
             self.backdrop.file_manager.raise_()
             self.backdrop.file_manager.activateWindow()
 
 
 class FullscreenBackdrop(QWidget):
-    def on_slider_item_selected(self, item):
-        if self.file_manager:
-            self.file_manager.set_fake_root(item.text())
-            self.file_manager.raise_()
-            self.file_manager.activateWindow()
-
-    def __init__(self, wallpaper_path: Optional[str] = None, file_manager: Optional[FileManager] = None, glob_pattern: Optional[str] = None):
+    def __init__(self, wallpaper_path: Optional[str] = None, file_manager: Optional[FileManager] = None, snapshots_path: Union[str, Path] = "./"):
         super().__init__()
         self.wallpaper = wallpaper_path
         self.file_manager = file_manager
-        self.glob_pattern = glob_pattern or "*"
+        self.snapshots_path = snapshots_path
+        self.catalog: Optional[SnapshotCatalog] = None
 
-        self.slider = PathSlider(self, self)
+        self.slider = TimelineSlider(self, self)
         self.slider.setFixedWidth(int(self.width() * 0.31))
         self.slider.move(0, 0)
-        self.slider.populate(self.glob_pattern)
         self.setWindowFlags(Qt.Window | Qt.CustomizeWindowHint | Qt.WindowTitleHint | Qt.WindowCloseButtonHint)
         self.setWindowTitle("Time Machine Style")
         self.installEventFilter(self)
+        self.loader: Optional[CatalogLoader] = None
+        self.populate_slider()
 
     def resizeEvent(self, event):
         if self.slider:
@@ -259,33 +659,54 @@ class FullscreenBackdrop(QWidget):
         return super().eventFilter(obj, event)
 
     def populate_slider(self):
-        matches = sorted(glob.glob(self.glob_pattern))
-        for path in matches:
-            if os.path.isdir(path):
-                self.slider.addItem(QListWidgetItem(path))
+        """
+        Load the catalog in the background, the slider fills in once it is read.
+        """
+        if self.loader is not None and self.loader.isRunning():
+            return
+        self.loader = CatalogLoader(self.snapshots_path, self)
+        self.loader.loaded.connect(self.on_catalog_loaded)
+        self.loader.start()
+
+    def on_catalog_loaded(self, catalog):
+        self.catalog = catalog
+        self.slider.populate(catalog)
 
 
 def main_browse_gui():
     from .config import update_fargv_dict
     import fargv
-    import glob
     p = {
         "archive_root": "./",
         "current_name": "current",
         "snapshots_name": "snapshots",
-        "date_glob": "*-*-*-*-*-*",
+        "trace_output": "",
     }
     update_fargv_dict(p)
     args, _ = fargv.fargv(p)
-    snapshot_glob = f"{args.archive_root}/{args.snapshots_name}/{args.date_glob}"
+    with session(args.trace_output, "browse"):
+        returncode = _browse(args)
+    sys.exit(returncode)
+
+
+def _browse(args) -> int:
+    snapshots_path = Path(args.archive_root) / args.snapshots_name
+    versions = None
+    if (Path(args.archive_root) / VersionIndex.index_name).exists():
+        # the browser only reads the index, snapshot and prune jobs keep it up to date
+        versions = VersionIndex(snapshots_path, readonly=True)
     app = QApplication(sys.argv)
     #fake_root = QFileDialog.getExistingDirectory(None, "Select Fake Root")
-    fake_root = list(glob.glob(snapshot_glob))[-1]
+    # the newest snapshot opens right away, the timeline is loaded in the background
+    newest = newest_snapshot(snapshots_path)
+    fake_root = str(newest) if newest is not None else None
     #wallpaper = QFileDialog.getOpenFileName(None, "Select Background Wallpaper", "", "Images (*.png *.jpg *.jpeg *.bmp)")[0]
     wallpaper = "/usr/share/backgrounds/Milkyway_by_mizuno_as.png"
   
     if fake_root:
-        manager = FileManager(fake_root)
+        names_path = snapshots_path if (Path(args.archive_root) / NameIndex.index_name).exists() else None
+        lock_path = archive_lock_path(args.archive_root)
+        manager = FileManager(fake_root, versions=versions, current_root=os.path.join(args.archive_root, args.current_name), names_path=names_path, lock_path=lock_path if lock_path.parent == Path(args.archive_root) else None)
         manager.installEventFilter(manager)
         screen = app.primaryScreen().geometry()
         manager.resize(1280, 1024)
@@ -293,7 +714,7 @@ def main_browse_gui():
             screen.center().x() - manager.width() // 2,
             screen.center().y() - manager.height() // 2
         )
-        backdrop = FullscreenBackdrop(wallpaper_path=wallpaper, file_manager=manager, glob_pattern=snapshot_glob)
+        backdrop = FullscreenBackdrop(wallpaper_path=wallpaper, file_manager=manager, snapshots_path=snapshots_path)
         # Show backdrop fullscreen
         backdrop.showFullScreen()
 
@@ -303,7 +724,8 @@ def main_browse_gui():
         manager.raise_()
         manager.activateWindow()
 
-        sys.exit(app.exec())
+        return app.exec()
+    return 0
 
 
 if __name__ == "__main__":
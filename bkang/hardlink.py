@@ -0,0 +1,210 @@
+import errno
+import os
+import shutil
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+from .deletion import DELETING_PREFIX
+
+
+CREATING_PREFIX = ".bkang-creating-"
+
+
+class LinkProgress:
+    """
+    Thread safe counters of a running snapshot creation.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.start_time: float = time.monotonic()
+        self.files: int = 0
+        self.dirs: int = 0
+        self.copied: int = 0
+        self.errors: List[Tuple[str, str]] = []
+
+    def add(self, files: int = 0, dirs: int = 0, copied: int = 0) -> None:
+        with self._lock:
+            self.files += files
+            self.dirs += dirs
+            self.copied += copied
+
+    def error(self, path: str, e: Exception) -> None:
+        with self._lock:
+            self.errors.append((path, str(e)))
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    @property
+    def files_per_second(self) -> float:
+        elapsed = self.elapsed
+        return self.files / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return f"[linked {self.files} files, {self.dirs} dirs, {self.copied} copied, {self.files_per_second:.0f} files/s, {len(self.errors)} errors]"
+
+
+def _copy_entry(src: str, dst: str, st: os.stat_result) -> None:
+    """
+    Copy a non directory entry that could not be hard linked (eg. EMLINK).
+    """
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dst)
+    elif stat.S_ISREG(st.st_mode):
+        shutil.copyfile(src, dst, follow_symlinks=False)
+    else:
+        os.mknod(dst, st.st_mode, st.st_rdev)
+    _copy_metadata(src, dst, st)
+
+
+def _copy_metadata(src: str, dst: str, st: os.stat_result) -> None:
+    """
+    Owner, mode, xattrs and timestamps of src onto dst, without following symlinks.
+    """
+    try:
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    except PermissionError:
+        pass  # like cp -a, ownership is only preserved when allowed
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(dst, stat.S_IMODE(st.st_mode))
+    try:
+        for name in os.listxattr(src, follow_symlinks=False):
+            try:
+                os.setxattr(dst, name, os.getxattr(src, name, follow_symlinks=False), follow_symlinks=False)
+            except PermissionError:
+                pass  # trusted.* and security.* need privileges
+    except OSError as e:
+        if e.errno not in (errno.ENOTSUP, errno.EOPNOTSUPP):
+            raise
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+
+def _link_directory(src: str, dst: str, progress: LinkProgress) -> List[Tuple[str, str]]:
+    """
+    Hard link every non directory entry of src into dst and create the
+    subdirectories, which are returned for the pool to descend into.
+    """
+    subdirs = []
+    files = copied = 0
+    with os.scandir(src) as it:
+        for entry in it:
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                # owner only until the metadata fix-up, so a read only
+                # source directory can still be filled
+                os.mkdir(target, 0o700)
+                subdirs.append((entry.path, target))
+                continue
+            try:
+                # symlinks, fifos, sockets and devices are linked as they are
+                os.link(entry.path, target, follow_symlinks=False)
+                files += 1
+            except OSError as e:
+                if e.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
+                    raise
+                _copy_entry(entry.path, target, entry.stat(follow_symlinks=False))
+                copied += 1
+    progress.add(files=files, copied=copied)
+    return subdirs
+
+
+def _fix_directory(src: str, dst: str, progress: LinkProgress) -> None:
+    # setting metadata on a directory does not modify its parent so the
+    # fix-up order does not matter, as long as the tree is complete
+    _copy_metadata(src, dst, os.lstat(src))
+    progress.add(dirs=1)
+
+
+def link_tree(src: Union[str, Path], dst: Union[str, Path], workers: int = 16, progress_interval: float = 10.0, progress_file: Optional[IO] = sys.stderr) -> LinkProgress:
+    """
+    Recreate the directory tree src at dst with every file hard linked, like cp --link -a.
+
+    Directories are handed to a thread pool as they are discovered, idle
+    workers pick up whichever directory is queued next. Directory metadata
+    (owner, mode, xattrs, timestamps) is applied once all entries exist, so
+    directory mtimes are those of src.
+    """
+    src, dst = str(src), str(dst)
+    progress = LinkProgress()
+    os.mkdir(dst, 0o700)
+    directories: List[Tuple[str, str]] = [(src, dst)]
+    pending: Dict[Future, Tuple[str, str]] = {}
+    last_report = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bkang-link") as executor:
+        pending[executor.submit(_link_directory, src, dst, progress)] = (src, dst)
+        while pending:
+            done, _ = wait(list(pending), timeout=progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                src_dir, _ = pending.pop(future)
+                try:
+                    subdirs = future.result()
+                except OSError as e:
+                    progress.error(src_dir, e)
+                    continue
+                for src_sub, dst_sub in subdirs:
+                    directories.append((src_sub, dst_sub))
+                    pending[executor.submit(_link_directory, src_sub, dst_sub, progress)] = (src_sub, dst_sub)
+            if progress_file is not None and time.monotonic() - last_report >= progress_interval:
+                last_report = time.monotonic()
+                print(progress, file=progress_file, flush=True)
+        fixes = {executor.submit(_fix_directory, s, d, progress): s for s, d in directories}
+        for future, src_dir in fixes.items():
+            try:
+                future.result()
+            except OSError as e:
+                progress.error(src_dir, e)
+    if progress_file is not None:
+        print(progress, file=progress_file, flush=True)
+    return progress
+
+
+def abandoned_creations(snapshots_path: Union[str, Path], newest_snapshot: Optional[str]) -> List[Path]:
+    """
+    Snapshots whose creation was started before newest_snapshot and never completed.
+
+    They are left by a crash during create_hardlink_snapshot or by a linkdest
+    sync that failed. A leftover named after the newest snapshot may still
+    be filled (a client's sync does not hold the lock of the archive host)
+    and is resumed by the next linkdest sync, so it is not returned.
+    """
+    if newest_snapshot is None:
+        return []
+    from .datename import Datename
+    newest = Datename(newest_snapshot)
+    leftovers = []
+    with os.scandir(snapshots_path) as it:
+        for entry in it:
+            if not entry.name.startswith(CREATING_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                continue
+            try:
+                started = Datename(entry.name[len(CREATING_PREFIX):])
+            except ValueError:
+                continue
+            if started < newest:
+                leftovers.append(Path(entry.path))
+    return sorted(leftovers)
+
+
+def create_hardlink_snapshot(current_path: Union[str, Path], snapshot_path: Union[str, Path], workers: int = 16, progress_file: Optional[IO] = sys.stderr) -> LinkProgress:
+    """
+    Create snapshot_path as a hard linked copy of current_path.
+
+    The tree is built under a temporary name next to snapshot_path and
+    atomically renamed once complete, so a snapshot is never seen half made.
+    A failed attempt is renamed for deletion and cleaned up by the next
+    prune, as is the tree of a crashed one (see abandoned_creations).
+    """
+    snapshot_path = Path(snapshot_path)
+    tmp_path = snapshot_path.with_name(CREATING_PREFIX + snapshot_path.name)
+    progress = link_tree(current_path, tmp_path, workers=workers, progress_file=progress_file)
+    if progress.errors:
+        os.rename(tmp_path, tmp_path.with_name(DELETING_PREFIX + tmp_path.name))
+        return progress
+    os.rename(tmp_path, snapshot_path)
+    return progress
@@ -0,0 +1,194 @@
+import fcntl
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Optional, Union
+
+
+LOCK_NAME = ".bkang.lock"
+IO_CLASSES = {"": None, "none": "0", "realtime": "1", "best-effort": "2", "idle": "3"}
+
+
+class LockTimeout(TimeoutError):
+    pass
+
+
+def archive_lock_path(archive_root: Union[str, Path], archive_address: Optional[str] = None) -> Path:
+    """
+    The lock file shared by every job on the archive at archive_root.
+
+    It lives in the archive so that jobs started by any user or container
+    agree on it. An archive on another host (client mode) gets a local lock
+    in the temporary directory keyed on its address, which only orders the
+    jobs of this host.
+    """
+    archive_root = Path(archive_root)
+    local = archive_address in (None, "", "localhost", "127.0.0.1") and archive_root.is_dir()
+    if local and (os.access(archive_root, os.W_OK) or (archive_root / LOCK_NAME).exists()):
+        return archive_root / LOCK_NAME
+    key = hashlib.sha1(f"{archive_address}:{archive_root}".encode()).hexdigest()[:12]
+    return Path(tempfile.gettempdir()) / f"bkang-{key}.lock"
+
+
+class ArchiveLock:
+    """
+    A shared or exclusive flock on an archive, waited for in a queue.
+
+    Readers (browsing, diffs) share the lock, jobs that write to the archive
+    (sync, snapshot, prune, dedup) hold it exclusively. Every locker first
+    passes through a turnstile, a second lock file that a waiting exclusive
+    locker keeps closed, so a stream of readers can not starve a writer and
+    writers get the archive in turn. A timeout of None waits forever.
+    """
+    poll_interval = 0.05
+    max_poll_interval = 0.5
+
+    def __init__(self, lock_path: Union[str, Path], exclusive: bool = True, timeout: Optional[float] = None, name: str = "", progress_file: Optional[IO] = sys.stderr) -> None:
+        self.lock_path: Path = Path(lock_path)
+        self.exclusive: bool = exclusive
+        self.timeout: Optional[float] = timeout
+        self.name: str = name
+        self.progress_file: Optional[IO] = progress_file
+        self._file: Optional[IO] = None
+
+    def _flock(self, f: IO, operation: int, deadline: Optional[float]) -> None:
+        interval, reported = self.poll_interval, False
+        while True:
+            try:
+                fcntl.flock(f, operation | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+            if deadline is not None and time.monotonic() >= deadline:
+                raise LockTimeout(f"Timed out after {self.timeout}s waiting for {self.lock_path} ({self.holder()})")
+            if not reported and self.progress_file is not None:
+                print(f"[Waiting for {self.lock_path}: {self.holder()}]", file=self.progress_file, flush=True)
+                reported = True
+            time.sleep(interval if deadline is None else max(0.0, min(interval, deadline - time.monotonic())))
+            interval = min(interval * 2, self.max_poll_interval)
+
+    def holder(self) -> str:
+        """
+        What the last exclusive holder wrote in the lock file.
+        """
+        try:
+            return self.lock_path.read_text().strip() or "shared"
+        except OSError:
+            return "unknown"
+
+    @staticmethod
+    def _open(path: Path) -> IO:
+        try:
+            return open(path, "a+")
+        except PermissionError:
+            # flock needs no write access, a reader of someone else's archive still queues
+            return open(path, "r")
+
+    def acquire(self) -> None:
+        deadline = time.monotonic() + self.timeout if self.timeout is not None and self.timeout >= 0 else None
+        turnstile = self._open(self.lock_path.with_name(self.lock_path.name + ".queue"))
+        try:
+            self._flock(turnstile, fcntl.LOCK_EX, deadline)
+            f = self._open(self.lock_path)
+            try:
+                self._flock(f, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH, deadline)
+            except BaseException:
+                f.close()
+                raise
+        finally:
+            # closing the turnstile lets the next waiter in
+            turnstile.close()
+        if self.exclusive:
+            f.truncate(0)
+            f.write(f"{self.name or 'exclusive'} pid {os.getpid()} since {time.strftime('%Y-%m-%d %H:%M:%S')}\n")
+            f.flush()
+        self._file = f
+        if self.progress_file is not None:
+            print(f"[Lock acquired: {self.name} {'exclusive' if self.exclusive else 'shared'} {self.lock_path}]", file=self.progress_file, flush=True)
+
+    def release(self) -> None:
+        if self._file is None:
+            return
+        if self.exclusive:
+            self._file.truncate(0)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self) -> "ArchiveLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+    def __repr__(self) -> str:
+        return f"ArchiveLock({str(self.lock_path)}, {'exclusive' if self.exclusive else 'shared'})"
+
+
+_lowered = threading.local()
+
+
+@contextmanager
+def job_priority(io_class: str = "", io_level: int = 7, cpu_nice: int = 0) -> Iterator[None]:
+    """
+    Run the calling thread, and the threads and processes it starts, at a lower priority.
+
+    Both priorities are per thread on linux and are not restored: an
+    unprivileged process cannot raise its priority back. A long running
+    caller (the daemon) runs every job on a thread of its own, lowering the
+    priority of a thread twice raises RuntimeError.
+    """
+    if io_class not in IO_CLASSES:
+        raise ValueError(f"Invalid io_class: {io_class}. Expected one of {', '.join(IO_CLASSES)}")
+    if cpu_nice <= 0 and IO_CLASSES[io_class] is None:
+        yield
+        return
+    if getattr(_lowered, "job", None) is not None:
+        raise RuntimeError(f"The priority of this thread was already lowered for {_lowered.job}, run every job on a thread of its own")
+    tid = threading.get_native_id()
+    if cpu_nice > 0:
+        os.setpriority(os.PRIO_PROCESS, tid, min(19, os.getpriority(os.PRIO_PROCESS, tid) + cpu_nice))
+    if IO_CLASSES[io_class] is not None:
+        ionice = ["ionice", "-c", IO_CLASSES[io_class]] + (["-n", str(io_level)] if io_class in ("realtime", "best-effort") else []) + ["-p", str(tid)]
+        try:
+            subprocess.run(ionice, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            print("ionice is not available, the I/O priority is unchanged", file=sys.stderr)
+    _lowered.job = f"{io_class or 'unchanged'} I/O, nice +{max(0, cpu_nice)}"
+    yield
+
+
+@contextmanager
+def archive_job(args, name: str, exclusive: bool = True, metrics: Optional["RunMetrics"] = None) -> Iterator[None]:
+    """
+    Hold the archive lock and lower the priority for a job configured by args.
+
+    The arguments provide archive_root, no_dry_run, lock_timeout, io_class,
+    io_level and cpu_nice, and archive_address for a remote archive. Dry
+    runs take no lock. Raises LockTimeout when the lock is not obtained.
+    The wait is recorded as the lock_wait phase of metrics.
+    """
+    if not args.no_dry_run:
+        yield
+        return
+    lock = ArchiveLock(archive_lock_path(args.archive_root, getattr(args, "archive_address", None)), exclusive, args.lock_timeout, name)
+    try:
+        if metrics is not None:
+            with metrics.phase("lock_wait"):
+                lock.acquire()
+        else:
+            lock.acquire()
+    except LockTimeout as e:
+        print(f"[{name} not run: {e}]", file=sys.stderr)
+        raise
+    try:
+        with job_priority(args.io_class, args.io_level, args.cpu_nice):
+            yield
+    finally:
+        lock.release()
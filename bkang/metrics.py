@@ -0,0 +1,152 @@
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Union
+
+from .tracing import span
+
+
+class RunMetrics:
+    """
+    Phase timings, counts and the exit code of one run of a job.
+
+    Phases accumulate, a phase entered twice (eg. one transfer per rsync)
+    reports the sum of its durations. Every phase is also a tracing span.
+    """
+    def __init__(self, job: str, labels: Optional[Dict[str, str]] = None) -> None:
+        self.job: str = job
+        self.labels: Dict[str, str] = dict(labels or {})
+        self.start_time: float = time.time()
+        self._start: float = time.monotonic()
+        self.seconds: Optional[float] = None
+        self.exit_code: Optional[int] = None
+        self.phases: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            with span(name, job=self.job):
+                yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counts[name] = self.counts.get(name, 0) + int(value)
+
+    def finish(self, exit_code: Optional[int] = None) -> None:
+        if exit_code is not None:
+            self.exit_code = exit_code
+        self.seconds = time.monotonic() - self._start
+
+    def record(self) -> Dict:
+        return {
+            "job": self.job,
+            "labels": self.labels,
+            "start": self.start_time,
+            "seconds": self.seconds,
+            "exit_code": self.exit_code,
+            "phases": self.phases,
+            "counts": self.counts,
+        }
+
+    def write_jsonl(self, path: Union[str, Path]) -> None:
+        """
+        Append the run as one json line, a single write so concurrent jobs do not interleave.
+        """
+        line = json.dumps(self.record()) + "\n"
+        with open(path, "a") as f:
+            f.write(line)
+
+    def prometheus(self, last_success: Optional[float] = None) -> str:
+        """
+        The run in the prometheus text exposition format.
+        """
+        labels = {"job": self.job, **self.labels}
+
+        def sample(name: str, value: float, **extra: str) -> str:
+            label_str = ",".join(f'{k}="{_escape(str(v))}"' for k, v in {**labels, **extra}.items())
+            return f"{name}{{{label_str}}} {value}"
+        lines = []
+
+        def gauge(name: str, help: str, samples) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.extend(samples)
+        gauge("bkang_job_last_run_timestamp_seconds", "When the last run of the job started.", [sample("bkang_job_last_run_timestamp_seconds", self.start_time)])
+        if last_success is not None:
+            gauge("bkang_job_last_success_timestamp_seconds", "When the last successful run of the job started.", [sample("bkang_job_last_success_timestamp_seconds", last_success)])
+        gauge("bkang_job_duration_seconds", "Wall time of the last run of the job.", [sample("bkang_job_duration_seconds", self.seconds or 0.0)])
+        gauge("bkang_job_exit_code", "Exit code of the last run of the job.", [sample("bkang_job_exit_code", self.exit_code if self.exit_code is not None else -1)])
+        if self.phases:
+            gauge("bkang_job_phase_seconds", "Wall time of each phase of the last run of the job.", [sample("bkang_job_phase_seconds", v, phase=k) for k, v in sorted(self.phases.items())])
+        if self.counts:
+            gauge("bkang_job_count", "What the last run of the job processed.", [sample("bkang_job_count", v, count=k) for k, v in sorted(self.counts.items())])
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, directory: Union[str, Path]) -> Path:
+        """
+        Atomically replace bkang_<job>.prom in a node exporter textfile collector directory.
+
+        The last success timestamp is carried over from the previous file when the run failed.
+        """
+        path = Path(directory) / f"bkang_{self.job}.prom"
+        last_success = self.start_time if self.exit_code == 0 else _read_last_success(path)
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus(last_success))
+        os.replace(tmp_path, path)
+        return path
+
+    def export(self, jsonl_path: str = "", textfile_dir: str = "") -> None:
+        if jsonl_path:
+            self.write_jsonl(jsonl_path)
+        if textfile_dir:
+            self.write_textfile(textfile_dir)
+
+    def __repr__(self) -> str:
+        return f"RunMetrics({self.job}, exit_code={self.exit_code}, seconds={self.seconds})"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+_LAST_SUCCESS_RE = re.compile(r"^bkang_job_last_success_timestamp_seconds\{.*\} (\S+)$", re.MULTILINE)
+
+
+def _read_last_success(path: Path) -> Optional[float]:
+    try:
+        match = _LAST_SUCCESS_RE.search(path.read_text())
+    except OSError:
+        return None
+    return float(match.group(1)) if match else None
+
+
+@contextmanager
+def job_metrics(args, job: str) -> Iterator[RunMetrics]:
+    """
+    Collect the metrics of a job configured by args and export them when it ends.
+
+    The caller sets exit_code, an exception leaves 1. Only real runs are
+    exported, to args.metrics_jsonl and args.metrics_textfile_dir.
+    """
+    metrics = RunMetrics(job, {"archive": str(args.archive_root)})
+    try:
+        yield metrics
+    except BaseException:
+        if metrics.exit_code is None:
+            metrics.exit_code = 1
+        raise
+    finally:
+        metrics.finish()
+        if args.no_dry_run:
+            try:
+                metrics.export(args.metrics_jsonl, args.metrics_textfile_dir)
+            except OSError as e:
+                import sys
+                print(f"Could not export the metrics of {job}: {e}", file=sys.stderr)
@@ -0,0 +1,393 @@
+import os
+import re
+import sys
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .catalog import SnapshotCatalog
+from .datename import Datename
+from .diff import diff_snapshots
+
+
+_GLOB_CHARS = re.compile(r"[*?\[]")
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """
+    A glob where * and ? stop at slashes and ** does not.
+    """
+    regex, i = "", 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            end = pattern.find("]", i + 2 if pattern.startswith("[!", i) or pattern.startswith("[]", i) else i + 1)
+            if end < 0:
+                regex += re.escape(c)
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body.replace(chr(92), chr(92) * 2)}]"
+                i = end + 1
+                continue
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+
+def compile_query(query: str) -> Tuple[re.Pattern, str]:
+    """
+    The regex matching relative paths for query and a literal every match contains in its name.
+
+    A query without wildcards is a substring of the name, a glob matches
+    the trailing components of the path, eg. "*.xlsx" or "docs/*/report*".
+    Matching ignores case.
+    """
+    query = query.strip("/")
+    if not _GLOB_CHARS.search(query):
+        query = f"*{query}*"
+    regex = re.compile(r"(?:^|/)" + _glob_to_regex(query) + r"\Z", re.IGNORECASE | re.DOTALL)
+    # only the last component has to be in the name, the trigrams index names
+    name_pattern = query.rsplit("/", 1)[-1]
+    literals = [] if "**" in name_pattern else re.split(r"\[[^\]]*\]|[*?]", name_pattern)
+    return regex, max(literals, key=len, default="")
+
+
+def _fold(name: bytes) -> bytes:
+    """
+    The case folded name, the same folding for indexed names and queries.
+    """
+    return os.fsencode(os.fsdecode(name).casefold())
+
+
+def _trigram_keys(names: List[bytes], ids: np.ndarray) -> np.ndarray:
+    """
+    Sorted distinct (trigram << 32 | id) keys of the case folded names.
+    """
+    if len(names) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    names = [_fold(n) for n in names]
+    data = np.frombuffer(b"\0".join(names) + b"\0", dtype=np.uint8).astype(np.uint64)
+    owners = np.repeat(ids.astype(np.uint64), [len(n) + 1 for n in names])
+    valid = (data[:-2] != 0) & (data[1:-1] != 0) & (data[2:] != 0)
+    codes = (data[:-2] << 16) | (data[1:-1] << 8) | data[2:]
+    keys = np.sort((codes[valid] << np.uint64(32)) | owners[:-2][valid])
+    # sort and drop repeats, much faster than np.unique on large arrays
+    return keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+
+
+def _trigrams(literal: bytes) -> List[int]:
+    literal = _fold(literal)
+    return sorted({(literal[i] << 16) | (literal[i + 1] << 8) | literal[i + 2] for i in range(len(literal) - 2)})
+
+
+def _epoch(snapshot_name: str) -> int:
+    return Datename(snapshot_name).epoch
+
+
+def _save_array(path: Path, array: np.ndarray) -> None:
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class NameIndex:
+    """
+    Every path of every snapshot, searchable by name.
+
+    Distinct relative paths are stored once, NUL separated in paths.bin and
+    numbered by their position. Every snapshot is a sorted array of the
+    numbers of its paths, derived from the array of the previous snapshot
+    and the diff between both, so adding a snapshot costs a diff rather than
+    a walk. Names are indexed by trigram, a query only checks the paths
+    whose name holds every trigram of its longest literal and then looks
+    the hits up in each snapshot array, which are memory mapped. Once
+    pruning leaves more than compact_fraction of the paths in no snapshot,
+    they are dropped and the rest renumbered.
+    """
+    version = 2
+    index_name = ".bkang_names"
+
+    def __init__(self, snapshots_path: Union[str, Path], index_path: Union[str, Path, None] = None) -> None:
+        self.snapshots_path: Path = Path(snapshots_path)
+        if index_path is None:
+            index_path = self.snapshots_path.parent / self.index_name
+        self.index_path: Path = Path(index_path)
+        self._ids: Optional[Dict[bytes, int]] = None
+        self._snapshots: Dict[str, np.ndarray] = {}
+        self.load()
+
+    def _read_version(self) -> Optional[int]:
+        try:
+            return int((self.index_path / "version").read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_version(self, version: Optional[int]) -> None:
+        if version is None:
+            (self.index_path / "version").unlink(missing_ok=True)
+        else:
+            (self.index_path / "version").write_text(f"{version}\n")
+
+    def load(self) -> None:
+        try:
+            if self._read_version() != self.version:
+                # an older format or an interrupted compaction, update() starts over
+                raise ValueError(self.index_path)
+            self.offsets = np.load(self.index_path / "offsets.npy")
+            self.trigram_keys = np.load(self.index_path / "trigrams.npy", mmap_mode="r")
+            with open(self.index_path / "paths.bin", "rb") as f:
+                self.blob = f.read(int(self.offsets[-1]))
+        except (OSError, ValueError):
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.trigram_keys = np.zeros(0, dtype=np.uint64)
+            self.blob = b""
+        self._ids = None
+
+    def snapshot_names(self) -> List[str]:
+        if self._read_version() != self.version:
+            return []
+        try:
+            names = [n[:-len(".npy")] for n in os.listdir(self.index_path / "snapshots") if n.endswith(".npy")]
+        except FileNotFoundError:
+            return []
+        return sorted(names, key=_epoch)
+
+    def _snapshot_ids(self, name: str) -> np.ndarray:
+        # snapshot arrays never change once written, the mappings are reused across queries
+        if name not in self._snapshots:
+            self._snapshots[name] = np.load(self.index_path / "snapshots" / f"{name}.npy", mmap_mode="r")
+        return self._snapshots[name]
+
+    def path(self, path_id: int) -> str:
+        return os.fsdecode(self.blob[self.offsets[path_id]:self.offsets[path_id + 1] - 1])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def update(self, catalog: Optional[SnapshotCatalog] = None, workers: int = 8, compact_fraction: float = 0.25, progress_file: Optional[IO] = sys.stderr) -> Tuple[int, int]:
+        """
+        Index the snapshots not indexed yet and forget the deleted ones.
+
+        Returns how many snapshots were added and removed.
+        """
+        if catalog is None:
+            catalog = SnapshotCatalog(self.snapshots_path)
+        (self.index_path / "snapshots").mkdir(parents=True, exist_ok=True)
+        if self._read_version() != self.version:
+            for stale in (self.index_path / "snapshots").glob("*.npy"):
+                os.unlink(stale)
+            for name in ("paths.bin", "offsets.npy", "trigrams.npy"):
+                (self.index_path / name).unlink(missing_ok=True)
+            self._snapshots.clear()
+            self._write_version(self.version)
+            self.load()
+        indexed = self.snapshot_names()
+        present = set(catalog.names)
+        removed = [n for n in indexed if n not in present]
+        for name in removed:
+            self._snapshots.pop(name, None)
+            os.unlink(self.index_path / "snapshots" / f"{name}.npy")
+        indexed = [n for n in indexed if n in present]
+        if removed:
+            self._compact(indexed, compact_fraction, progress_file)
+        if self._ids is None:
+            self._ids = {p: n for n, p in enumerate(self.blob.split(b"\0")[:-1])}
+        new_paths: List[bytes] = []
+
+        def path_id(path: str) -> int:
+            encoded = os.fsencode(path)
+            if encoded not in self._ids:
+                self._ids[encoded] = len(self._ids)
+                new_paths.append(encoded)
+            return self._ids[encoded]
+        done = set(indexed)
+        added = [n for n in catalog.names if n not in done]
+        for name in added:
+            epoch = _epoch(name)
+            # the diff is taken against the newest indexed snapshot older than this one
+            base = max((n for n in indexed if _epoch(n) < epoch), key=_epoch, default=None)
+            if progress_file is not None:
+                print(f"Indexing names of {name}" + (f" from {base}" if base else ""), file=progress_file, flush=True)
+            gone, arrived = [], []
+            for record in diff_snapshots(self.snapshots_path / base if base else None, self.snapshots_path / name, workers=workers, expand=True):
+                if record["status"] == "removed":
+                    gone.append(path_id(record["path"]))
+                elif record["status"] == "added":
+                    arrived.append(path_id(record["path"]))
+            ids = np.asarray(self._snapshot_ids(base)) if base else np.zeros(0, dtype=np.int64)
+            ids = np.union1d(np.setdiff1d(ids, np.array(gone, dtype=np.int64), assume_unique=True), np.array(arrived, dtype=np.int64))
+            if new_paths:
+                self._append_paths(new_paths)
+                new_paths.clear()
+            _save_array(self.index_path / "snapshots" / f"{name}.npy", ids.astype(np.int64))
+            indexed.append(name)
+        return len(added), len(removed)
+
+    def _append_paths(self, paths: List[bytes]) -> None:
+        """
+        Number new paths after the existing ones and index their names.
+        """
+        first = len(self)
+        with open(self.index_path / "paths.bin", "ab") as f:
+            # bytes past the last offset are left by an interrupted update
+            f.truncate(int(self.offsets[-1]))
+            f.write(b"".join(p + b"\0" for p in paths))
+        lengths = np.array([len(p) + 1 for p in paths], dtype=np.int64)
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        self.blob += b"".join(p + b"\0" for p in paths)
+        keys = _trigram_keys([p.rsplit(b"/", 1)[-1] for p in paths], np.arange(first, first + len(paths)))
+        # both runs are sorted and distinct, merging them is linear where sorting is not
+        self.trigram_keys = np.insert(np.asarray(self.trigram_keys), np.searchsorted(self.trigram_keys, keys), keys)
+        _save_array(self.index_path / "trigrams.npy", self.trigram_keys)
+        _save_array(self.index_path / "offsets.npy", self.offsets)
+
+    def _compact(self, names: List[str], compact_fraction: float, progress_file: Optional[IO]) -> None:
+        """
+        Drop the paths none of the snapshots names holds if they are more than compact_fraction of all.
+
+        Numbers keep their order, so every sorted array stays sorted. The
+        index is marked as being compacted until done, an interrupted
+        compaction makes the next update start over.
+        """
+        live = np.zeros(len(self), dtype=bool)
+        for name in names:
+            live[np.asarray(self._snapshot_ids(name))] = True
+        dead = len(self) - int(live.sum())
+        if dead == 0 or dead <= compact_fraction * len(self):
+            return
+        if progress_file is not None:
+            print(f"Compacting the name index, dropping {dead} of {len(self)} paths", file=progress_file, flush=True)
+        new_ids = np.cumsum(live) - 1
+        lengths = np.diff(self.offsets)
+        data = np.frombuffer(self.blob, dtype=np.uint8)[np.repeat(live, lengths)]
+        offsets = np.concatenate([[0], np.cumsum(lengths[live])]).astype(np.int64)
+        keys = np.asarray(self.trigram_keys)
+        key_ids = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        keep = live[key_ids]
+        trigram_keys = (keys[keep] & ~np.uint64(0xFFFFFFFF)) | new_ids[key_ids[keep]].astype(np.uint64)
+        snapshots = {name: new_ids[np.asarray(self._snapshot_ids(name))].astype(np.int64) for name in names}
+        self._snapshots.clear()
+        self._write_version(None)
+        for name, ids in snapshots.items():
+            _save_array(self.index_path / "snapshots" / f"{name}.npy", ids)
+        tmp_path = self.index_path / ".paths.bin.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data.tobytes())
+        os.replace(tmp_path, self.index_path / "paths.bin")
+        _save_array(self.index_path / "trigrams.npy", trigram_keys)
+        _save_array(self.index_path / "offsets.npy", offsets)
+        self._write_version(self.version)
+        self.load()
+
+    def _candidates(self, literal: str) -> Optional[np.ndarray]:
+        trigrams = _trigrams(os.fsencode(literal))
+        if not trigrams:
+            return None
+        postings = []
+        for code in trigrams:
+            lo = np.searchsorted(self.trigram_keys, np.uint64(code << 32))
+            hi = np.searchsorted(self.trigram_keys, np.uint64((code + 1) << 32))
+            postings.append((hi - lo, lo, hi))
+        # the rarest trigram gives the candidates, the others are only probed for them
+        postings.sort()
+        candidates = None
+        for _, lo, hi in postings:
+            ids = (np.asarray(self.trigram_keys[lo:hi]) & np.uint64(0xFFFFFFFF)).astype(np.int64)
+            if candidates is None:
+                candidates = ids
+            elif len(ids):
+                candidates = candidates[ids[np.minimum(np.searchsorted(ids, candidates), len(ids) - 1)] == candidates]
+            else:
+                candidates = ids
+            if len(candidates) == 0:
+                break
+        return candidates
+
+    def search(self, query: str, limit: int = 1000) -> List[Tuple[str, List[str]]]:
+        """
+        The paths matching query with the snapshots holding them, oldest first.
+
+        See compile_query for the query syntax. At most limit paths are
+        returned, the first ones indexed, sorted by path.
+        """
+        regex, literal = compile_query(query)
+        candidates = self._candidates(literal)
+        if candidates is None:
+            candidates = np.arange(len(self))
+        names = self.snapshot_names()
+        results = []
+        # candidates are checked a chunk at a time so common queries stop at limit
+        for start in range(0, len(candidates), 4096):
+            hits = [(self.path(h), h) for h in candidates[start:start + 4096].tolist()]
+            hits = [(path, h) for path, h in hits if regex.search(path)]
+            for hit_start in range(0, len(hits), max(1, limit)):
+                results += self._holders(hits[hit_start:hit_start + max(1, limit)], names)
+                if len(results) >= limit:
+                    break
+            if len(results) >= limit:
+                break
+        return sorted(results[:limit])
+
+    def _holders(self, hits: List[Tuple[str, int]], names: List[str]) -> List[Tuple[str, List[str]]]:
+        """
+        The snapshots among names holding each hit.
+        """
+        hit_ids = np.array([h for _, h in hits], dtype=np.int64)
+        holders: List[List[str]] = [[] for _ in hits]
+        for name in names:
+            ids = self._snapshot_ids(name)
+            if len(ids) == 0:
+                continue
+            positions = np.minimum(np.searchsorted(ids, hit_ids), len(ids) - 1)
+            for n in np.flatnonzero(np.asarray(ids[positions]) == hit_ids).tolist():
+                holders[n].append(name)
+        # paths only left in pruned snapshots are not hits anymore
+        return [(path, held) for (path, _), held in zip(hits, holders) if held]
+
+
+def update_name_index(snapshots_path: Union[str, Path], workers: int = 8, progress_file: Optional[IO] = sys.stderr) -> Tuple[int, int]:
+    """
+    Create or update the name index of the snapshots at snapshots_path.
+    """
+    return NameIndex(snapshots_path).update(workers=workers, progress_file=progress_file)
+
+
+def find_main():
+    from .config import update_fargv_dict
+    from .tracing import session
+    import fargv
+    p = {
+        "archive_root": "./",
+        "snapshots_name": "snapshots",
+        "query": ("", "A name substring or a glob such as *.xlsx or docs/*/report*"),
+        "limit": 1000,
+        "update": (False, "Index new snapshots before searching"),
+        "workers": 8,
+        "trace_output": "",
+    }
+    update_fargv_dict(p)
+    args, _ = fargv.fargv(p)
+    with session(args.trace_output, "find"):
+        index = NameIndex(Path(args.archive_root) / args.snapshots_name)
+        if args.update:
+            index.update(workers=args.workers)
+        found = index.search(args.query, args.limit) if args.query else []
+    if not args.query:
+        print("Nothing to search for, pass -query.", file=sys.stderr)
+        sys.exit(1)
+    for path, names in found:
+        span = names[0] if len(names) == 1 else f"{names[0]} .. {names[-1]}"
+        print(f"{path}\t{span} ({len(names)} snapshots)")
@@ -0,0 +1,232 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+from .datename import _civil_from_days
+
+
+# Rule names in the order they are reported, each rule is driven by <rule>_count.
+RETENTION_RULES = ("yearly", "monthly", "weekly", "daily", "hourly", "minute")
+
+
+def bucket_ids(epochs: np.ndarray, rule: str) -> np.ndarray:
+    """
+    Calendar bucket of every epoch for a retention rule.
+
+    Buckets are monotonic integers: year, year * 12 + month, ISO week (weeks
+    start on monday), day, hour or minute counted from 1970.
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    if rule == "minute":
+        return epochs // 60
+    if rule == "hourly":
+        return epochs // 3600
+    days = epochs // 86400
+    if rule == "daily":
+        return days
+    if rule == "weekly":
+        # 1970-01-01 was a thursday
+        return (days + 3) // 7
+    year, month, _ = _civil_from_days(days)
+    if rule == "monthly":
+        return year * 12 + month - 1
+    if rule == "yearly":
+        return year
+    raise ValueError(f"Invalid retention rule: {rule}")
+
+
+class RetentionPlan:
+    """
+    Keep and prune indexes into the epochs a plan was computed on.
+
+    Every rule keeps the newest snapshot of each of its newest <rule>_count
+    buckets (-1 means all buckets, 0 disables the rule). The newest
+    snapshot is kept whatever the counts, as "newest": current links to it
+    in linkdest mode and the next sync hard links against it. reasons maps
+    each rule to the indexes it kept. The original get_prune_list kept instead
+    the oldest snapshot and the ones following it a period apart, up to
+    <rule>_count of them, so an archive pruned before keeps other snapshots.
+    """
+    def __init__(self, keep: np.ndarray, prune: np.ndarray, reasons: Dict[str, np.ndarray]) -> None:
+        self.keep: np.ndarray = keep
+        self.prune: np.ndarray = prune
+        self.reasons: Dict[str, np.ndarray] = reasons
+
+    def explain(self) -> Dict[int, List[str]]:
+        """
+        Map every kept index to the rules that keep it.
+        """
+        result = {int(idx): [] for idx in self.keep}
+        for rule in RETENTION_RULES + ("newest",):
+            for idx in self.reasons.get(rule, ()):
+                result[int(idx)].append(rule)
+        return result
+
+    def __repr__(self) -> str:
+        return f"RetentionPlan(keep={len(self.keep)}, prune={len(self.prune)})"
+
+
+def plan_retention(epochs: Sequence[int], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0) -> RetentionPlan:
+    """
+    Compute which snapshots to keep and which to prune.
+
+    epochs is an int64 array as returned by Datename.parse_many, it is sorted
+    only if it is not sorted already so a sorted input is planned in O(n).
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    counts = dict(zip(RETENTION_RULES, (yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)))
+    if len(epochs) > 1 and not (epochs[1:] >= epochs[:-1]).all():
+        order = np.argsort(epochs, kind="stable")
+    else:
+        order = None
+    sorted_epochs = epochs if order is None else epochs[order]
+    kept = np.zeros(len(epochs), dtype=bool)
+    reasons = {}
+    for rule in RETENTION_RULES:
+        count = counts[rule]
+        if count == 0 or len(epochs) == 0:
+            reasons[rule] = np.zeros(0, dtype=np.int64)
+            continue
+        buckets = bucket_ids(sorted_epochs, rule)
+        # the newest snapshot of every bucket is the last one before the bucket changes
+        newest = np.flatnonzero(np.append(buckets[1:] != buckets[:-1], True))
+        if count > 0:
+            newest = newest[-count:]
+        if order is not None:
+            newest = order[newest]
+        kept[newest] = True
+        reasons[rule] = newest
+    reasons["newest"] = np.zeros(0, dtype=np.int64) if len(epochs) == 0 else np.array([len(epochs) - 1 if order is None else order[-1]], dtype=np.int64)
+    kept[reasons["newest"]] = True
+    return RetentionPlan(np.flatnonzero(kept), np.flatnonzero(~kept), reasons)
+
+
+
+class RetentionState:
+    """
+    Bucket occupancy of every rule after the last processed snapshot.
+
+    buckets maps each rule to [bucket, epoch] pairs, oldest first, of the
+    snapshots the rule currently keeps, the snapshot at last_epoch is kept
+    as the newest one. Folding newer snapshots into the state
+    only touches the newest bucket of every rule, so an incremental prune
+    costs O(new snapshots) instead of O(history).
+    """
+    version = 1
+
+    def __init__(self, counts: Dict[str, int], buckets: Dict[str, List[List[int]]], last_epoch: Optional[int]) -> None:
+        self.counts: Dict[str, int] = dict(counts)
+        self.buckets: Dict[str, List[List[int]]] = {rule: [list(b) for b in buckets.get(rule, [])] for rule in RETENTION_RULES}
+        self.last_epoch: Optional[int] = last_epoch
+
+    @classmethod
+    def from_plan(cls, epochs: np.ndarray, plan: RetentionPlan, counts: Dict[str, int]) -> "RetentionState":
+        """
+        Build the state a full plan leaves behind.
+        """
+        epochs = np.asarray(epochs, dtype=np.int64)
+        buckets = {}
+        for rule in RETENTION_RULES:
+            kept = plan.reasons[rule]
+            kept = kept[np.argsort(epochs[kept], kind="stable")]
+            buckets[rule] = [[int(b), int(e)] for b, e in zip(bucket_ids(epochs[kept], rule), epochs[kept])]
+        last_epoch = int(epochs.max()) if len(epochs) else None
+        return cls(counts, buckets, last_epoch)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional["RetentionState"]:
+        """
+        Load a state file, None if it is missing or unreadable.
+        """
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data.get("version") != cls.version:
+                return None
+            return cls(data["counts"], data["buckets"], data["last_epoch"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path: Union[str, Path]) -> None:
+        """
+        Atomically write the state file.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "counts": self.counts, "last_epoch": self.last_epoch, "buckets": self.buckets}, f)
+        os.replace(tmp_path, path)
+
+    def kept_epochs(self) -> Set[int]:
+        kept = {epoch for rule in RETENTION_RULES for _, epoch in self.buckets[rule]}
+        if self.last_epoch is not None:
+            kept.add(self.last_epoch)
+        return kept
+
+    def explain(self) -> Dict[int, List[str]]:
+        """
+        Map every kept epoch to the rules that keep it.
+        """
+        result = {}
+        for rule in RETENTION_RULES:
+            for _, epoch in self.buckets[rule]:
+                result.setdefault(epoch, []).append(rule)
+        if self.last_epoch is not None:
+            result.setdefault(self.last_epoch, []).append("newest")
+        return result
+
+    def is_consistent(self, counts: Dict[str, int], epochs: np.ndarray) -> bool:
+        """
+        True if the state was made with counts and the existing snapshots up
+        to last_epoch are exactly the ones it keeps.
+        """
+        if self.counts != counts or self.last_epoch is None:
+            return False
+        epochs = np.asarray(epochs, dtype=np.int64)
+        processed = epochs[epochs <= self.last_epoch]
+        return len(processed) == len(set(processed.tolist())) and set(processed.tolist()) == self.kept_epochs()
+
+    def fold(self, new_epochs: Sequence[int]) -> Set[int]:
+        """
+        Fold snapshots newer than last_epoch into the state.
+
+        Returns the epochs, old and new, no rule keeps anymore.
+        """
+        before = self.kept_epochs()
+        new_epochs = sorted(int(e) for e in new_epochs)
+        for rule in RETENTION_RULES:
+            count = self.counts[rule]
+            if count == 0 or len(new_epochs) == 0:
+                continue
+            occupancy = self.buckets[rule]
+            for bucket, epoch in zip(bucket_ids(np.array(new_epochs, dtype=np.int64), rule).tolist(), new_epochs):
+                if len(occupancy) and occupancy[-1][0] == bucket:
+                    occupancy[-1][1] = epoch
+                else:
+                    occupancy.append([bucket, epoch])
+            if count > 0 and len(occupancy) > count:
+                del occupancy[:len(occupancy) - count]
+        if len(new_epochs):
+            self.last_epoch = new_epochs[-1]
+        return (before | set(new_epochs)) - self.kept_epochs()
+
+
+def plan_incremental(epochs: Sequence[int], state: Optional[RetentionState], yearly_count: int = -1, monthly_count: int = 12, weekly_count: int = 5, daily_count: int = 7, hourly_count: int = 24, minute_count: int = 0) -> Tuple[np.ndarray, RetentionState, bool]:
+    """
+    Prune indexes into epochs, the updated state and whether the state was reused.
+
+    Falls back to a full plan_retention when state is missing or does not
+    match the snapshots on disk (eg. a failed or dry prune, changed counts).
+    """
+    epochs = np.asarray(epochs, dtype=np.int64)
+    counts = dict(zip(RETENTION_RULES, (yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)))
+    if state is None or not state.is_consistent(counts, epochs):
+        plan = plan_retention(epochs, yearly_count, monthly_count, weekly_count, daily_count, hourly_count, minute_count)
+        return plan.prune, RetentionState.from_plan(epochs, plan, counts), False
+    state = RetentionState(state.counts, state.buckets, state.last_epoch)
+    pruned = state.fold(epochs[epochs > state.last_epoch])
+    prune = np.flatnonzero(np.isin(epochs, np.array(sorted(pruned), dtype=np.int64)))
+    return prune, state, True
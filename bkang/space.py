@@ -0,0 +1,191 @@
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+
+def _scan_directory(path: str) -> Tuple[List[int], List[int], List[str]]:
+    """
+    Inodes and allocated bytes of the entries of path, and its subdirectories.
+    """
+    inodes, sizes, subdirs = [], [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            st = entry.stat(follow_symlinks=False)
+            inodes.append(st.st_ino)
+            sizes.append(st.st_blocks * 512)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+    return inodes, sizes, subdirs
+
+
+def scan_snapshot(snapshot_path: Union[str, Path], workers: int = 16) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The distinct inodes referenced by a snapshot and their allocated bytes.
+
+    Directories are scanned concurrently by a thread pool, several links to
+    the same inode within the snapshot count once.
+    """
+    root = str(snapshot_path)
+    st = os.lstat(root)
+    inodes, sizes = [st.st_ino], [st.st_blocks * 512]
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bkang-space") as executor:
+        pending: Dict[Future, str] = {executor.submit(_scan_directory, root): root}
+        while pending:
+            done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                dir_inodes, dir_sizes, subdirs = future.result()
+                inodes += dir_inodes
+                sizes += dir_sizes
+                for subdir in subdirs:
+                    pending[executor.submit(_scan_directory, subdir)] = subdir
+    inodes, first = np.unique(np.array(inodes, dtype=np.uint64), return_index=True)
+    return inodes, np.array(sizes, dtype=np.int64)[first]
+
+
+class SpaceAccounting:
+    """
+    Which snapshots reference every inode, for hard link snapshots.
+
+    A snapshot is scanned once, its sorted inodes and sizes are cached in
+    cache_path as snapshots never change, so a new snapshot costs one scan.
+    Holders (eg. the current directory) are scanned every time, the inodes
+    they reference are never freed by deleting snapshots. Inode numbers are
+    only meaningful within one filesystem, btrfs snapshots are not supported.
+    """
+    def __init__(self, snapshot_paths: Sequence[Union[str, Path]], cache_path: Union[str, Path], holder_paths: Sequence[Union[str, Path]] = (), workers: int = 16, progress_file: Optional[IO] = sys.stderr) -> None:
+        self.snapshot_paths: List[Path] = [Path(p) for p in snapshot_paths]
+        self.cache_path: Path = Path(cache_path)
+        self.workers: int = workers
+        self.progress_file: Optional[IO] = progress_file
+        self.inodes: List[np.ndarray] = []
+        self.sizes: List[np.ndarray] = []
+        for path in self.snapshot_paths:
+            inodes, sizes = self._load_or_scan(path)
+            self.inodes.append(inodes)
+            self.sizes.append(sizes)
+        self._drop_stale_cache()
+        holders = [scan_snapshot(p, workers) for p in holder_paths]
+        n = len(self.snapshot_paths)
+        # every reference of every snapshot, the holders being owner n
+        empty = [np.zeros(0, dtype=np.int64)]
+        self._owners = np.concatenate(empty + [np.full(len(a), i, dtype=np.int64) for i, a in enumerate(self.inodes)] + [np.full(len(a), n, dtype=np.int64) for a, _ in holders])
+        self._ref_sizes = np.concatenate(empty + self.sizes + [s for _, s in holders])
+        uniq, self._refs = np.unique(np.concatenate([np.zeros(0, dtype=np.uint64)] + self.inodes + [a for a, _ in holders]), return_inverse=True)
+        self._ref_counts = np.bincount(self._refs, minlength=len(uniq))
+        self._inode_sizes = np.zeros(len(uniq), dtype=np.int64)
+        self._inode_sizes[self._refs] = self._ref_sizes
+
+    def _cache_file(self, path: Path) -> Path:
+        return self.cache_path / f"{path.name}.npz"
+
+    def _load_or_scan(self, path: Path) -> Tuple[np.ndarray, np.ndarray]:
+        st = os.lstat(path)
+        # a snapshot deleted and recreated under the same name has another root inode
+        key = np.array([st.st_ino, st.st_ctime_ns], dtype=np.int64)
+        try:
+            with np.load(self._cache_file(path)) as cached:
+                if np.array_equal(cached["key"], key):
+                    return cached["inodes"], cached["sizes"]
+        except (OSError, ValueError, KeyError):
+            pass
+        if self.progress_file is not None:
+            print(f"Scanning {path}", file=self.progress_file, flush=True)
+        inodes, sizes = scan_snapshot(path, self.workers)
+        tmp_path = self.cache_path / f".{path.name}.npz.tmp"
+        try:
+            self.cache_path.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                np.savez(f, key=key, inodes=inodes, sizes=sizes)
+            os.replace(tmp_path, self._cache_file(path))
+        except OSError:
+            pass  # a read only archive simply gets scanned every time
+        return inodes, sizes
+
+    def _drop_stale_cache(self) -> None:
+        names = {f"{p.name}.npz" for p in self.snapshot_paths}
+        try:
+            with os.scandir(self.cache_path) as it:
+                for entry in it:
+                    if entry.name.endswith(".npz") and entry.name not in names:
+                        os.unlink(entry.path)
+        except OSError:
+            pass
+
+    def total_bytes(self) -> np.ndarray:
+        return np.array([s.sum() for s in self.sizes], dtype=np.int64)
+
+    def unique_bytes(self) -> np.ndarray:
+        """
+        Per snapshot, the bytes no other snapshot or holder references, ie.
+        what deleting only that snapshot frees.
+        """
+        n = len(self.snapshot_paths)
+        alone = (self._ref_counts[self._refs] == 1) & (self._owners < n)
+        return np.bincount(self._owners[alone], weights=self._ref_sizes[alone], minlength=n)[:n].astype(np.int64)
+
+    def shared_bytes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Per snapshot, the bytes shared with the previous and with the next snapshot.
+        """
+        n = len(self.snapshot_paths)
+        previous = np.zeros(n, dtype=np.int64)
+        for i in range(1, n):
+            _, idx, _ = np.intersect1d(self.inodes[i], self.inodes[i - 1], assume_unique=True, return_indices=True)
+            previous[i] = self.sizes[i][idx].sum()
+        following = np.zeros(n, dtype=np.int64)
+        following[:-1] = previous[1:]
+        return previous, following
+
+    def freed_bytes(self, indexes: Sequence[int]) -> int:
+        """
+        The bytes freed by deleting the snapshots at indexes together.
+        """
+        removed = np.isin(self._owners, np.array(list(indexes), dtype=np.int64))
+        remaining = self._ref_counts - np.bincount(self._refs[removed], minlength=len(self._ref_counts))
+        # an inode can be referenced by several of the deleted snapshots
+        freed = np.unique(self._refs[removed & (remaining[self._refs] == 0)])
+        return int(self._inode_sizes[freed].sum())
+
+    def plan_free_space(self, needed_bytes: int, candidates: Sequence[int], pruned: Sequence[int] = ()) -> Tuple[List[int], int]:
+        """
+        Snapshots to delete on top of pruned so that at least needed_bytes more are freed.
+
+        Greedily picks the candidate freeing the most bytes given what is
+        already deleted, the oldest one when none frees anything on its own.
+        Returns the picked indexes, in picking order, and the bytes they free,
+        fewer than needed_bytes when the candidates cannot free enough.
+        """
+        n = len(self.snapshot_paths)
+        remaining = self._ref_counts.copy()
+        remaining -= np.bincount(self._refs[np.isin(self._owners, np.array(list(pruned), dtype=np.int64))], minlength=len(remaining))
+        available = np.zeros(n + 1, dtype=bool)
+        available[list(candidates)] = True
+        picked, freed = [], 0
+        while freed < needed_bytes and available.any():
+            alone = (remaining[self._refs] == 1) & available[self._owners]
+            gains = np.bincount(self._owners[alone], weights=self._ref_sizes[alone], minlength=n + 1)
+            gains[~available] = -1
+            pick = int(np.argmax(gains)) if gains.max() > 0 else int(np.flatnonzero(available)[0])
+            picked.append(pick)
+            freed += int(max(gains[pick], 0))
+            available[pick] = False
+            # the inodes of one snapshot are distinct
+            remaining[self._refs[self._owners == pick]] -= 1
+        return picked, freed
+
+    def report(self) -> List[Dict]:
+        previous, following = self.shared_bytes()
+        return [{"snapshot": p.name, "total": int(t), "unique": int(u), "shared_previous": int(sp), "shared_next": int(sn)}
+                for p, t, u, sp, sn in zip(self.snapshot_paths, self.total_bytes(), self.unique_bytes(), previous, following)]
+
+
+def format_bytes(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if abs(size) < 1024 or unit == "TiB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
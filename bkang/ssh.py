@@ -0,0 +1,126 @@
+import hashlib
+import os
+import shlex
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional, Self, Union
+
+
+class SSHConnection:
+    """
+    A shared ssh ControlMaster connection to the archive host.
+
+    The master is started once and every ssh, rsync and health check of the
+    job goes through its control socket, so only the first one pays for the
+    handshake. Used as a context manager the master lives as long as the
+    block, otherwise until stop() or control_persist seconds of idleness.
+    """
+    def __init__(self, archive_address: str, port: int = 22, control_dir: Union[str, Path, None] = None, control_persist: int = 600, connect_timeout: int = 10) -> None:
+        if control_dir is None:
+            control_dir = Path.home() / ".cache" / "bkang" / "ssh"
+        self.archive_address: str = archive_address
+        self.port: int = port
+        self.control_dir: Path = Path(control_dir)
+        self.control_persist: int = control_persist
+        self.connect_timeout: int = connect_timeout
+        # sockets paths are limited to about 100 bytes, hence the digest
+        digest = hashlib.sha1(f"{archive_address}:{port}".encode("utf-8")).hexdigest()[:16]
+        self.control_path: Path = self.control_dir / f"{digest}.sock"
+
+    def ssh_options(self) -> List[str]:
+        options = [
+            "-o", "BatchMode=yes",
+            "-o", f"ConnectTimeout={self.connect_timeout}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPath={self.control_path}",
+            "-o", f"ControlPersist={self.control_persist}",
+        ]
+        if self.port != 22:
+            options += ["-p", str(self.port)]
+        return options
+
+    def ssh_cmd(self) -> str:
+        """
+        The ssh program with the multiplexing options, for rsync -e.
+        """
+        return " ".join(["ssh"] + [shlex.quote(o) for o in self.ssh_options()])
+
+    def rsync_flags(self) -> str:
+        return f"-e {shlex.quote(self.ssh_cmd())}"
+
+    def remote_cmd(self, cmd: str) -> str:
+        """
+        A shell command running cmd on the archive host through the master.
+        """
+        return f"{self.ssh_cmd()} {shlex.quote(self.archive_address)} {shlex.quote(cmd)}"
+
+    def _control(self, operation: str) -> bool:
+        result = subprocess.run(["ssh"] + self.ssh_options() + ["-O", operation, self.archive_address], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def check(self) -> bool:
+        """
+        True if the master is up.
+        """
+        return self.control_path.exists() and self._control("check")
+
+    def start(self) -> bool:
+        """
+        Start the master unless it already runs, True if it is up.
+        """
+        if self.check():
+            return True
+        self.control_dir.mkdir(parents=True, exist_ok=True)
+        os.chmod(self.control_dir, 0o700)
+        # -f forks once authenticated, the forked master keeps any pipe open so
+        # its output has to go to /dev/null for run() to return
+        result = subprocess.run(["ssh"] + self.ssh_options() + ["-M", "-N", "-f", self.archive_address], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0 and self.check()
+
+    def health_check(self) -> bool:
+        """
+        True if a command runs on the archive host, starting the master if needed.
+        """
+        if not self.start():
+            return False
+        result = subprocess.run(["ssh"] + self.ssh_options() + [self.archive_address, "true"], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def stop(self) -> None:
+        """
+        Shut the master down, connections still using it finish first.
+        """
+        if self.control_path.exists():
+            self._control("exit")
+
+    def __enter__(self) -> Self:
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def __repr__(self) -> str:
+        return f"SSHConnection({self.archive_address}:{self.port}, {self.control_path})"
+
+
+_connections: Dict[str, SSHConnection] = {}
+
+
+def get_connection(archive_address: str, port: int = 22, **kwargs) -> SSHConnection:
+    """
+    The connection of this process to archive_address, created on first use.
+    """
+    key = f"{archive_address}:{port}"
+    if key not in _connections:
+        _connections[key] = SSHConnection(archive_address, port, **kwargs)
+    return _connections[key]
+
+
+def close_connections() -> None:
+    """
+    Stop every master started by this process.
+    """
+    for connection in _connections.values():
+        connection.stop()
+    _connections.clear()
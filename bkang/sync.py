@@ -0,0 +1,344 @@
+import json
+import os
+import shlex
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+
+RSYNC_FLAGS = "-aAXH"
+# structured progress and totals, parsed by util.run_cmd
+RSYNC_PROGRESS_FLAGS = "--info=progress2 --stats"
+
+
+def remote_cmd(archive_address: str, cmd: str, ssh: str = "ssh") -> str:
+    """
+    A shell command running cmd on the archive host.
+
+    ssh can carry options, eg. SSHConnection.ssh_cmd() to go through a shared master.
+    """
+    return f"{ssh} {archive_address} {shlex.quote(cmd)}"
+
+
+def current_rsync_target(backup_src: str, archive_address: str, archive_root: str, current_name: str) -> Tuple[str, str]:
+    """
+    Extra rsync options and destination mirroring backup_src into current.
+    """
+    return "--delete", f"{archive_address}:{archive_root}/{current_name}{backup_src}"
+
+
+def current_sync_cmd(backup_src: str, archive_address: str, archive_root: str, current_name: str, flags: str = RSYNC_FLAGS) -> str:
+    """
+    Mirror backup_src into the current directory of the archive.
+    """
+    extra, dest = current_rsync_target(backup_src, archive_address, archive_root, current_name)
+    return f"rsync {flags} {extra} {backup_src}/ {dest}/"
+
+
+def _linkdest_paths(archive_root: str, current_name: str, snapshots_name: str, snapshot_name: str) -> Tuple[str, str, str]:
+    from .hardlink import CREATING_PREFIX
+    snapshots_path = f"{archive_root}/{snapshots_name}"
+    return snapshots_path, f"{snapshots_path}/{CREATING_PREFIX}{snapshot_name}", f"{archive_root}/{current_name}"
+
+
+def linkdest_rsync_target(backup_src: str, archive_address: str, archive_root: str, current_name: str, snapshots_name: str, snapshot_name: str) -> Tuple[str, str, str]:
+    """
+    Extra rsync options, destination and --link-dest directory syncing backup_src into a new snapshot.
+
+    The link dest corresponds to the destination, a sync of a subdirectory
+    of both needs the same subdirectory of the link dest.
+    """
+    _, tmp_path, current_path = _linkdest_paths(archive_root, current_name, snapshots_name, snapshot_name)
+    # rsync resolves the current symlink on the archive side, --delete matters
+    # when an interrupted snapshot is resumed
+    return "--delete", f"{archive_address}:{tmp_path}{backup_src}", current_path + backup_src
+
+
+def resume_creation_cmd(snapshots_path: str, snapshot_name: str) -> str:
+    """
+    A shell command taking over the tree of an interrupted snapshot as the temporary tree of snapshot_name.
+
+    Only a leftover named after every snapshot is resumed, rsync then only
+    transfers what it is missing. Older leftovers are collected by prune
+    (see hardlink.abandoned_creations), so the two never race.
+    """
+    from .hardlink import CREATING_PREFIX
+    prefix = shlex.quote(CREATING_PREFIX)
+    newest = f"{{ ls -d {prefix}* 2>/dev/null | cut -c{len(CREATING_PREFIX) + 1}-; ls -d [0-9]* 2>/dev/null; }} | sort | tail -n 1"
+    return (f"cd {shlex.quote(snapshots_path)} && newest=$({newest}) && "
+            f"if [ -n \"$newest\" ] && [ \"$newest\" != {shlex.quote(snapshot_name)} ] && [ -d {prefix}\"$newest\" ]; "
+            f"then mv -T {prefix}\"$newest\" {shlex.quote(CREATING_PREFIX + snapshot_name)}; fi")
+
+
+def linkdest_sync_cmds(backup_src: str, archive_address: str, archive_root: str, current_name: str, snapshots_name: str, snapshot_name: str, flags: str = RSYNC_FLAGS, ssh: str = "ssh") -> List[str]:
+    """
+    Commands syncing backup_src straight into a new snapshot: prepare, rsync and finalize.
+
+    Unchanged files are hard linked by rsync against the snapshot current
+    points to, so no separate snapshot pass over the tree is needed. The
+    snapshot is filled under a temporary name, renamed when rsync succeeds,
+    and current is then atomically repointed to it. The tree of a sync that
+    failed or was interrupted is resumed. current must be a symlink (or
+    missing), not a directory.
+    """
+    snapshots_path, tmp_path, current_path = _linkdest_paths(archive_root, current_name, snapshots_name, snapshot_name)
+    new_current_path = f"{archive_root}/.{current_name}.tmp"
+    prepare = f"mkdir -p {shlex.quote(snapshots_path)} && {resume_creation_cmd(snapshots_path, snapshot_name)} && mkdir -p {shlex.quote(tmp_path + backup_src)}"
+    extra, dest, link_dest = linkdest_rsync_target(backup_src, archive_address, archive_root, current_name, snapshots_name, snapshot_name)
+    rsync = f"rsync {flags} {extra} --link-dest={shlex.quote(link_dest)} {backup_src}/ {dest}/"
+    # a relative symlink keeps the archive relocatable, mv -T renames over the old link atomically
+    finalize = " && ".join([
+        f"mv -T {shlex.quote(tmp_path)} {shlex.quote(snapshots_path + '/' + snapshot_name)}",
+        f"ln -sfn {shlex.quote(snapshots_name + '/' + snapshot_name)} {shlex.quote(new_current_path)}",
+        f"mv -T {shlex.quote(new_current_path)} {shlex.quote(current_path)}",
+    ])
+    return [remote_cmd(archive_address, prepare, ssh), rsync, remote_cmd(archive_address, finalize, ssh)]
+
+
+_WILDCARDS = set("*?[\\")
+# weight of a byte relative to a file when balancing shards, rsync is mostly
+# latency bound per file on trees of small files
+_BYTES_PER_FILE_COST = 256 * 1024
+
+
+class ShardEstimates:
+    """
+    Cached file and byte counts of the directories of a backup source.
+
+    Directories up to max_depth below the source are counted in a single
+    os.scandir walk, which is repeated once the cache is older than max_age
+    seconds. The counts only balance the shards, stale ones never affect
+    what gets synced.
+    """
+    def __init__(self, backup_src: str, cache_path: Union[str, Path, None] = None, max_depth: int = 2, max_age: float = 7 * 86400) -> None:
+        if cache_path is None:
+            cache_path = Path.home() / ".cache" / "bkang" / "shard_estimates.json"
+        self.backup_src: str = backup_src
+        self.cache_path: Path = Path(cache_path)
+        self.max_depth: int = max_depth
+        self.max_age: float = max_age
+        self.estimates: Dict[str, Tuple[int, int]] = {}
+        self.load_or_scan()
+
+    def load_or_scan(self) -> None:
+        try:
+            with open(self.cache_path, "r") as f:
+                entry = json.load(f)[self.backup_src]
+            if entry["max_depth"] >= self.max_depth and time.time() - entry["time"] < self.max_age:
+                self.estimates = {k: tuple(v) for k, v in entry["estimates"].items()}
+                return
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.estimates = self.scan()
+        self.save()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Count files and bytes of every directory up to max_depth, recursively.
+        """
+        totals: Dict[str, List[int]] = {}
+        stack = [("", 0)]
+        while stack:
+            rel, depth = stack.pop()
+            files = size = 0
+            try:
+                with os.scandir(os.path.join(self.backup_src, rel)) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((os.path.join(rel, entry.name), depth + 1))
+                            continue
+                        files += 1
+                        try:
+                            size += entry.stat(follow_symlinks=False).st_size
+                        except OSError:
+                            pass
+            except OSError:
+                continue
+            # charge the directory and all its ancestors up to max_depth
+            prefix = rel
+            while True:
+                if prefix.count(os.sep) + (1 if prefix else 0) <= self.max_depth:
+                    counts = totals.setdefault(prefix, [0, 0])
+                    counts[0] += files + 1
+                    counts[1] += size
+                if not prefix:
+                    break
+                prefix = os.path.dirname(prefix)
+        return {k: (v[0], v[1]) for k, v in totals.items()}
+
+    def save(self) -> None:
+        try:
+            with open(self.cache_path, "r") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[self.backup_src] = {"time": time.time(), "max_depth": self.max_depth, "estimates": self.estimates}
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_name(f".{self.cache_path.name}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    def cost(self, rel: str) -> float:
+        files, size = self.estimates.get(rel, (1, 0))
+        return files + size / _BYTES_PER_FILE_COST
+
+
+class ShardPlan:
+    """
+    How a sharded sync splits the source.
+
+    dir_passes are directories synced non recursively first, parents before
+    children: they carry the files directly in them and delete entries that
+    vanished from them. shards are groups of directories, each synced
+    recursively by one rsync.
+    """
+    def __init__(self, dir_passes: List[str], shards: List[List[str]], costs: List[float]) -> None:
+        self.dir_passes: List[str] = dir_passes
+        self.shards: List[List[str]] = shards
+        self.costs: List[float] = costs
+
+    def __repr__(self) -> str:
+        return f"ShardPlan({len(self.dir_passes)} dir passes, shards of {[len(s) for s in self.shards]} dirs)"
+
+
+def _list_subdirs(backup_src: str, rel: str) -> List[str]:
+    with os.scandir(os.path.join(backup_src, rel)) as it:
+        return sorted(os.path.join(rel, e.name) for e in it if e.is_dir(follow_symlinks=False))
+
+
+def plan_shards(backup_src: str, shard_count: int, estimates: ShardEstimates) -> ShardPlan:
+    """
+    Split backup_src into shard_count groups of directories of similar cost.
+
+    Directories are listed now, the estimates only weigh them. A directory
+    costing more than a shard's share is split into its subdirectories (up
+    to the estimate depth), then directories are assigned largest first to
+    the least loaded shard.
+    """
+    dir_passes = [""]
+    units = _list_subdirs(backup_src, "")
+    target = estimates.cost("") / max(1, shard_count)
+    splittable = True
+    while splittable and units:
+        units.sort(key=estimates.cost)
+        largest = units[-1]
+        depth = largest.count(os.sep) + 1
+        splittable = estimates.cost(largest) > target and depth < estimates.max_depth and not (_WILDCARDS & set(largest))
+        if splittable:
+            children = _list_subdirs(backup_src, largest)
+            splittable = len(children) > 0
+            if splittable:
+                units.pop()
+                units.extend(children)
+                dir_passes.append(largest)
+    shards: List[List[str]] = [[] for _ in range(max(1, shard_count))]
+    costs = [0.0] * len(shards)
+    for unit in sorted(units, key=estimates.cost, reverse=True):
+        idx = costs.index(min(costs))
+        shards[idx].append(unit)
+        costs[idx] += estimates.cost(unit)
+    keep = [i for i, s in enumerate(shards) if s]
+    return ShardPlan(dir_passes, [shards[i] for i in keep], [costs[i] for i in keep])
+
+
+def _escape_pattern(rel: str) -> str:
+    return "".join("\\" + c if c in _WILDCARDS else c for c in rel)
+
+
+def shard_filter_rules(units: List[str]) -> List[str]:
+    """
+    Include rules selecting units (and their parents) from the source root.
+
+    Everything else is excluded on the command line, which also protects it
+    from this shard's --delete.
+    """
+    rules, parents = [], set()
+    for unit in units:
+        parent = os.path.dirname(unit)
+        while parent and parent not in parents:
+            parents.add(parent)
+            rules.append(f"/{parent}/")
+            parent = os.path.dirname(parent)
+        rules.append(f"/{_escape_pattern(unit)}/***")
+    return rules
+
+
+def sharded_rsync_cmds(plan: ShardPlan, flags: str, extra: str, src: str, dest: str, filter_dir: Union[str, Path], link_dest: Optional[str] = None) -> Tuple[List[str], List[str]]:
+    """
+    rsync commands of the dir passes and of the shards.
+
+    src, dest and link_dest (the --link-dest directory, if any) are roots.
+    Shards sync from the roots, a dir pass syncs the same subdirectory of
+    all three. Shard rules are written to null separated files in
+    filter_dir. Every command is a separate rsync, so -H only preserves the
+    hard links among the files one command transfers: files hard linked
+    across shards, or between a dir pass and a shard, arrive as copies.
+    """
+    dir_cmds = []
+    for rel in plan.dir_passes:
+        suffix = f"/{rel}" if rel else ""
+        link = f" --link-dest={shlex.quote(link_dest + suffix)}" if link_dest else ""
+        dir_cmds.append(f"rsync {flags} --no-recursive --dirs {extra}{link} {shlex.quote(src + suffix)}/ {shlex.quote(dest + suffix)}/")
+    if link_dest:
+        extra = f"{extra} --link-dest={shlex.quote(link_dest)}"
+    shard_cmds = []
+    for n, units in enumerate(plan.shards):
+        filter_path = Path(filter_dir) / f"shard_{n}.rules"
+        with open(filter_path, "wb") as f:
+            f.write(b"\0".join(rule.encode("utf-8", errors="surrogateescape") for rule in shard_filter_rules(units)) + b"\0")
+        shard_cmds.append(f"rsync {flags} {extra} --from0 --include-from={shlex.quote(str(filter_path))} --exclude='*' {shlex.quote(src)}/ {shlex.quote(dest)}/")
+    return dir_cmds, shard_cmds
+
+
+def run_sharded(dir_cmds: List[str], shard_cmds: List[str], ok_codes: Tuple[int, ...] = (0, 24), progress_interval: float = 10.0, output_file: IO = sys.stderr, show_output: bool = True, results: Optional[List] = None) -> int:
+    """
+    Run the dir passes in order, then all shards concurrently.
+
+    Progress of the shards is aggregated into a single line, the exit status
+    is 0 if every command ended with one of ok_codes, otherwise the largest
+    failing code. The CommandResult of every command is appended to results.
+    """
+    from .util import run_cmd
+    for cmd in dir_cmds:
+        result = run_cmd(cmd, show_cmd=show_output, show_output=show_output, output_file=output_file)
+        if results is not None:
+            results.append(result)
+        if result.returncode not in ok_codes:
+            print(f"Failed ({result.returncode}): {cmd}", file=sys.stderr)
+            return result.returncode
+    lock = threading.Lock()
+    shard_bytes = [0] * len(shard_cmds)
+    done = [0]
+    last_shown = [time.monotonic()]
+
+    def report(n: int, update) -> None:
+        with lock:
+            shard_bytes[n] = update.bytes
+            if show_output and time.monotonic() - last_shown[0] >= progress_interval:
+                last_shown[0] = time.monotonic()
+                print(f"[shards {done[0]}/{len(shard_cmds)} done, {sum(shard_bytes)} bytes transferred]", file=output_file, flush=True)
+
+    def run_shard(n: int, cmd: str) -> int:
+        result = run_cmd(cmd, show_cmd=show_output, show_output=False, output_file=output_file, on_progress=lambda update: report(n, update))
+        with lock:
+            done[0] += 1
+            if results is not None:
+                results.append(result)
+        for line in result.stderr_tail:
+            print(f"[shard {n}] {line}", file=sys.stderr)
+        if result.returncode not in ok_codes:
+            print(f"Failed shard {n} ({result.returncode}) after {result.elapsed:.1f}s: {cmd}", file=sys.stderr)
+        return result.returncode
+    with ThreadPoolExecutor(max_workers=max(1, len(shard_cmds)), thread_name_prefix="bkang-shard") as executor:
+        codes = list(executor.map(run_shard, range(len(shard_cmds)), shard_cmds))
+    if show_output:
+        print(f"[shards {done[0]}/{len(shard_cmds)} done, {sum(shard_bytes)} bytes transferred]", file=output_file, flush=True)
+    failed = [code for code in codes if code not in ok_codes]
+    return max(failed) if failed else 0
@@ -0,0 +1,169 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from string import Template
+from typing import Dict, Iterator, List, Optional
+
+
+# the tracer of the running session, None when tracing is off
+_tracer: Optional["Tracer"] = None
+
+
+class Tracer:
+    """
+    The spans of one traced run, in chrome trace event format.
+
+    Spans of the subprocess category are time spent waiting on child
+    processes, the rest of a thread's wall time is python work.
+    """
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.pid: int = os.getpid()
+        self.start_ns: int = time.perf_counter_ns()
+        self.events: List[Dict] = []
+        self.wait_ns: Dict[int, int] = {}
+        self.thread_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, cat: str, start_ns: int, end_ns: int, args: Dict, wait_ns: Optional[int] = None) -> None:
+        tid = threading.get_ident()
+        event = {"name": name, "cat": cat, "ph": "X", "ts": (start_ns - self.start_ns) / 1000, "dur": (end_ns - start_ns) / 1000, "pid": self.pid, "tid": tid}
+        if args:
+            event["args"] = args
+        with self._lock:
+            self.events.append(event)
+            if tid not in self.thread_names:
+                self.thread_names[tid] = threading.current_thread().name
+            if cat == "subprocess":
+                self.wait_ns[tid] = self.wait_ns.get(tid, 0) + (end_ns - start_ns if wait_ns is None else wait_ns)
+
+    def chrome_trace(self) -> Dict:
+        names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}} for tid, name in self.thread_names.items()]
+        return {"traceEvents": names + self.events, "displayTimeUnit": "ms", "otherData": {"name": self.name}}
+
+    def summary(self, wall_ns: int, tid: int) -> str:
+        wait = self.wait_ns.get(tid, 0)
+        others = sum(ns for t, ns in self.wait_ns.items() if t != tid)
+        share = 100 * wait / wall_ns if wall_ns > 0 else 0.0
+        result = f"wall {wall_ns / 1e9:.3f}s, waiting on subprocesses {wait / 1e9:.3f}s ({share:.0f}%), python {(wall_ns - wait) / 1e9:.3f}s"
+        if others:
+            result += f", other threads waited {others / 1e9:.3f}s on subprocesses"
+        return result
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "args", "start_ns", "wait_ns")
+
+    def __init__(self, tracer: Tracer, name: str, cat: str, args: Dict) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.wait_ns: Optional[int] = None
+
+    def __enter__(self) -> "_Span":
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.tracer.add(self.name, self.cat, self.start_ns, time.perf_counter_ns(), self.args, self.wait_ns)
+
+
+class _NullSpan:
+    __slots__ = ("args", "wait_ns")
+
+    def __init__(self) -> None:
+        self.args: Dict = {}
+        self.wait_ns: Optional[int] = None
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def active() -> Optional[Tracer]:
+    return _tracer
+
+
+def span(name: str, cat: str = "python", **args):
+    """
+    A context manager timing a block as a span, a shared no-op when tracing is off.
+
+    A subprocess span may set wait_ns when only part of it was spent waiting.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, cat, args)
+
+
+def traced(name: Optional[str] = None, cat: str = "python"):
+    """
+    Decorate a function to run as a span named after it.
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with _Span(tracer, span_name, cat, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def session(output: str, name: str) -> Iterator[Optional[Tracer]]:
+    """
+    Trace the block when output is set, then write the trace and print where the time went.
+
+    output may contain $job, $pid and $time (not {job}, fargv formats
+    braces in string arguments itself). A .prof output is a cProfile
+    dump of the calling thread (pstats, snakeviz), anything else a chrome
+    trace json of the spans of all threads (chrome://tracing, perfetto). A
+    session inside a session only adds a span to the outer one.
+    """
+    global _tracer
+    if not output or _tracer is not None:
+        with span(name):
+            yield _tracer
+        return
+    path = Template(output).safe_substitute(job=name, pid=os.getpid(), time=time.strftime("%Y%m%d-%H%M%S"))
+    tracer = Tracer(name)
+    profile = None
+    if path.endswith(".prof"):
+        import cProfile
+        profile = cProfile.Profile()
+    _tracer = tracer
+    start_ns = time.perf_counter_ns()
+    if profile is not None:
+        profile.enable()
+    try:
+        with _Span(tracer, name, "python", {}):
+            yield tracer
+    finally:
+        if profile is not None:
+            profile.disable()
+        _tracer = None
+        wall_ns = time.perf_counter_ns() - start_ns
+        try:
+            if profile is not None:
+                profile.dump_stats(path)
+            else:
+                with open(path, "w") as f:
+                    json.dump(tracer.chrome_trace(), f)
+            print(f"[trace {name}: {tracer.summary(wall_ns, threading.get_ident())}, written to {path}]", file=sys.stderr, flush=True)
+        except OSError as e:
+            print(f"Could not write the trace of {name} to {path}: {e}", file=sys.stderr)
@@ -1,14 +1,18 @@
+from collections import deque
 from functools import wraps
 import fcntl
 from pathlib import Path
+import re
+import selectors
 import tempfile
 import subprocess
 import sys
-from typing import IO, Union
-import toml
-import json
+import time
+from typing import IO, Callable, Dict, List, Optional, Tuple, Union
 import os
 
+from .tracing import active, span
+
 
 def single_instance_aborting(lock_name):
     def decorator(func):
@@ -28,16 +32,169 @@ def single_instance_aborting(lock_name):
     return decorator
 
 
-def get_cmd_output(cmd: str, show_cmd: bool = True, show_output: bool = True, output_file: IO = sys.stdout, dry_run: bool = False) -> str:
+# rsync exit codes that still mean a usable transfer, 24 is "source files vanished"
+RSYNC_OK_CODES = (0, 24)
+
+_RSYNC_PROGRESS_RE = re.compile(r"^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d+:\d+)(?:\s+\(xfr#(\d+),\s+(?:ir|to)-chk=(\d+)/(\d+)\))?")
+_RSYNC_STATS_RE = re.compile(r"^(Number of [\w ]+|Total [\w ]+size|Total bytes \w+|Literal data|Matched data|File list size): ([\d,.]+)")
+_LINE_SPLIT_RE = re.compile(rb"[\r\n]")
+_MAX_LINE_BYTES = 65536
+
+
+class RsyncProgress:
+    """
+    One rsync --info=progress2 update.
+    """
+    __slots__ = ("bytes", "percent", "rate", "eta", "transferred_files", "to_check", "total_files")
+
+    def __init__(self, bytes: int, percent: int, rate: str, eta: str, transferred_files: Optional[int] = None, to_check: Optional[int] = None, total_files: Optional[int] = None) -> None:
+        self.bytes = bytes
+        self.percent = percent
+        self.rate = rate
+        self.eta = eta
+        self.transferred_files = transferred_files
+        self.to_check = to_check
+        self.total_files = total_files
+
+    @staticmethod
+    def parse(line: str) -> Optional["RsyncProgress"]:
+        match = _RSYNC_PROGRESS_RE.match(line)
+        if match is None:
+            return None
+        size, percent, rate, eta, xfr, to_check, total = match.groups()
+        optional = [int(v) if v is not None else None for v in (xfr, to_check, total)]
+        return RsyncProgress(int(size.replace(",", "")), int(percent), rate, eta, *optional)
+
+    def __str__(self) -> str:
+        files = f" {self.transferred_files} files, {self.to_check}/{self.total_files} to check" if self.transferred_files is not None else ""
+        return f"[rsync {self.bytes} bytes {self.percent}% {self.rate} eta {self.eta}{files}]"
+
+
+def parse_rsync_stats_line(line: str) -> Optional[Tuple[str, int]]:
+    """
+    Parse a line of rsync --stats into (snake_case key, value).
+    """
+    match = _RSYNC_STATS_RE.match(line.strip())
+    if match is None:
+        return None
+    key = match.group(1).lower().replace(" ", "_")
+    return key, int(float(match.group(2).replace(",", "")))
+
+
+class CommandResult:
     """
-    Get the output of a command.
+    Exit status, timing and the last lines of output of a command.
+    """
+    def __init__(self, cmd: str, returncode: Optional[int], start_time: float, elapsed: float, stdout_tail: List[str], stderr_tail: List[str], progress: Optional[RsyncProgress] = None, stats: Optional[Dict[str, int]] = None) -> None:
+        self.cmd: str = cmd
+        self.returncode: Optional[int] = returncode  # None for dry runs
+        self.start_time: float = start_time
+        self.elapsed: float = elapsed
+        self.stdout_tail: List[str] = stdout_tail
+        self.stderr_tail: List[str] = stderr_tail
+        self.progress: Optional[RsyncProgress] = progress
+        self.stats: Dict[str, int] = stats or {}
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode in (0, None)
+
+    @property
+    def stdout(self) -> str:
+        return "\n".join(self.stdout_tail)
+
+    @property
+    def stderr(self) -> str:
+        return "\n".join(self.stderr_tail)
+
+    def __repr__(self) -> str:
+        return f"CommandResult({self.cmd!r}, returncode={self.returncode}, elapsed={self.elapsed:.3f})"
+
+
+def run_cmd(cmd: str, show_cmd: bool = True, show_output: bool = True, output_file: IO = sys.stdout, dry_run: bool = False, tail_lines: int = 1000, progress_interval: float = 10.0, on_line: Optional[Callable[[str, str], None]] = None, on_progress: Optional[Callable[[RsyncProgress], None]] = None) -> CommandResult:
+    """
+    Run a shell command streaming its output.
+
+    stdout and stderr are read as they are produced and split on newlines
+    and carriage returns (rsync progress). Only the last tail_lines of each
+    are kept, so memory does not grow with the output. rsync progress
+    updates are parsed, passed to on_progress and shown at most every
+    progress_interval seconds, --stats lines are collected into stats.
     """
     if show_cmd:
-        print(cmd, file=output_file)
+        print(cmd, file=output_file, flush=True)
+    start_time = time.time()
     if dry_run:
-        result = "NA"
-    else:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-    if show_output:
-        print(result.stdout, file=output_file)
-    return result.stdout.strip()
+        return CommandResult(cmd, None, start_time, 0.0, [], [])
+    tails = {"stdout": deque(maxlen=tail_lines), "stderr": deque(maxlen=tail_lines)}
+    partial = {"stdout": b"", "stderr": b""}
+    stats = {}
+    progress = None
+    last_shown = 0.0
+
+    def handle_line(stream: str, raw: bytes) -> None:
+        nonlocal progress, last_shown
+        line = raw.decode("utf-8", errors="replace")
+        if not line.strip():
+            return
+        update = RsyncProgress.parse(line) if stream == "stdout" and "%" in line else None
+        if update is not None:
+            progress = update
+            if on_progress is not None:
+                on_progress(update)
+            if show_output and time.monotonic() - last_shown >= progress_interval:
+                last_shown = time.monotonic()
+                print(update, file=output_file, flush=True)
+            return
+        stat_line = parse_rsync_stats_line(line) if stream == "stdout" and ": " in line else None
+        if stat_line is not None:
+            stats[stat_line[0]] = stat_line[1]
+        tails[stream].append(line)
+        if on_line is not None:
+            on_line(stream, line)
+        if show_output:
+            print(line, file=output_file if stream == "stdout" else sys.stderr, flush=True)
+
+    # time blocked on the child counts as subprocess wait, handling its output as python work
+    trace = span("run_cmd", "subprocess", cmd=cmd)
+    timing, waited = active() is not None, 0
+    with trace:
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, "stdout")
+            selector.register(process.stderr, selectors.EVENT_READ, "stderr")
+            while selector.get_map():
+                if timing:
+                    select_start = time.perf_counter_ns()
+                events = selector.select()
+                if timing:
+                    waited += time.perf_counter_ns() - select_start
+                for key, _ in events:
+                    stream = key.data
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        if partial[stream]:
+                            handle_line(stream, partial[stream])
+                            partial[stream] = b""
+                        continue
+                    pieces = _LINE_SPLIT_RE.split(partial[stream] + chunk)
+                    partial[stream] = pieces.pop()
+                    for piece in pieces:
+                        handle_line(stream, piece)
+                    if len(partial[stream]) > _MAX_LINE_BYTES:
+                        handle_line(stream, partial[stream])
+                        partial[stream] = b""
+        wait_start = time.perf_counter_ns()
+        returncode = process.wait()
+        trace.wait_ns = waited + time.perf_counter_ns() - wait_start
+    return CommandResult(cmd, returncode, start_time, time.time() - start_time, list(tails["stdout"]), list(tails["stderr"]), progress, stats)
+
+
+def get_cmd_output(cmd: str, show_cmd: bool = True, show_output: bool = True, output_file: IO = sys.stdout, dry_run: bool = False) -> str:
+    """
+    Get the (last lines of the) output of a command.
+    """
+    with span("get_cmd_output", cmd=cmd):
+        return run_cmd(cmd, show_cmd=show_cmd, show_output=show_output, output_file=output_file, dry_run=dry_run).stdout.strip()
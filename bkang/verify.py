@@ -0,0 +1,377 @@
+import os
+import re
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import IO, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from .catalog import SnapshotCatalog
+from .dedup import hash_file, scan_files
+from .tracing import span
+
+
+MANIFESTS_NAME = ".bkang_manifests"
+_UNESCAPE_RE = re.compile(r"\\(.)")
+
+
+def manifest_line(digest: str, rel_path: str) -> str:
+    """
+    A line of a sha256sum compatible manifest, paths with backslashes or newlines are escaped as sha256sum does.
+    """
+    if "\\" in rel_path or "\n" in rel_path:
+        return "\\" + digest + "  " + rel_path.replace("\\", "\\\\").replace("\n", "\\n") + "\n"
+    return f"{digest}  {rel_path}\n"
+
+
+def read_manifest(path: Union[str, Path]) -> Iterator[Tuple[str, str]]:
+    """
+    The digests and relative paths of a manifest written by write_manifest.
+    """
+    with open(path, encoding="utf-8", errors="surrogateescape") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            escaped = line.startswith("\\")
+            if escaped:
+                line = line[1:]
+            digest, rel_path = line[:64], line[66:]
+            if escaped:
+                rel_path = _UNESCAPE_RE.sub(lambda m: "\n" if m.group(1) == "n" else m.group(1), rel_path)
+            yield digest, rel_path
+
+
+def write_manifest(path: Union[str, Path], entries: List[Tuple[str, str]]) -> None:
+    """
+    Atomically write the (digest, relative path) entries sorted by path.
+
+    Run `sha256sum -c` from inside the snapshot to check it without bkang.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8", errors="surrogateescape") as f:
+        for digest, rel_path in sorted(entries, key=lambda e: e[1]):
+            f.write(manifest_line(digest, rel_path))
+    os.replace(tmp_path, path)
+
+
+class VerifyStats:
+    def __init__(self) -> None:
+        self.start_time: float = time.monotonic()
+        self.manifests: int = 0
+        self.files: int = 0
+        self.hashed: int = 0
+        self.hashed_bytes: int = 0
+        self.verified: int = 0
+        self.verified_bytes: int = 0
+        self.corrupt: List[Tuple[str, str]] = []
+        self.missing: List[str] = []
+        self.changed: List[str] = []
+        self.errors: List[Tuple[str, str]] = []
+
+    def ok(self) -> bool:
+        return not (self.corrupt or self.missing or self.changed or self.errors)
+
+    def __str__(self) -> str:
+        return (f"[{self.manifests} manifests written, {self.files} files, hashed {self.hashed} ({self.hashed_bytes} bytes), "
+                f"verified {self.verified} ({self.verified_bytes} bytes), {len(self.corrupt)} corrupt, {len(self.missing)} missing, "
+                f"{len(self.changed)} changed, {len(self.errors)} errors, {time.monotonic() - self.start_time:.1f}s]")
+
+
+class VerifyIndex:
+    """
+    The digest of every inode of the archive and when its contents were last checked.
+
+    Hard link snapshots share the inodes of unchanged files, so an inode is
+    hashed once for the manifests of every snapshot linking it and verified
+    once for all of them. An inode is recognised as the dedup index does it,
+    by its number, size, mtime and ctime, while the path it was last seen at
+    still holds it. Every btrfs snapshot is a filesystem of its own reusing
+    the same inode numbers, with per_device the device is part of the inode
+    and nothing is shared between snapshots.
+    """
+    version = 2
+    index_name = ".bkang_verify.sqlite"
+
+    def __init__(self, snapshots_path: Union[str, Path], index_path: Union[str, Path, None] = None, per_device: bool = False) -> None:
+        self.snapshots_path: Path = Path(snapshots_path)
+        self.per_device: bool = per_device
+        if index_path is None:
+            index_path = self.snapshots_path.parent / self.index_name
+        self.index_path: Path = Path(index_path)
+        self.db = sqlite3.connect(str(self.index_path), timeout=30)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript("DROP TABLE IF EXISTS inodes;")
+        self.db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS inodes (dev INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, ctime_ns INTEGER NOT NULL,
+                                               digest TEXT NOT NULL, verified REAL NOT NULL, path TEXT NOT NULL, PRIMARY KEY (dev, inode));
+            PRAGMA user_version = {self.version};
+        """)
+
+    def key(self, st: os.stat_result) -> Tuple[int, int]:
+        """
+        What tells the inode of st apart from the other inodes of the archive.
+        """
+        return st.st_dev if self.per_device else 0, st.st_ino
+
+    def lookup(self, path: str, st: os.stat_result) -> Optional[Tuple[str, float]]:
+        """
+        The digest of the inode of st and when it was last verified, None if unknown or modified since.
+        """
+        dev, inode = self.key(st)
+        row = self.db.execute("SELECT size, mtime_ns, ctime_ns, digest, verified, path FROM inodes WHERE dev = ? AND inode = ?", (dev, inode)).fetchone()
+        if row is None:
+            return None
+        size, mtime_ns, ctime_ns, digest, verified, known_path = row
+        if ctime_ns != st.st_ctime_ns:
+            # a new hard link or a reused inode number, only the former leaves the inode where it was
+            try:
+                alive = self.key(os.lstat(known_path)) == (dev, inode)
+            except OSError:
+                alive = False
+            if not alive:
+                self.db.execute("DELETE FROM inodes WHERE dev = ? AND inode = ?", (dev, inode))
+                return None
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        if ctime_ns != st.st_ctime_ns or known_path != path:
+            self.add_inode(path, st, digest, verified)
+        return digest, verified
+
+    def add_inode(self, path: str, st: os.stat_result, digest: str, verified: float) -> None:
+        self.db.execute("INSERT OR REPLACE INTO inodes (dev, inode, size, mtime_ns, ctime_ns, digest, verified, path) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        self.key(st) + (st.st_size, st.st_mtime_ns, st.st_ctime_ns, digest, verified, path))
+
+    def forget_inodes(self, inodes: List[int]) -> None:
+        """
+        Drop these inode numbers, whatever their device.
+        """
+        with self.db:
+            self.db.executemany("DELETE FROM inodes WHERE inode = ?", ((i,) for i in inodes))
+
+    def forget_except(self, keys: List[Tuple[int, int]]) -> int:
+        """
+        Drop the inodes no manifest refers to anymore, returns how many.
+        """
+        with self.db:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS live (dev INTEGER NOT NULL, inode INTEGER NOT NULL, PRIMARY KEY (dev, inode))")
+            self.db.execute("DELETE FROM live")
+            self.db.executemany("INSERT OR IGNORE INTO live (dev, inode) VALUES (?, ?)", keys)
+            count = self.db.execute("DELETE FROM inodes WHERE (dev, inode) NOT IN (SELECT dev, inode FROM live)").rowcount
+            self.db.execute("DELETE FROM live")
+        return count
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def manifest_snapshot(index: VerifyIndex, snapshot_path: Path, manifest_path: Path, hasher: Callable, executor: ProcessPoolExecutor, stats: VerifyStats, scan_workers: int = 16, dry_run: bool = True) -> None:
+    """
+    Write the manifest of one snapshot, hashing only the inodes the index does not know.
+    """
+    with span("scan", snapshot=snapshot_path.name):
+        files = scan_files(snapshot_path, 0, scan_workers)
+    stats.files += len(files)
+    digests: Dict[Tuple[int, int], str] = {}
+    unknown: Dict[Tuple[int, int], Tuple[str, os.stat_result]] = {}
+    for path, st in files:
+        key = index.key(st)
+        if key in digests or key in unknown:
+            continue
+        known = index.lookup(path, st)
+        if known is not None:
+            digests[key] = known[0]
+        else:
+            unknown[key] = (path, st)
+    if unknown:
+        with span("hash", snapshot=snapshot_path.name, files=len(unknown)):
+            now = time.time()
+            # big files first so a single one does not end up last
+            ordered = sorted(unknown.values(), key=lambda e: -e[1].st_size)
+            for (path, st), (_, digest) in zip(ordered, executor.map(hasher, [path for path, _ in ordered], chunksize=16)):
+                if digest is None:
+                    stats.errors.append((path, "unreadable"))
+                    continue
+                digests[index.key(st)] = digest
+                index.add_inode(path, st, digest, now)
+                stats.hashed += 1
+                stats.hashed_bytes += st.st_size
+    entries = [(digests[index.key(st)], os.path.relpath(path, snapshot_path)) for path, st in files if index.key(st) in digests]
+    if not dry_run:
+        write_manifest(manifest_path, entries)
+        index.db.commit()
+    stats.manifests += 1
+
+
+def verify_manifests(index: VerifyIndex, snapshots_path: Path, manifests_path: Path, names: List[str], hasher: Callable, executor: ProcessPoolExecutor, stats: VerifyStats, max_age: float = 30 * 86400.0, budget_bytes: int = 0, dry_run: bool = True, output_file: IO = sys.stdout) -> None:
+    """
+    Check the manifests of the snapshots named against the archive.
+
+    Every listed file must still be an inode with the contents of the
+    manifest, which only costs an lstat for the inodes hashed before. The contents of the inodes not verified
+    for max_age seconds are then hashed again, least recently verified
+    first and at most budget_bytes of them (0 for all), so that repeated
+    runs go round the whole archive.
+    """
+    live: Dict[Tuple[int, int], Tuple[str, os.stat_result, str, float]] = {}
+    with span("check"):
+        for name in names:
+            manifest_path = manifests_path / f"{name}.sha256"
+            if not manifest_path.exists():
+                continue
+            snapshot_path = snapshots_path / name
+            for digest, rel_path in read_manifest(manifest_path):
+                path = str(snapshot_path / rel_path)
+                try:
+                    st = os.lstat(path)
+                except FileNotFoundError:
+                    stats.missing.append(path)
+                    print(f"MISSING\t{path}", file=output_file)
+                    continue
+                except OSError as e:
+                    stats.errors.append((path, str(e)))
+                    continue
+                key = index.key(st)
+                if key in live and live[key][2] == digest:
+                    continue
+                known = index.lookup(path, st)
+                if (known is not None and known[0] != digest) or key in live:
+                    stats.changed.append(path)
+                    print(f"CHANGED\t{path}", file=output_file)
+                    continue
+                # an inode the index does not know (eg. relinked by bkang-dedup) is hashed first
+                live[key] = (path, st, digest, known[1] if known is not None else 0.0)
+    due = sorted((v[3], key) for key, v in live.items() if v[3] < time.time() - max_age)
+    selected, total = [], 0
+    for _, key in due:
+        size = live[key][1].st_size
+        if budget_bytes > 0 and total + size > budget_bytes and selected:
+            break
+        selected.append(key)
+        total += size
+    if selected:
+        with span("verify", files=len(selected)):
+            now = time.time()
+            for key, (_, digest) in zip(selected, executor.map(hasher, [live[k][0] for k in selected], chunksize=16)):
+                path, st, expected, _ = live[key]
+                if digest is None:
+                    stats.errors.append((path, "unreadable"))
+                    continue
+                stats.verified += 1
+                stats.verified_bytes += st.st_size
+                if digest != expected:
+                    stats.corrupt.append((path, digest))
+                    print(f"CORRUPT\t{path}\texpected {expected} got {digest}, {st.st_nlink} links", file=output_file)
+                elif not dry_run:
+                    index.add_inode(path, st, digest, now)
+    if not dry_run:
+        index.db.commit()
+        if names and not stats.missing and not stats.errors:
+            index.forget_except(list(live))
+
+
+def verify_archive(snapshots_path: Union[str, Path], write_manifests: bool = True, verify: bool = True, max_age: float = 30 * 86400.0, budget_bytes: int = 0,
+                   hash_workers: Optional[int] = None, scan_workers: int = 16, chunk_size: int = 1 << 20, read_ahead: int = 4 << 20, max_bytes_per_second: float = 0.0,
+                   drop_cache: bool = True, per_device: bool = False, dry_run: bool = True, progress_file: Optional[IO] = sys.stderr, output_file: IO = sys.stdout) -> VerifyStats:
+    """
+    Write the manifests of new snapshots and verify the archive against all of them.
+
+    max_bytes_per_second is the read rate of all hash workers together,
+    per_device is needed when every snapshot is a filesystem of its own (btrfs).
+    """
+    snapshots_path = Path(snapshots_path)
+    manifests_path = snapshots_path.parent / MANIFESTS_NAME
+    catalog = SnapshotCatalog(snapshots_path)
+    index = VerifyIndex(snapshots_path, per_device=per_device)
+    stats = VerifyStats()
+    workers = hash_workers or os.cpu_count() or 1
+    hasher = partial(hash_file, chunk_size=chunk_size, read_ahead=read_ahead, max_bytes_per_second=max_bytes_per_second / workers, drop_cache=drop_cache)
+    try:
+        if not dry_run:
+            manifests_path.mkdir(exist_ok=True)
+            # the manifests of pruned snapshots
+            present = set(catalog.names)
+            for manifest_path in manifests_path.glob("*.sha256"):
+                if manifest_path.name[:-len(".sha256")] not in present:
+                    os.unlink(manifest_path)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            if write_manifests:
+                for name in catalog.names:
+                    manifest_path = manifests_path / f"{name}.sha256"
+                    if manifest_path.exists():
+                        continue
+                    if progress_file is not None:
+                        print(f"Writing the manifest of {name}", file=progress_file, flush=True)
+                    manifest_snapshot(index, snapshots_path / name, manifest_path, hasher, executor, stats, scan_workers, dry_run)
+                    if progress_file is not None:
+                        print(stats, file=progress_file, flush=True)
+            if verify:
+                if progress_file is not None:
+                    print(f"Verifying {len(catalog.names)} snapshots", file=progress_file, flush=True)
+                verify_manifests(index, snapshots_path, manifests_path, catalog.names, hasher, executor, stats, max_age, budget_bytes, dry_run, output_file)
+                if progress_file is not None:
+                    print(stats, file=progress_file, flush=True)
+    finally:
+        index.close()
+    return stats
+
+
+def verify_main():
+    from .config import update_fargv_dict
+    from .datename import LOCK_TIMEOUT_EXIT
+    from .locks import LockTimeout, archive_job
+    from .metrics import job_metrics
+    from .tracing import session
+    import fargv
+    p = {
+        "archive_root": "./",
+        "snapshots_name": "snapshots",
+        "action": ("all", "manifest", "verify"),
+        "max_age_days": (30.0, "Hash again the contents not verified for this many days"),
+        "budget_gb": (0.0, "Hash at most this much data per run, 0 for no limit"),
+        "hash_workers": os.cpu_count() or 1,
+        "scan_workers": 16,
+        "read_size_kb": 1024,
+        "read_ahead_kb": 4096,
+        "max_read_mbps": (0.0, "Limit the reading of all hash workers together to this many MB/s, 0 for no limit"),
+        "drop_cache": (True, "Evict the hashed files from the page cache"),
+        "verbose": 1,
+        "no_dry_run": (False, "Write the manifests and record the verification, a dry run only reports"),
+        "lock_timeout": 3600.0,
+        "io_class": "best-effort",
+        "io_level": 7,
+        "cpu_nice": 10,
+        "metrics_jsonl": "",
+        "metrics_textfile_dir": "",
+        "trace_output": "",
+        "fstype": ("btrfs", "hardlinks")
+    }
+    update_fargv_dict(p)
+    args, _ = fargv.fargv(p)
+    stats = None
+    with session(args.trace_output, "verify"), job_metrics(args, "verify") as metrics:
+        try:
+            # a prune must not delete what is being verified, other readers are fine
+            with archive_job(args, "verify", exclusive=False, metrics=metrics):
+                stats = verify_archive(Path(args.archive_root) / args.snapshots_name, args.action in ("all", "manifest"), args.action in ("all", "verify"),
+                                       args.max_age_days * 86400, int(args.budget_gb * 1e9), args.hash_workers, args.scan_workers, args.read_size_kb << 10,
+                                       args.read_ahead_kb << 10, args.max_read_mbps * 1e6, args.drop_cache, args.fstype == "btrfs", dry_run=not args.no_dry_run,
+                                       progress_file=sys.stderr if args.verbose > 0 else None)
+        except LockTimeout:
+            metrics.exit_code = LOCK_TIMEOUT_EXIT
+        if stats is not None:
+            for name, value in (("manifests", stats.manifests), ("files", stats.files), ("files_hashed", stats.hashed), ("bytes_hashed", stats.hashed_bytes),
+                                ("files_verified", stats.verified), ("bytes_verified", stats.verified_bytes), ("corrupt", len(stats.corrupt)),
+                                ("missing", len(stats.missing)), ("changed", len(stats.changed)), ("errors", len(stats.errors))):
+                metrics.count(name, value)
+            metrics.exit_code = 0 if stats.ok() else 1
+    for path, error in stats.errors if stats is not None else []:
+        print(f"Error verifying {path}: {error}", file=sys.stderr)
+    sys.exit(metrics.exit_code)
+
+
+if __name__ == "__main__":
+    verify_main()
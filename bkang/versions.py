@@ -0,0 +1,179 @@
+import os
+import sqlite3
+import sys
+from pathlib import Path
+from typing import IO, Dict, List, Optional, Tuple, Union
+
+from .catalog import SnapshotCatalog
+from .datename import Datename
+from .diff import diff_snapshots
+
+
+class VersionRun:
+    """
+    A file present with the same inode in every snapshot from first to last.
+    """
+    __slots__ = ("first_name", "last_name", "inode", "size", "mtime")
+
+    def __init__(self, first_name: str, last_name: str, inode: int, size: int, mtime: float) -> None:
+        self.first_name: str = first_name
+        self.last_name: str = last_name
+        self.inode: int = inode
+        self.size: int = size
+        self.mtime: float = mtime
+
+    def pretty(self) -> str:
+        first, last = Datename(self.first_name).pretty(), Datename(self.last_name).pretty()
+        span = first if self.first_name == self.last_name else f"{first} - {last}"
+        return f"{span} ({self.size} bytes)"
+
+    def __repr__(self) -> str:
+        return f"VersionRun({self.first_name}, {self.last_name}, inode={self.inode}, size={self.size})"
+
+
+class VersionIndex:
+    """
+    Every version of every file across the snapshots of an archive.
+
+    A sqlite database maps relative paths to runs of consecutive snapshots
+    sharing an inode. Runs still present in the newest indexed snapshot are
+    open (last is NULL), so a new snapshot only costs closing and opening
+    the runs of the paths its diff against the previous one reports. A
+    pruned snapshot only moves the bounds of the runs starting or ending at
+    it. Snapshots older than the newest indexed one cause a rebuild.
+    """
+    version = 1
+    index_name = ".bkang_versions.sqlite"
+    _batch_size = 10000
+
+    def __init__(self, snapshots_path: Union[str, Path], index_path: Union[str, Path, None] = None, readonly: bool = False) -> None:
+        self.snapshots_path: Path = Path(snapshots_path)
+        if index_path is None:
+            index_path = self.snapshots_path.parent / self.index_name
+        self.index_path: Path = Path(index_path)
+        if readonly:
+            self.db = sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, timeout=30)
+            return
+        self.db = sqlite3.connect(str(self.index_path), timeout=30)
+        # readers (the browser) are not blocked by an update in progress
+        self.db.execute("PRAGMA journal_mode=WAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript("DROP TABLE IF EXISTS snapshots; DROP TABLE IF EXISTS runs;")
+        self.db.executescript(f"""
+            CREATE TABLE IF NOT EXISTS snapshots (epoch INTEGER PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS runs (path TEXT NOT NULL, first INTEGER NOT NULL, last INTEGER, inode INTEGER, size INTEGER, mtime REAL, PRIMARY KEY (path, first)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS runs_first ON runs (first);
+            CREATE INDEX IF NOT EXISTS runs_last ON runs (last);
+            PRAGMA user_version = {self.version};
+        """)
+
+    def snapshots(self) -> List[Tuple[int, str]]:
+        """
+        The indexed snapshots as (epoch, name), oldest first.
+        """
+        return self.db.execute("SELECT epoch, name FROM snapshots ORDER BY epoch").fetchall()
+
+    def versions(self, rel_path: str) -> List[VersionRun]:
+        """
+        The runs of rel_path, oldest first.
+        """
+        rel_path = os.path.normpath(rel_path).lstrip("/")
+        names = dict(self.snapshots())
+        if len(names) == 0:
+            return []
+        newest = max(names)
+        rows = self.db.execute("SELECT first, last, inode, size, mtime FROM runs WHERE path = ? ORDER BY first", (rel_path,)).fetchall()
+        return [VersionRun(names[first], names[last if last is not None else newest], inode, size, mtime) for first, last, inode, size, mtime in rows]
+
+    def _add(self, epoch: int, name: str, workers: int) -> int:
+        indexed = self.snapshots()
+        previous = indexed[-1] if indexed else None
+        old = self.snapshots_path / previous[1] if previous is not None else None
+        closing, opening = [], []
+        with self.db:
+            for record in diff_snapshots(old, self.snapshots_path / name, workers=workers, expand=True):
+                before, after = record.get("old"), record.get("new")
+                if before is not None and before["type"] != "dir":
+                    closing.append((previous[0], record["path"]))
+                if after is not None and after["type"] != "dir":
+                    opening.append((record["path"], epoch, after["inode"], after["size"], after["mtime"]))
+                if len(closing) + len(opening) >= self._batch_size:
+                    self._flush(closing, opening)
+            self._flush(closing, opening)
+            self.db.execute("INSERT INTO snapshots (epoch, name) VALUES (?, ?)", (epoch, name))
+        return len(indexed) + 1
+
+    def _flush(self, closing: List[Tuple], opening: List[Tuple]) -> None:
+        self.db.executemany("UPDATE runs SET last = ? WHERE path = ? AND last IS NULL", closing)
+        self.db.executemany("INSERT INTO runs (path, first, last, inode, size, mtime) VALUES (?, ?, NULL, ?, ?, ?)", opening)
+        closing.clear()
+        opening.clear()
+
+    def _remove(self, epoch: int) -> None:
+        previous = self.db.execute("SELECT MAX(epoch) FROM snapshots WHERE epoch < ?", (epoch,)).fetchone()[0]
+        following = self.db.execute("SELECT MIN(epoch) FROM snapshots WHERE epoch > ?", (epoch,)).fetchone()[0]
+        with self.db:
+            self.db.execute("DELETE FROM runs WHERE first = ? AND last = ?", (epoch, epoch))
+            if following is None:
+                # the newest snapshot goes, what ended just before it is the present again
+                self.db.execute("DELETE FROM runs WHERE first = ? AND last IS NULL", (epoch,))
+                self.db.execute("UPDATE runs SET last = NULL WHERE last = ?", (previous,))
+            else:
+                self.db.execute("UPDATE runs SET first = ? WHERE first = ?", (following, epoch))
+                self.db.execute("UPDATE runs SET last = ? WHERE last = ?", (previous, epoch))
+            self.db.execute("DELETE FROM snapshots WHERE epoch = ?", (epoch,))
+
+    def forget_from(self, epoch: int) -> int:
+        """
+        Drop the indexed snapshots from epoch on, eg. after their inodes changed, returns how many.
+
+        The next update indexes them again.
+        """
+        newer = [e for e, _ in self.snapshots() if e >= epoch]
+        for e in sorted(newer, reverse=True):
+            self._remove(e)
+        return len(newer)
+
+    def update(self, catalog: Optional[SnapshotCatalog] = None, workers: int = 8, progress_file: Optional[IO] = sys.stderr) -> Tuple[int, int]:
+        """
+        Bring the index in line with the snapshots on disk.
+
+        Returns how many snapshots were added and removed.
+        """
+        if catalog is None:
+            catalog = SnapshotCatalog(self.snapshots_path)
+        present = dict(zip(catalog.epochs.tolist(), catalog.names))
+        indexed = dict(self.snapshots())
+        removed = [e for e, name in indexed.items() if present.get(e) != name]
+        for epoch in sorted(removed, reverse=True):
+            self._remove(epoch)
+            del indexed[epoch]
+        added = sorted((e, name) for e, name in present.items() if e not in indexed)
+        if added and indexed and added[0][0] < max(indexed):
+            # runs can only grow forwards, an older snapshot appearing needs a rebuild
+            with self.db:
+                self.db.execute("DELETE FROM runs")
+                self.db.execute("DELETE FROM snapshots")
+            added = sorted(present.items())
+        for epoch, name in added:
+            if progress_file is not None:
+                print(f"Indexing versions of {name}", file=progress_file, flush=True)
+            self._add(epoch, name, workers)
+        return len(added), len(removed)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __repr__(self) -> str:
+        return f"VersionIndex({str(self.index_path)})"
+
+
+def update_version_index(snapshots_path: Union[str, Path], workers: int = 8, progress_file: Optional[IO] = sys.stderr) -> Tuple[int, int]:
+    """
+    Create or update the version index of the snapshots at snapshots_path.
+    """
+    index = VersionIndex(snapshots_path)
+    try:
+        return index.update(workers=workers, progress_file=progress_file)
+    finally:
+        index.close()
@@ -30,7 +30,7 @@ setup(
         "Operating System :: OS Independent",
     ],
     python_requires=">=3.9",
-    install_requires=["fargv", "toml", "PySide6", "python-crontab"],
+    install_requires=["fargv", "toml", "PySide6", "python-crontab", "numpy"],
     entry_points={
         "console_scripts": [
             "bkang-prune=bkang.datename:list_prune_main",
@@ -38,6 +38,12 @@ setup(
             "bkang-snapshot=bkang.datename:take_snapshot_main",
             "bkang-config=bkang.config:config_main",
             "bkang-setup=bkang.config:setup_main",
+            "bkang-bench=bkang.benchmark:benchmark_main",
+            "bkang-diff=bkang.diff:diff_main",
+            "bkang-find=bkang.names:find_main",
+            "bkang-dedup=bkang.dedup:dedup_main",
+            "bkang-daemon=bkang.daemon:daemon_main",
+            "bkang-verify=bkang.verify:verify_main",
         ],
         "gui_scripts": [
             "bkang-browse=bkang.gui_browser:main_browse_gui",
@@ -0,0 +1,86 @@
+import os
+import stat
+
+import pytest
+
+from bkang.btrfs import delete_commands, delete_subvolumes
+
+
+FAKE_BTRFS = """#!/bin/sh
+echo "$*" >> "{log}"
+[ "$1" = subvolume ] || exit 1
+case "$2" in
+delete)
+  shift 2; mode=no-commit
+  if [ "$1" = -c ]; then mode=commit; shift; fi
+  ret=0
+  for p in "$@"; do
+    case "$p" in
+    *busy*) echo "ERROR: Could not destroy subvolume/snapshot: Device or resource busy" >&2; echo "ERROR: cannot delete '$p'" >&2; ret=1;;
+    *) rm -rf "$p"; echo "Delete subvolume ($mode): '$p'";;
+    esac
+  done
+  exit $ret;;
+sync) exit 0;;
+esac
+exit 1
+"""
+
+
+@pytest.fixture
+def fake_btrfs(tmp_path, monkeypatch):
+    """
+    A btrfs on PATH deleting directories, failing on the ones named busy, and logging its arguments.
+    """
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    log = tmp_path / "calls.log"
+    script = bin_path / "btrfs"
+    script.write_text(FAKE_BTRFS.format(log=log))
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    return lambda: log.read_text().splitlines() if log.exists() else []
+
+
+def _subvolumes(tmp_path, names):
+    snapshots = tmp_path / "snapshots"
+    snapshots.mkdir(exist_ok=True)
+    for name in names:
+        (snapshots / name).mkdir()
+    return [str(snapshots / name) for name in names]
+
+
+def test_delete_commands_commit_only_last():
+    cmds = delete_commands([f"s{n}" for n in range(5)], batch_size=2)
+    assert cmds == ["btrfs subvolume delete s0 s1", "btrfs subvolume delete s2 s3", "btrfs subvolume delete -c s4"]
+    assert delete_commands(["s0"], commit=False) == ["btrfs subvolume delete s0"]
+    assert delete_commands([]) == []
+
+
+def test_batches_and_single_commit(tmp_path, fake_btrfs):
+    subvolumes = _subvolumes(tmp_path, [f"2024-01-{day:02d}-00-00-00" for day in range(1, 8)])
+    deletion = delete_subvolumes(subvolumes, batch_size=3, progress_file=None)
+    calls = fake_btrfs()
+    assert [len(c.split()) for c in calls] == [2 + 3, 2 + 3, 3 + 1]
+    assert [c.split()[2] == "-c" for c in calls] == [False, False, True]
+    assert deletion.commands == 3
+    assert deletion.deleted == subvolumes and deletion.errors == []
+    assert not any(os.path.exists(s) for s in subvolumes)
+
+
+def test_partial_failure_names_the_failed_subvolume(tmp_path, fake_btrfs):
+    subvolumes = _subvolumes(tmp_path, ["2024-01-01-00-00-00", "2024-01-02-00-00-00-busy", "2024-01-03-00-00-00", "2024-01-04-00-00-00-busy"])
+    deletion = delete_subvolumes(subvolumes, batch_size=2, progress_file=None)
+    assert deletion.deleted == [subvolumes[0], subvolumes[2]]
+    assert [path for path, _ in deletion.errors] == [subvolumes[1], subvolumes[3]]
+    # each error is the line naming its subvolume, not the batch's last message
+    for path, error in deletion.errors:
+        assert error == f"ERROR: cannot delete '{path}'"
+    assert os.path.isdir(subvolumes[1]) and os.path.isdir(subvolumes[3])
+
+
+def test_wait_cleaner(tmp_path, fake_btrfs):
+    subvolumes = _subvolumes(tmp_path, ["2024-01-01-00-00-00"])
+    deletion = delete_subvolumes(subvolumes, wait_cleaner=True, progress_file=None)
+    assert fake_btrfs()[-1] == f"subvolume sync {tmp_path / 'snapshots'}"
+    assert deletion.cleaner_seconds is not None and deletion.reclaimed_bytes is not None
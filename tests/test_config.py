@@ -0,0 +1,41 @@
+from pathlib import Path
+
+from bkang.config import validate_config_str
+
+
+# the configuration file bkang shipped before options were added to it
+BASELINE_CONFIG = """
+mode = "local"
+archive_address = "127.0.0.1"
+backup_src = "/home"
+archive_root = "/mnt/btrfs/backup"
+current_name = "current"
+snapshots_name = "snapshots"
+yearly_count = -1
+monthly_count = 12
+weekly_count = 5
+daily_count = 7
+hourly_count = 24
+fstype = "btrfs"
+crontab_identifier = "bkang"
+sync_crontab_freq = "0 * * * *"
+snapshot_crontab_freq = "30 * * * *"
+prune_crontab_freq = ""
+"""
+
+
+def test_default_config_validates():
+    default_config = Path(__file__).parent.parent / "bkang" / "resources" / "default_config.toml"
+    assert validate_config_str(default_config.read_text())
+
+
+def test_older_config_validates():
+    assert validate_config_str(BASELINE_CONFIG)
+    assert validate_config_str(BASELINE_CONFIG.replace('"local"', '"server"') + "sync_shards = 4\n")
+
+
+def test_invalid_configs():
+    assert not validate_config_str(BASELINE_CONFIG.replace("daily_count = 7", 'daily_count = "7"'))
+    assert not validate_config_str(BASELINE_CONFIG.replace('"local"', '"remote"'))
+    assert not validate_config_str(BASELINE_CONFIG.replace('"127.0.0.1"', '"backup@archive"'))
+    assert not validate_config_str("mode = ")
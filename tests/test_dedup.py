@@ -0,0 +1,82 @@
+import os
+import shutil
+
+from bkang.dedup import DedupIndex, dedup_snapshots
+from bkang.verify import VerifyIndex
+from bkang.versions import VersionIndex
+
+
+def _write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def _dedup(snapshots, dry_run=False):
+    return dedup_snapshots(snapshots, min_size=1, hash_workers=1, scan_workers=2, dry_run=dry_run, progress_file=None)
+
+
+def test_moved_file_is_relinked(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    data = os.urandom(10000)
+    _write(snapshots / "2024-01-01-00-00-00" / "docs" / "report.bin", data)
+    _write(snapshots / "2024-01-01-00-00-00" / "other.bin", os.urandom(500))
+    stats = _dedup(snapshots)
+    # unique sizes are recorded without hashing them
+    assert stats.hashed == 0
+    shutil.copytree(snapshots / "2024-01-01-00-00-00" / "docs", snapshots / "2024-01-02-00-00-00" / "moved")
+    stats = _dedup(snapshots)
+    assert (stats.hashed, stats.relinked, stats.errors) == (2, 1, [])
+    original = os.stat(snapshots / "2024-01-01-00-00-00" / "docs" / "report.bin")
+    moved = os.stat(snapshots / "2024-01-02-00-00-00" / "moved" / "report.bin")
+    assert moved.st_ino == original.st_ino and original.st_nlink == 2
+
+
+def test_same_size_different_contents_stay_apart(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _write(snapshots / "2024-01-01-00-00-00" / "a.bin", os.urandom(4096))
+    _dedup(snapshots)
+    _write(snapshots / "2024-01-02-00-00-00" / "b.bin", os.urandom(4096))
+    stats = _dedup(snapshots)
+    assert (stats.hashed, stats.relinked) == (2, 0)
+    # both are hashed now, a third file of that size only costs its own hash
+    _write(snapshots / "2024-01-03-00-00-00" / "c.bin", os.urandom(4096))
+    assert _dedup(snapshots).hashed == 1
+
+
+def test_unhashed_inode_of_a_pruned_snapshot_is_forgotten(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _write(snapshots / "2024-01-01-00-00-00" / "a.bin", os.urandom(3000))
+    _dedup(snapshots)
+    shutil.rmtree(snapshots / "2024-01-01-00-00-00")
+    _write(snapshots / "2024-01-02-00-00-00" / "b.bin", os.urandom(3000))
+    assert _dedup(snapshots).hashed == 0
+    index = DedupIndex(snapshots)
+    try:
+        assert [p for p, _ in index.unhashed(3000)] == [str(snapshots / "2024-01-02-00-00-00" / "b.bin")]
+    finally:
+        index.close()
+
+
+def test_relinking_refreshes_inode_indexes(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    data = os.urandom(8000)
+    _write(snapshots / "2024-01-01-00-00-00" / "a.bin", data)
+    (snapshots / "2024-01-02-00-00-00").mkdir()
+    shutil.copy2(snapshots / "2024-01-01-00-00-00" / "a.bin", snapshots / "2024-01-02-00-00-00" / "a.bin")
+    versions = VersionIndex(snapshots)
+    versions.update(progress_file=None)
+    assert len(versions.versions("a.bin")) == 2
+    verify = VerifyIndex(snapshots)
+    duplicate = os.stat(snapshots / "2024-01-02-00-00-00" / "a.bin")
+    verify.add_inode(str(snapshots / "2024-01-02-00-00-00" / "a.bin"), duplicate, "0" * 64, 0.0)
+    verify.db.commit()
+    verify.close()
+    assert _dedup(snapshots).relinked == 1
+    # the version index forgot the relinked snapshot and sees a single version once updated
+    versions.update(progress_file=None)
+    runs = versions.versions("a.bin")
+    assert len(runs) == 1 and runs[0].inode == os.stat(snapshots / "2024-01-01-00-00-00" / "a.bin").st_ino
+    versions.close()
+    verify = VerifyIndex(snapshots)
+    assert verify.db.execute("SELECT COUNT(*) FROM inodes WHERE inode = ?", (duplicate.st_ino,)).fetchone()[0] == 0
+    verify.close()
@@ -0,0 +1,73 @@
+import os
+import shutil
+
+import numpy as np
+
+from bkang.names import NameIndex, _trigram_keys
+
+
+def _snapshot(snapshots, name, paths):
+    for path in paths:
+        full = snapshots / name / path
+        full.parent.mkdir(parents=True, exist_ok=True)
+        full.write_text(path)
+
+
+def _index(tmp_path):
+    return NameIndex(tmp_path / "snapshots", tmp_path / "names")
+
+
+def test_non_ascii_names_ignore_case(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _snapshot(snapshots, "2024-01-01-00-00-00", ["Ärger/ÜBERSICHT.txt", "Straße.odt", "plain.txt"])
+    index = _index(tmp_path)
+    index.update(progress_file=None)
+    assert [p for p, _ in index.search("übersicht")] == ["Ärger/ÜBERSICHT.txt"]
+    assert [p for p, _ in index.search("ärger/*.TXT")] == ["Ärger/ÜBERSICHT.txt"]
+    assert [p for p, _ in index.search("STRASSE")] == []  # the regex decides, case folding only narrows
+    assert [p for p, _ in index.search("straße")] == ["Straße.odt"]
+
+
+def test_appended_trigrams_stay_sorted(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _snapshot(snapshots, "2024-01-01-00-00-00", ["zzz_report.txt", "aaa_notes.txt"])
+    index = _index(tmp_path)
+    index.update(progress_file=None)
+    _snapshot(snapshots, "2024-01-02-00-00-00", ["zzz_report.txt", "aaa_notes.txt", "mmm_report.txt"])
+    index.update(progress_file=None)
+    keys = np.asarray(_index(tmp_path).trigram_keys)
+    names = [index.path(n).encode() for n in range(len(index))]
+    assert keys.tolist() == _trigram_keys(names, np.arange(len(names))).tolist()
+    assert [p for p, _ in index.search("report")] == ["mmm_report.txt", "zzz_report.txt"]
+
+
+def test_prune_compacts_paths(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _snapshot(snapshots, "2024-01-01-00-00-00", [f"old/file{n}.txt" for n in range(20)])
+    _snapshot(snapshots, "2024-01-02-00-00-00", ["kept/report.txt"])
+    index = _index(tmp_path)
+    index.update(progress_file=None)
+    size = os.path.getsize(tmp_path / "names" / "paths.bin")
+    shutil.rmtree(snapshots / "2024-01-01-00-00-00")
+    assert index.update(progress_file=None) == (0, 1)
+    assert os.path.getsize(tmp_path / "names" / "paths.bin") < size
+    reloaded = _index(tmp_path)
+    assert sorted(reloaded.path(n) for n in range(len(reloaded))) == ["kept", "kept/report.txt"]
+    assert reloaded.search("report") == [("kept/report.txt", ["2024-01-02-00-00-00"])]
+    assert reloaded.search("file") == []
+    # the renumbered index keeps growing as before
+    _snapshot(snapshots, "2024-01-03-00-00-00", ["kept/report.txt", "new/report2.txt"])
+    reloaded.update(progress_file=None)
+    assert [p for p, _ in reloaded.search("report")] == ["kept/report.txt", "new/report2.txt"]
+
+
+def test_old_format_is_rebuilt(tmp_path):
+    snapshots = tmp_path / "snapshots"
+    _snapshot(snapshots, "2024-01-01-00-00-00", ["Übung.txt"])
+    index = _index(tmp_path)
+    index.update(progress_file=None)
+    (tmp_path / "names" / "version").unlink()
+    assert _index(tmp_path).search("übung") == []
+    rebuilt = _index(tmp_path)
+    assert rebuilt.update(progress_file=None) == (1, 0)
+    assert [p for p, _ in rebuilt.search("übung")] == ["Übung.txt"]
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from bkang.datename import Datename
+from bkang.retention import RETENTION_RULES, RetentionState, bucket_ids, plan_incremental, plan_retention
+
+
+def epoch(name: str) -> int:
+    return Datename(name).epoch
+
+
+@pytest.mark.parametrize("rule, last, first", [
+    ("minute", "2024-03-10-12-34-59", "2024-03-10-12-35-00"),
+    ("hourly", "2024-03-10-12-59-59", "2024-03-10-13-00-00"),
+    ("daily", "2024-03-10-23-59-59", "2024-03-11-00-00-00"),
+    # 2024-03-10 is a sunday, weeks start on monday
+    ("weekly", "2024-03-10-23-59-59", "2024-03-11-00-00-00"),
+    ("monthly", "2024-02-29-23-59-59", "2024-03-01-00-00-00"),
+    ("monthly", "2023-12-31-23-59-59", "2024-01-01-00-00-00"),
+    ("yearly", "2023-12-31-23-59-59", "2024-01-01-00-00-00"),
+])
+def test_bucket_boundaries(rule, last, first):
+    before, after = bucket_ids(np.array([epoch(last), epoch(first)]), rule).tolist()
+    assert after == before + 1
+
+
+def test_weeks_start_on_monday():
+    monday, sunday = epoch("2024-03-04-00-00-00"), epoch("2024-03-10-23-59-59")
+    assert len(set(bucket_ids(np.array([monday, sunday]), "weekly").tolist())) == 1
+    assert bucket_ids(np.array([epoch("1970-01-05-00-00-00")]), "weekly")[0] == 1  # the first monday after the epoch
+
+
+def test_invalid_rule():
+    with pytest.raises(ValueError):
+        bucket_ids(np.array([0]), "fortnightly")
+
+
+def test_keeps_newest_of_each_bucket():
+    names = ["2024-03-10-08-00-00", "2024-03-10-20-00-00", "2024-03-11-08-00-00", "2024-03-11-09-00-00"]
+    plan = plan_retention([epoch(n) for n in names], yearly_count=0, monthly_count=0, weekly_count=0, daily_count=-1, hourly_count=0)
+    assert plan.keep.tolist() == [1, 3]
+    assert plan.prune.tolist() == [0, 2]
+
+
+def test_counts_keep_the_newest_buckets():
+    epochs = [epoch(f"2024-03-{day:02d}-12-00-00") for day in range(1, 11)]
+    plan = plan_retention(epochs, yearly_count=0, monthly_count=0, weekly_count=0, daily_count=3, hourly_count=0)
+    assert plan.keep.tolist() == [7, 8, 9]
+    assert plan.explain() == {7: ["daily"], 8: ["daily"], 9: ["daily", "newest"]}
+
+
+def test_disabled_rules_keep_the_newest_and_empty_input():
+    epochs = [epoch("2024-03-02-12-00-00"), epoch("2024-03-01-12-00-00")]
+    plan = plan_retention(epochs, 0, 0, 0, 0, 0, 0)
+    # current links to the newest snapshot in linkdest mode, it is never pruned
+    assert plan.keep.tolist() == [0] and plan.prune.tolist() == [1]
+    assert plan.explain() == {0: ["newest"]}
+    empty = plan_retention([])
+    assert len(empty.keep) == 0 and len(empty.prune) == 0
+
+
+def test_unsorted_input_indexes_the_input():
+    epochs = [epoch("2024-03-02-12-00-00"), epoch("2024-03-01-08-00-00"), epoch("2024-03-01-20-00-00")]
+    plan = plan_retention(epochs, 0, 0, 0, -1, 0, 0)
+    assert plan.keep.tolist() == [0, 2]
+
+
+def _timeline(seed: int, size: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    gaps = rng.choice([60, 1800, 3600, 3600, 3600, 86400, 5 * 86400], size=size)
+    return epoch("2023-11-20-00-00-00") + np.cumsum(gaps)
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("counts", [(-1, 12, 5, 7, 24, 0), (1, 2, 2, 3, 4, 5), (-1, -1, -1, -1, 0, 0), (0, 0, 0, 0, 0, 0)])
+def test_incremental_matches_full_recompute(seed, counts):
+    epochs = _timeline(seed, 600)
+    rng = np.random.default_rng(seed + 100)
+    on_disk = np.zeros(0, dtype=np.int64)
+    state = None
+    arrived = 0
+    while arrived < len(epochs):
+        step = int(rng.integers(1, 40))
+        on_disk = np.concatenate([on_disk, epochs[arrived:arrived + step]])
+        arrived += step
+        prune, state, reused = plan_incremental(on_disk, state, *counts)
+        assert reused or state is not None
+        full = plan_retention(on_disk, *counts)
+        assert sorted(prune.tolist()) == full.prune.tolist()
+        on_disk = np.delete(on_disk, prune)
+    # after the first run every later one reused the state
+    assert reused
+
+
+def test_incremental_falls_back_on_changed_counts():
+    epochs = _timeline(0, 50)
+    _, state, _ = plan_incremental(epochs, None, -1, 12, 5, 7, 24, 0)
+    _, _, reused = plan_incremental(epochs, state, -1, 12, 5, 7, 12, 0)
+    assert not reused
+
+
+def test_state_round_trip(tmp_path):
+    epochs = _timeline(1, 100)
+    prune, state, _ = plan_incremental(epochs, None)
+    state.save(tmp_path / "state.json")
+    loaded = RetentionState.load(tmp_path / "state.json")
+    assert loaded.buckets == state.buckets and loaded.last_epoch == state.last_epoch
+    assert set(RETENTION_RULES) == set(loaded.buckets)
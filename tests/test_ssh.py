@@ -0,0 +1,183 @@
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import time
+
+import pytest
+
+from bkang.ssh import SSHConnection, close_connections, get_connection
+
+
+def _sshd_path():
+    return shutil.which("sshd") or next((p for p in ("/usr/sbin/sshd", "/usr/local/sbin/sshd") if os.path.exists(p)), None)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_options(tmp_path):
+    default = SSHConnection("backup@archive", control_dir=tmp_path)
+    assert "-p" not in default.ssh_options()
+    other = SSHConnection("backup@archive", 2222, control_dir=tmp_path)
+    assert other.ssh_options()[-2:] == ["-p", "2222"]
+    # one master per host and port, with a socket path short enough for any home
+    assert default.control_path != other.control_path
+    assert len(default.control_path.name) < 30
+    assert default.remote_cmd("ls '/a b'").endswith("backup@archive 'ls '\"'\"'/a b'\"'\"''")
+
+
+def test_get_connection_is_shared(tmp_path):
+    try:
+        assert get_connection("archive", control_dir=tmp_path) is get_connection("archive")
+        assert get_connection("archive") is not get_connection("archive", 2222, control_dir=tmp_path)
+    finally:
+        close_connections()
+
+
+FAKE_SSH = """#!/bin/sh
+# logs "<action> <master up before>" and keeps the master as a file at ControlPath
+control="" operation="" master=0 host="" command=""
+while [ $# -gt 0 ]; do
+  case "$1" in
+  -o) case "$2" in ControlPath=*) control="${{2#ControlPath=}}";; esac; shift 2;;
+  -O) operation="$2"; shift 2;;
+  -p) shift 2;;
+  -M) master=1; shift;;
+  -N|-f) shift;;
+  *) if [ -z "$host" ]; then host="$1"; else command="$command $1"; fi; shift;;
+  esac
+done
+up=0; [ -e "$control" ] && up=1
+case "$host" in *unreachable*) echo "connect $up" >> "{log}"; exit 255;; esac
+if [ -n "$operation" ]; then
+  echo "$operation $up" >> "{log}"
+  [ "$up" = 1 ] || exit 255
+  [ "$operation" = exit ] && rm -f "$control"
+  exit 0
+fi
+if [ "$master" = 1 ]; then
+  echo "master $up" >> "{log}"
+  touch "$control"
+  exit 0
+fi
+echo "run$command $up" >> "{log}"
+exit 0
+"""
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    """
+    An ssh on PATH emulating a ControlMaster with a file, and logging what each call did.
+    """
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    log = tmp_path / "ssh.log"
+    script = bin_path / "ssh"
+    script.write_text(FAKE_SSH.format(log=log))
+    script.chmod(script.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+
+    def calls():
+        calls = log.read_text().splitlines() if log.exists() else []
+        log.unlink(missing_ok=True)
+        return calls
+    return calls
+
+
+def test_master_is_started_once_and_reused(tmp_path, fake_ssh):
+    connection = SSHConnection("backup@archive", control_dir=tmp_path / "ctl")
+    assert connection.start()
+    assert fake_ssh() == ["master 0", "check 1"]
+    assert oct(os.stat(tmp_path / "ctl").st_mode & 0o777) == "0o700"
+    # a running master is only checked, every command goes through it
+    assert connection.start()
+    assert connection.health_check()
+    assert fake_ssh() == ["check 1", "check 1", "run true 1"]
+    assert SSHConnection("backup@archive", control_dir=tmp_path / "ctl").check()
+    assert not SSHConnection("backup@archive", 2222, control_dir=tmp_path / "ctl").check()
+    fake_ssh()
+    connection.stop()
+    assert fake_ssh() == ["exit 1"]
+    assert not connection.check()
+    # nothing to stop, nothing is sent
+    connection.stop()
+    assert fake_ssh() == []
+
+
+def test_context_manager_stops_the_master(tmp_path, fake_ssh):
+    with SSHConnection("backup@archive", control_dir=tmp_path / "ctl") as connection:
+        subprocess.run(connection.remote_cmd("ls /"), shell=True, check=True)
+    assert fake_ssh() == ["master 0", "check 1", "run ls / 1", "exit 1"]
+    assert not connection.control_path.exists()
+
+
+def test_master_failing_to_start(tmp_path, fake_ssh):
+    connection = SSHConnection("unreachable", control_dir=tmp_path / "ctl")
+    assert not connection.start()
+    assert not connection.health_check()
+    assert fake_ssh() == ["connect 0", "connect 0"]
+
+
+@pytest.mark.skipif(shutil.which("ssh") is None, reason="no ssh client")
+def test_unreachable_host(tmp_path):
+    connection = SSHConnection("127.0.0.1", _free_port(), control_dir=tmp_path / "ctl", connect_timeout=2)
+    assert not connection.health_check()
+    assert not connection.check()
+
+
+@pytest.fixture
+def sshd(tmp_path, monkeypatch):
+    """
+    A throwaway sshd on localhost accepting a fresh key, and an ssh on PATH that uses it.
+    """
+    sshd_path = _sshd_path()
+    if sshd_path is None or shutil.which("ssh-keygen") is None:
+        pytest.skip("no sshd")
+    for name in ("host_key", "client_key"):
+        subprocess.run(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", str(tmp_path / name)], check=True)
+    (tmp_path / "authorized_keys").write_text((tmp_path / "client_key.pub").read_text())
+    port = _free_port()
+    (tmp_path / "sshd_config").write_text(
+        f"Port {port}\nListenAddress 127.0.0.1\nHostKey {tmp_path / 'host_key'}\nAuthorizedKeysFile {tmp_path / 'authorized_keys'}\n"
+        f"PidFile {tmp_path / 'sshd.pid'}\nStrictModes no\nUsePAM no\nPasswordAuthentication no\nPermitRootLogin prohibit-password\n")
+    (tmp_path / "ssh_config").write_text(
+        f"Host *\n  IdentityFile {tmp_path / 'client_key'}\n  IdentitiesOnly yes\n  UserKnownHostsFile /dev/null\n  StrictHostKeyChecking no\n  LogLevel ERROR\n")
+    bin_path = tmp_path / "bin"
+    bin_path.mkdir()
+    wrapper = bin_path / "ssh"
+    wrapper.write_text(f"#!/bin/sh\nexec {shutil.which('ssh')} -F {tmp_path / 'ssh_config'} \"$@\"\n")
+    wrapper.chmod(wrapper.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    server = subprocess.Popen([sshd_path, "-D", "-e", "-f", str(tmp_path / "sshd_config")], stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                pytest.skip("sshd did not start")
+            time.sleep(0.1)
+    yield port
+    server.terminate()
+    server.wait()
+
+
+def test_master_is_shared(tmp_path, sshd):
+    connection = SSHConnection("127.0.0.1", sshd, control_dir=tmp_path / "ctl")
+    with connection:
+        assert connection.check()
+        assert connection.health_check()
+        result = subprocess.run(connection.remote_cmd("echo $SSH_CONNECTION"), shell=True, capture_output=True, text=True)
+        assert result.returncode == 0 and result.stdout.split()[-1] == str(sshd)
+        # a second connection object to the same host finds the running master
+        assert SSHConnection("127.0.0.1", sshd, control_dir=tmp_path / "ctl").check()
+    time.sleep(0.5)
+    assert not connection.check()